@@ -1,42 +1,157 @@
 from dataclasses import dataclass, field
+import asyncio
+import contextlib
+import functools
 import datetime
 import json
+import time
 import discord
 import emojis
 import logging
-from anthropic import Anthropic
-from anthropic.types import MessageParam
-from tools.toolbase import ToolBase
+from anthropic import AsyncAnthropic
+from anthropic.types import Message, MessageParam, TextBlockParam, ToolResultBlockParam, ToolUseBlock
+from Clients import get_anthropic_client
+from ToolLoader import ToolSource
+from ToolExecutor import TOOL_TIMEOUT_SECONDS, ToolExecutor
+from ToolRegistry import ToolRegistry, ToolTier
+from ModelRouter import ModelRoute, ModelRouter
+from ContextWindow import ContextEntry, ContextWindow, DEFAULT_CONTEXT_BUDGET
+from AttachmentCache import AttachmentCache
+from ConversationCache import ConversationCache
+from ConversationStore import ConversationStore, StoredMessage
+from DiscordDelivery import in_background, split_message, with_backoff
+from DiscordStreamWriter import DiscordStreamWriter
+import Metrics
+from RequestContext import RequestContext
+from RequestScheduler import RequestScheduler, SchedulerRejectedError
+from Resilience import Resilience
+from ResponseCache import ResponseCache, is_deterministic
 import utilities.discord as discord_utilities
 import utilities.openai as openai_utilities
 
-from config import CONFIG, DISCORD_MAX_MESSAGE_LENGTH
-from typing import List
+from config import CONFIG
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+MAX_CONCURRENT_TOOLS = 4
+
+SUMMARY_PROMPT = "Summarize the following conversation in a few sentences. Keep names, decisions, open questions and any facts later messages may rely on."
+SUMMARY_MAX_TOKENS = 512
+
+DEFAULT_MODEL = "claude-3-5-sonnet-20241022"
+# used for a single request while the default model is failing or overloaded
+FALLBACK_MODEL = "claude-3-5-haiku-20241022"
+
+DEFAULT_TEMPERATURE = 1.0
+
+# the default routes: quick chat on haiku, long or tool-heavy threads on sonnet
+DEFAULT_ROUTES = (
+    ModelRoute(FALLBACK_MODEL, strength=1, max_context_tokens=200_000, latency_slo=10.0),
+    ModelRoute(DEFAULT_MODEL, strength=2, max_context_tokens=200_000, latency_slo=30.0))
+
+CACHE_CONTROL = {"type": "ephemeral"}
 
 @dataclass
 class AnthropicMessageHandler:
-    standard_tools : List[ToolBase]
-    admin_tools : List[ToolBase]
+    standard_tools : List[ToolSource]
+    admin_tools : List[ToolSource]
+
+    # follow-ups must use the same model as the first call, the prompt cache is per model
+    model : str = DEFAULT_MODEL
+
+    max_concurrent_tools : int = MAX_CONCURRENT_TOOLS
+    # the default deadline, tools can set their own
+    tool_timeout : float = TOOL_TIMEOUT_SECONDS
+
+    stream : bool = False
+
+    # 0 makes replies repeatable, which is also what lets the response cache answer them
+    temperature : float = DEFAULT_TEMPERATURE
+
+    conversation_cache : ConversationCache = field(default_factory=ConversationCache)
+    attachment_cache : AttachmentCache = field(default_factory=AttachmentCache)
+    # optional history on disk, so a conversation can be picked up again without walking discord
+    conversation_store : Optional[ConversationStore] = None
+    # optional, answers a request identical to an earlier one without calling the api again
+    response_cache : Optional[ResponseCache] = None
+    # picks the model for each request from DEFAULT_ROUTES; None sends every request to model
+    router : Optional[ModelRouter] = field(default_factory=lambda: ModelRouter(DEFAULT_ROUTES, name="anthropic"))
+
+    scheduler : RequestScheduler = field(default_factory=lambda: RequestScheduler(name="anthropic"))
 
-    @staticmethod   
-    def get_empty_file_list() -> List[discord.File]:
-        return []
-    
-    files : List[discord.File] = field(default_factory=get_empty_file_list)
+    resilience : Resilience = field(default_factory=lambda: Resilience(name="anthropic", fallback_model=FALLBACK_MODEL))
 
-    anthropic_client = Anthropic(
-        # defaults to os.environ.get("ANTHROPIC_API_KEY")        
-    )
+    context_budget : int = DEFAULT_CONTEXT_BUDGET
+    summarize_dropped_context : bool = False
+
+    tool_registry : ToolRegistry = field(init=False)
+    tool_executor : ToolExecutor = field(init=False)
+    context_window : ContextWindow = field(init=False)
+
+    # injectable for tests and benchmarks, otherwise the process-wide client is built on first use
+    anthropic_client : Optional[AsyncAnthropic] = None
+
+    def __post_init__(self):
+        self.tool_registry = ToolRegistry(self.standard_tools, self.admin_tools)
+        self.tool_executor = ToolExecutor(default_timeout=self.tool_timeout)
+        self.context_window = ContextWindow(
+            budget=self.context_budget,
+            summarizer=self.summarize_transcript if self.summarize_dropped_context else None,
+            summary_role="user")
+
+    @property
+    def client(self) -> AsyncAnthropic:
+        if self.anthropic_client is None:
+            self.anthropic_client = get_anthropic_client()
+        return self.anthropic_client
+
+    async def get_stored_history(
+            self,
+            message: discord.Message) -> Optional[List[StoredMessage]]:
+        if self.conversation_store is None or message.reference is None:
+            return None
+        return await self.conversation_store.get_chain(message.reference.message_id, self.conversation_cache.max_chain_depth - 1)
+
+    async def convert_message(self, message: discord.Message) -> Dict[str, Any]:
+        param = await self.attachment_cache.convert(message, discord_utilities.discord_message_to_openai_chat_completion_param)
+        if self.conversation_store is not None:
+            self.conversation_store.remember_message(message, param) # type: ignore
+        return param
 
     async def get_conversation(
             self,
-            message: discord.Message) -> List[discord.Message]:
-        conversation : List[discord.Message] = [message]
+            message: discord.Message) -> List[ContextEntry]:
+        with Metrics.span("get_conversation", provider="anthropic") as span:
+            # when everything before this message is on disk, it is the only one discord has to provide
+            stored = await self.get_stored_history(message) or []
+            if stored:
+                records = [self.conversation_cache.remember(message, await self.convert_message(message))]
+            else:
+                records = await self.conversation_cache.get_chain(message, self.convert_message)
+            span.set("messages", len(stored) + len(records))
+        self.attachment_cache.log_stats()
+
+        return [(s.id, s.param) for s in stored] + [(r.id, r.param) for r in records] # type: ignore
+
+    async def remember_reply(self, message: discord.Message):
+        self.conversation_cache.remember(message, await self.convert_message(message))
+
+    # everything cached about a message, or built from it, goes at once when it is edited or deleted
+    def forget(self, message_id: int):
+        self.conversation_cache.forget(message_id)
+        self.context_window.forget(message_id)
+        self.attachment_cache.forget(message_id)
+        if self.conversation_store is not None:
+            self.conversation_store.forget(message_id)
+        if self.response_cache is not None:
+            self.response_cache.forget_message(message_id)
+
+    # gateway event hooks, wire these to the client's on_message_edit / on_raw_message_delete
+    def on_message_edit(self, before: discord.Message, after: discord.Message):
+        self.forget(after.id)
+        self.conversation_cache.remember(after)
 
-        while conversation[0].reference is not None and isinstance(conversation[0].reference.resolved, discord.Message):
-            conversation.insert(0, await conversation[0].reference.resolved.fetch())
-            
-        return conversation
+    def on_raw_message_delete(self, payload: discord.RawMessageDeleteEvent):
+        self.forget(payload.message_id)
 
     async def on_message(
             self,
@@ -44,40 +159,94 @@ class AnthropicMessageHandler:
         
         conversation = await self.get_conversation(message)
 
-        #convert the messages to chat completion params
-        chat_completion_messages = [await discord_utilities.discord_message_to_openai_chat_completion_param(m) for m in conversation]
+        #keep the newest messages that fit the token budget
+        window = await self.context_window.fit(conversation)
 
-        logging.info(f"Found {len(chat_completion_messages)} messages in the conversation.")
+        logging.info(f"Found {len(conversation)} messages in the conversation, sending {len(window.messages)} ({window.kept_tokens} tokens, {window.saved_tokens} tokens saved).")
 
-        await self.get_discord_message_response(
-            messages=chat_completion_messages, #type: ignore
-            discord_message=message)
+        model : Optional[str] = None
+        use_tools = True
+        if self.router is not None:
+            tools_available = bool(self.tool_registry.tier_for(message.author.id).tools)
+            route = self.router.choose(window.kept_tokens, tools_available, message.channel.id)
+            model, use_tools = route.model, route.supports_tools
 
+        #wait for a fair share of the provider before calling it
+        try:
+            async with self.scheduler.slot(message.author.id, message.channel.id):
+                await self.get_discord_message_response(
+                    messages=window.messages, #type: ignore
+                    discord_message=message,
+                    model=model,
+                    use_tools=use_tools,
+                    conversation_ids=tuple(i for i, _ in conversation if i is not None))
+        except SchedulerRejectedError as e:
+            logging.warning(str(e))
+            reply = await message.reply(content=f"I'm sorry, {message.author.mention}, I'm a little busy right now. Please try again in a moment.")
+            await reply.add_reaction(emojis.HAL9000)
+
+
+    async def summarize_transcript(self, transcript: str) -> str:
+        summary = await self.resilience.call(self.model, lambda model: self.client.messages.create(
+            system=SUMMARY_PROMPT,
+            messages=[{"role": "user", "content": transcript}],
+            model=model,
+            max_tokens=SUMMARY_MAX_TOKENS
+        ))
+        return next((c.text for c in summary.content if c.type == "text"), "")
 
     async def get_discord_message_response(
     self,
     discord_message: discord.Message,
     messages: list[MessageParam],        
-    temperature: float = 1.0,
-    max_tokens: int = 1024):
-        logging.info(f"Getting discord message response with claude...")
+    temperature: Optional[float] = None,
+    max_tokens: int = 1024,
+    model: Optional[str] = None,
+    use_tools: bool = True,
+    conversation_ids: Tuple[int, ...] = ()):
+        if temperature is None:
+            temperature = self.temperature
+        # the whole turn, tool rounds included, stays on one model, the prompt cache is per model
+        if model is None:
+            model = self.model
+
+        logging.info(f"Getting discord message response with {model}...")
 
         author = discord_message.author    
+
+        context = RequestContext(author=author, channel=discord_message.channel, message_id=discord_message.id, model=model, conversation_ids=conversation_ids)
         
-        available_tools: List[ToolBase] = self.standard_tools + (self.admin_tools if author.id == CONFIG.admin_user_id else [])
+        # a model routed to without tools gets none offered
+        available_tools : ToolTier = self.tool_registry.tier_for(author.id) if use_tools else ToolTier.build([])
+
+        # In streaming mode the placeholder goes out straight away and tokens are edited into it as they arrive
+        thinking_message : Optional[discord.Message] = None
+        writer : Optional[DiscordStreamWriter] = None
+        if self.stream:
+            thinking_message = await discord_message.reply("🤔")
+            in_background(discord_utilities.add_model_reactions("opus", thinking_message))
+            writer = DiscordStreamWriter(thinking_message, on_message=self.remember_reply)
 
         try:
-            chat_completion = self.anthropic_client.messages.create(
-                system=CONFIG.system_message,
+            chat_completion = await self.create_message(
+                writer,
+                context,
+                available_tools,
+                system=self.get_system_blocks(),
                 messages=messages,
-                model="claude-3-5-sonnet-20241022",                
+                model=model,                
                 max_tokens=max_tokens,
-                tools=[t.parameter for t in available_tools]
+                temperature=temperature,
+                tools=available_tools.parameters
             )
         except Exception as e:
             logging.exception(e)
-            discord_message = await discord_message.reply(content=f"I'm sorry, {author.mention}, I'm afraid I can't do that.\n{e}")
-            await discord_message.add_reaction(emojis.HAL9000)        
+            if writer is not None:
+                thinking_message = await writer.fail(f"I'm sorry, {author.mention}, I'm afraid I can't do that.\n{e}")
+                await thinking_message.add_reaction(emojis.HAL9000)
+            else:
+                discord_message = await discord_message.reply(content=f"I'm sorry, {author.mention}, I'm afraid I can't do that.\n{e}")
+                await discord_message.add_reaction(emojis.HAL9000)        
             return
         
         # Process tool calls
@@ -85,78 +254,314 @@ class AnthropicMessageHandler:
         # Process text content
         text_content = next((c for c in chat_completion.content if c.type == "text"), None)
         if tool_contents:
-            thinking_message = await discord_message.reply("🤔")
-            await discord_utilities.add_model_reactions("opus", thinking_message)
-
-            for tool_content in tool_contents:
-                tool_name = tool_content.name
-                tool_args = tool_content.input
-                tool = next((t for t in available_tools if t.parameter["name"] == tool_name), None)
-
-                if tool:
-                    await thinking_message.add_reaction(tool.emoji)
-                    try:
-                        tool_result = await tool.get_tool_result(json.dumps(tool_args), self)
-                        # Attempt to parse the tool_result as JSON, but use it as a string if it fails
-                        try:
-                            json.loads(tool_result)
-                        except json.JSONDecodeError:
-                            tool_result = json.dumps(tool_result)    
-
-                        # Send tool result back to the model
-                        follow_up_message = self.anthropic_client.messages.create(
-                            system=f'The current time is {datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")} UTC. Your responses are sent through Discord.',
-                            messages=messages + [
-                                {
-                                    "role": "assistant",
-                                    "content": [
-                                        {"type": "tool_use", "name": tool_name, "input": tool_args, "id": tool_content.id}
-                                    ]
-                                },
-                                {
-                                    "role": "user",
-                                    "content": [
-                                        {"type": "tool_result", "tool_use_id": tool_content.id, "content": tool_result}
-                                    ]
-                                }
-                            ],
-                            model="claude-3-5-sonnet-20240620",
-                            max_tokens=max_tokens,
-                            tools=[t.parameter for t in available_tools]
-                        )
-
-                        # Process the follow-up message
-                        follow_up_text = next((c for c in follow_up_message.content if c.type == "text"), None)
-                        if follow_up_text:
-                            await self.send_response(content=follow_up_text.text, message=thinking_message, is_edit=True)
-                        else:
-                            await thinking_message.edit(content="I processed the tool result, but I don't have any additional comments.")
-
-                    except Exception as e:
-                        logging.exception(e)
-                        await thinking_message.add_reaction(emojis.HAL9000)
-                        await thinking_message.edit(content=f"I encountered an error while using the {tool_name} tool: {str(e)}")
-                else:
-                    await thinking_message.edit(content=f"I'm sorry, {author.mention}, I'm afraid I can't do that.\nI don't know how to use the tool {tool_name}.")
+            if thinking_message is None:
+                thinking_message = await discord_message.reply("🤔")
+                in_background(discord_utilities.add_model_reactions("opus", thinking_message))
+
+            # generated files are attached to the placeholder as soon as each one is ready
+            context.attachment_message = thinking_message
+
+            num_tools = 0
+
+            while tool_contents:
+                num_tools += len(tool_contents)
+                context.tool_rounds += 1
+
+                # run every tool requested this turn concurrently, reactions go out alongside them
+                semaphore = asyncio.Semaphore(self.max_concurrent_tools)
+                reactions : List[asyncio.Task] = []
+
+                # gather keeps the call order, so the transcript the model sees stays deterministic
+                tool_results = await asyncio.gather(*[
+                    self.run_tool_use(tool_content, available_tools, context, thinking_message, semaphore, reactions)
+                    for tool_content in tool_contents])
+
+                # all the results of this turn go back to claude in a single follow-up
+                messages = messages + [
+                    {
+                        "role": "assistant",
+                        "content": chat_completion.content
+                    },
+                    {
+                        "role": "user",
+                        "content": tool_results
+                    }
+                ]
+
+                # reactions finish on their own time, the follow-up call does not wait for them
+                in_background(asyncio.gather(*reactions, return_exceptions=True))
+
+                logging.info(f"Returning {len(tool_results)} tool results to claude...")
+
+                if writer is not None:
+                    writer.paragraph()
+
+                # Send tool results back to the model
+                try:
+                    chat_completion = await self.create_message(
+                        writer,
+                        context,
+                        available_tools,
+                        system=self.get_system_blocks(),
+                        messages=messages,
+                        model=model,
+                        max_tokens=max_tokens,
+                        temperature=temperature,
+                        tools=available_tools.parameters
+                    )
+                except Exception as e:
+                    logging.exception(e)
+                    if writer is not None:
+                        thinking_message = await writer.fail(f"I'm sorry, {author.mention}, I'm afraid I can't do that.\n{str(e)}")
+                    else:
+                        await thinking_message.edit(content=f"I'm sorry, {author.mention}, I'm afraid I can't do that.\n{str(e)}")
                     await thinking_message.add_reaction(emojis.HAL9000)
+                    return
+
+                tool_contents = [c for c in chat_completion.content if c.type == "tool_use"]
+
+            logging.info(f"Claude used {num_tools} tools.")
+            Metrics.get_sink().observe("tool_rounds", context.tool_rounds, provider="anthropic", model=model)
+            if self.router is not None:
+                self.router.record_tool_use(discord_message.channel.id)
+
+            # handle files that may have been generated
+            await context.attach_pending_files()
+            thinking_message = context.attachment_message
+
+            # Process the follow-up message
+            follow_up_text = next((c for c in chat_completion.content if c.type == "text"), None)
+            if writer is not None:
+                await writer.close()
+                if not writer.written:
+                    await thinking_message.edit(content="I processed the tool result, but I don't have any additional comments.")
+            elif follow_up_text:
+                await self.send_response(content=follow_up_text.text, message=thinking_message, is_edit=True, model=model)
+            else:
+                await thinking_message.edit(content="I processed the tool result, but I don't have any additional comments.")
+
+        elif writer is not None and thinking_message is not None:
+            await writer.close()
+            if not writer.written:
+                await thinking_message.edit(content=f"I'm sorry, {author.mention}, but I didn't generate any response or tool calls.")
 
         elif text_content:
-            await self.send_response(content=text_content.text, message=discord_message, is_edit=False)
+            await self.send_response(content=text_content.text, message=discord_message, is_edit=False, model=model)
 
         elif not text_content:
             await discord_message.reply(content=f"I'm sorry, {author.mention}, but I didn't generate any response or tool calls.")
 
+    def get_system_blocks(self) -> List[TextBlockParam]:
+        # only the date goes in, so the cached prefix stays valid for a whole day of turns
+        return [
+            {
+                "type": "text",
+                "text": CONFIG.system_message
+            },
+            {
+                "type": "text",
+                "text": f'The current date is {datetime.datetime.utcnow().strftime("%Y-%m-%d")} UTC. Your responses are sent through Discord.',
+                "cache_control": CACHE_CONTROL
+            }
+        ]
+
+    @staticmethod
+    def with_cache_breakpoint(messages: List[MessageParam]) -> List[MessageParam]:
+        # mark the end of the conversation so the next turn or tool round reads everything before it from the cache,
+        # copying rather than touching the caller's messages
+        if not messages:
+            return messages
+
+        last = messages[-1]
+        content = last["content"]
+        if isinstance(content, str):
+            blocks = [{"type": "text", "text": content}]
+        else:
+            blocks = list(content)
+
+        if not blocks or not isinstance(blocks[-1], dict):
+            return messages
+
+        blocks[-1] = {**blocks[-1], "cache_control": CACHE_CONTROL}
+
+        return messages[:-1] + [{**last, "content": blocks}]  # type: ignore
+
+    def response_cache_key(self, available_tools: ToolTier, kwargs: Dict[str, Any]) -> Optional[str]:
+        if self.response_cache is None or not is_deterministic(kwargs.get("temperature")):
+            return None
+        return self.response_cache.key(
+            provider="anthropic",
+            model=kwargs["model"],
+            system=kwargs.get("system"),
+            # the tier's hash stands in for its schemas, which are the same bytes on every request
+            tools=available_tools.schema_hash if "tools" in kwargs else None,
+            temperature=kwargs.get("temperature"),
+            messages=kwargs["messages"],
+            max_tokens=kwargs.get("max_tokens"))
+
+    @staticmethod
+    def only_cacheable_tools(tool_names: Iterable[str], available_tools: ToolTier) -> bool:
+        # a reply that came out of, or asks for, a tool with side effects or a random result can't be replayed
+        for name in tool_names:
+            tool = available_tools.get(name)
+            if tool is None or not tool.cache_policy.enabled:
+                return False
+        return True
+
+    async def create_message(
+            self,
+            writer: Optional[DiscordStreamWriter],
+            context: RequestContext,
+            available_tools: ToolTier,
+            **kwargs) -> Message:
+        kwargs["messages"] = self.with_cache_breakpoint(kwargs["messages"])
+
+        cache_key = self.response_cache_key(available_tools, kwargs)
+        if cache_key is not None:
+            assert self.response_cache is not None
+            cached = await self.response_cache.get(cache_key, "anthropic", kwargs["model"])
+            if cached is not None:
+                message = Message.model_validate_json(cached)
+                if writer is not None:
+                    for block in message.content:
+                        if block.type == "text":
+                            await writer.write(block.text)
+                return message
+
+        # a stream can only be retried while nothing has reached discord yet, and is never hedged
+        written = writer.written if writer is not None else 0
+        served_by : Optional[str] = None
+        started = time.monotonic()
+
+        async def attempt(model: str) -> Message:
+            nonlocal served_by
+            served_by = model
+            # the router's latency and error rate come from every attempt that ran to the end
+            tracked = self.router.track(model) if self.router is not None else contextlib.nullcontext()
+            with tracked, Metrics.span("completion", provider="anthropic", model=model, stream=writer is not None, tool_round=context.tool_rounds) as span:
+                if writer is None:
+                    message = await self.client.messages.create(**{**kwargs, "model": model})
+                else:
+                    async with self.client.messages.stream(**{**kwargs, "model": model}) as stream:
+                        async for text in stream.text_stream:
+                            await writer.write(text)
+
+                        message = await stream.get_final_message()
+
+                usage = message.usage
+                span.set("input_tokens", usage.input_tokens)
+                span.set("output_tokens", usage.output_tokens)
+                span.set("cache_read_tokens", usage.cache_read_input_tokens or 0)
+                span.set("cache_write_tokens", usage.cache_creation_input_tokens or 0)
+
+            if self.conversation_store is not None:
+                self.conversation_store.record_usage(
+                    context.message_id, "anthropic", model, usage.input_tokens, usage.output_tokens,
+                    usage.cache_read_input_tokens or 0, usage.cache_creation_input_tokens or 0)
+
+            logging.info(f"Claude usage: {usage.input_tokens} input, {usage.cache_read_input_tokens or 0} cache read, {usage.cache_creation_input_tokens or 0} cache write, {usage.output_tokens} output tokens.")
+
+            return message
+
+        message = await self.resilience.call(
+            kwargs["model"],
+            attempt,
+            hedge=writer is None,
+            can_retry=lambda: writer is None or writer.written == written)
+
+        # a fallback model's reply is not what the requested model would have said
+        tool_names = [name for name, _ in context.tool_timings] + [c.name for c in message.content if c.type == "tool_use"]
+        if cache_key is not None and served_by == kwargs["model"] and self.only_cacheable_tools(tool_names, available_tools):
+            assert self.response_cache is not None
+            self.response_cache.put(cache_key, message.model_dump_json(), time.monotonic() - started, context.conversation_ids)
+
+        return message
+
+    async def run_tool_use(
+            self,
+            tool_content: ToolUseBlock,
+            available_tools: ToolTier,
+            context: RequestContext,
+            thinking_message: discord.Message,
+            semaphore: asyncio.Semaphore,
+            reactions: List[asyncio.Task]) -> ToolResultBlockParam:
+        tool_name = tool_content.name
+        tool_args = tool_content.input
+
+        logging.info(f'{{ "id" = "{tool_content.id}", "name" = "{tool_name}", "args" = {json.dumps(tool_args)}}}')
+
+        tool = available_tools.get(tool_name)
+
+        if tool is None:
+            reactions.append(asyncio.create_task(thinking_message.add_reaction(emojis.HAL9000)))
+            return self.tool_error(tool_content, context, f"I don't know how to use the tool {tool_name}.")
+
+        reactions.append(asyncio.create_task(thinking_message.add_reaction(tool.emoji)))
+        elapsed : Optional[float] = None
+        try:
+            async with semaphore:
+                started = time.monotonic()
+                try:
+                    tool_result = await self.tool_executor.run(
+                        tool,
+                        tool_name,
+                        json.dumps(tool_args),
+                        context,
+                        provider="anthropic",
+                        model=context.model,
+                        tool_round=context.tool_rounds)
+                finally:
+                    elapsed = time.monotonic() - started
+                    context.record_tool_timing(tool_name, elapsed)
+        except asyncio.TimeoutError:
+            timeout = self.tool_executor.timeout_for(tool)
+            logging.error(f"Tool {tool_name} timed out after {timeout}s.")
+            reactions.append(asyncio.create_task(thinking_message.add_reaction(emojis.HAL9000)))
+            return self.tool_error(tool_content, context, f"The {tool_name} tool timed out after {timeout} seconds.", elapsed)
+        except Exception as e:
+            logging.exception(e)
+            reactions.append(asyncio.create_task(thinking_message.add_reaction(emojis.HAL9000)))
+            return self.tool_error(tool_content, context, f"I encountered an error while using the {tool_name} tool: {str(e)}", elapsed)
+
+        # Attempt to parse the tool_result as JSON, but use it as a string if it fails
+        try:
+            json.loads(tool_result)
+        except json.JSONDecodeError:
+            tool_result = json.dumps(tool_result)    
+
+        logging.info(f'{{ "id" = "{tool_content.id}", "content" = {tool_result}}}')
+
+        if self.conversation_store is not None:
+            self.conversation_store.record_tool_call(tool_content.id, context.message_id, tool_name, json.dumps(tool_args), tool_result, False, elapsed)
+
+        return {"type": "tool_result", "tool_use_id": tool_content.id, "content": tool_result}
+
+    def tool_error(
+            self,
+            tool_content: ToolUseBlock,
+            context: RequestContext,
+            error: str,
+            elapsed: Optional[float] = None) -> ToolResultBlockParam:
+        if self.conversation_store is not None:
+            self.conversation_store.record_tool_call(tool_content.id, context.message_id, tool_content.name, json.dumps(tool_content.input), error, True, elapsed)
+
+        return {"type": "tool_result", "tool_use_id": tool_content.id, "content": error, "is_error": True}
+
     async def send_response(
             self, 
             content: str, 
             message: discord.Message, 
-            is_edit: bool):
-        chunks = [content[i:i + DISCORD_MAX_MESSAGE_LENGTH] for i in range(0, len(content), DISCORD_MAX_MESSAGE_LENGTH)]
-        start = 0
-        if is_edit:
-            message = await message.edit(content=chunks[start])
-            start += 1
-        
-        for i in range(start, len(chunks)):
-            message = await message.reply(content = chunks[i])
-            #await discord_utilities.add_model_reactions("opus", message)
+            is_edit: bool,
+            model: Optional[str] = None):
+        if model is None:
+            model = self.model
+
+        with Metrics.span("send_response", provider="anthropic", model=model):
+            # split at line and word breaks, without cutting code blocks in half
+            chunks = split_message(content) or [content]
+            for i, chunk in enumerate(chunks):
+                if i == 0 and is_edit:
+                    message = await with_backoff(functools.partial(message.edit, content=chunk))
+                else:
+                    message = await with_backoff(functools.partial(message.reply, content=chunk))
+                await self.remember_reply(message)
@@ -0,0 +1,93 @@
+from collections import OrderedDict
+from dataclasses import dataclass, field
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+import discord
+
+DEFAULT_MAX_CACHED_BYTES = 64 * 1024 * 1024
+
+Converter = Callable[[discord.Message], Awaitable[Any]]
+AttachmentKey = Tuple[int, Optional[float], Tuple[Tuple[int, int], ...]]
+
+def estimate_size(value: Any) -> int:
+    # the base64 image data dominates, everything else is a rounding error
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(estimate_size(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(estimate_size(v) for v in value)
+    return 8
+
+# converted messages that carry attachments or embeds, so an image heavy thread downloads
+# and encodes each image once rather than on every turn
+@dataclass
+class AttachmentCache:
+    max_bytes : int = DEFAULT_MAX_CACHED_BYTES
+
+    entries : "OrderedDict[AttachmentKey, Tuple[int, Any]]" = field(default_factory=OrderedDict)
+    in_flight : Dict[AttachmentKey, "asyncio.Task[Any]"] = field(default_factory=dict)
+    total_bytes : int = 0
+
+    hits : int = 0
+    misses : int = 0
+
+    @staticmethod
+    def key(message: discord.Message) -> Optional[AttachmentKey]:
+        if not message.attachments and not message.embeds:
+            return None
+        # an edit or a swapped attachment changes the key, so stale content is never served
+        edited_at = message.edited_at.timestamp() if message.edited_at is not None else None
+        return (message.id, edited_at, tuple((a.id, a.size) for a in message.attachments))
+
+    def put(self, key: AttachmentKey, param: Any):
+        size = estimate_size(param)
+        if size > self.max_bytes:
+            return
+
+        previous = self.entries.pop(key, None)
+        if previous is not None:
+            self.total_bytes -= previous[0]
+
+        self.entries[key] = (size, param)
+        self.total_bytes += size
+
+        while self.total_bytes > self.max_bytes:
+            _, (evicted_size, _) = self.entries.popitem(last=False)
+            self.total_bytes -= evicted_size
+
+    def forget(self, message_id: int):
+        # an edit already changes the key, but a delete doesn't
+        for key in [k for k in self.entries if k[0] == message_id]:
+            size, _ = self.entries.pop(key)
+            self.total_bytes -= size
+
+    async def convert(self, message: discord.Message, converter: Converter) -> Any:
+        key = self.key(message)
+        if key is None:
+            return await converter(message)
+
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+        # the same thread answered in two channels at once still downloads once
+        task = self.in_flight.get(key)
+        if task is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            task = asyncio.ensure_future(converter(message))
+            self.in_flight[key] = task
+            task.add_done_callback(lambda _: self.in_flight.pop(key, None))
+
+        param = await asyncio.shield(task)
+        self.put(key, param)
+        return param
+
+    def log_stats(self):
+        logging.info(f"Attachment cache: {self.hits} hits, {self.misses} misses, {len(self.entries)} messages, {self.total_bytes / (1024 * 1024):.1f} MiB.")
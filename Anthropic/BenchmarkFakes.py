@@ -0,0 +1,247 @@
+from dataclasses import dataclass, field
+import asyncio
+import itertools
+import json
+import time
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+import discord
+from anthropic.types import Message, ToolParam
+
+from tools.toolbase import ToolBase
+
+# in-process stand-ins for discord and the anthropic api, so the handler can be driven with no network at all
+
+MESSAGE_IDS = itertools.count(1_000_000)
+
+@dataclass
+class FakeLatency:
+    # discord rest calls
+    fetch : float = 0.05
+    reply : float = 0.08
+    edit : float = 0.05
+    reaction : float = 0.03
+    # model
+    first_token : float = 0.4
+    per_token : float = 0.005
+    tokens : int = 60
+    # tools
+    tool : float = 0.2
+
+@dataclass
+class FakeUser:
+    id : int
+    name : str = "user"
+    bot : bool = False
+
+    @property
+    def display_name(self) -> str:
+        return self.name
+
+    @property
+    def mention(self) -> str:
+        return f"<@{self.id}>"
+
+@dataclass
+class FakeChannel:
+    id : int
+
+@dataclass
+class FakeReference:
+    message_id : int
+    resolved : Optional["FakeMessage"] = None
+
+@dataclass
+class FakeCounters:
+    fetches : int = 0
+    replies : int = 0
+    edits : int = 0
+    reactions : int = 0
+    first_content_at : Optional[float] = None
+
+    def saw_content(self, content: Optional[str]):
+        # the placeholder doesn't count, the first real text the user can read does
+        if content and content != "🤔" and self.first_content_at is None:
+            self.first_content_at = time.perf_counter()
+
+class FakeMessage(discord.Message):
+    # discord.Message has no usable constructor outside the gateway, so the slots it relies on are filled in by hand
+    def __init__(
+            self,
+            content: str,
+            author: FakeUser,
+            channel: FakeChannel,
+            latency: FakeLatency,
+            counters: FakeCounters,
+            parent: Optional["FakeMessage"] = None):
+        self.id = next(MESSAGE_IDS)
+        self.content = content
+        self.author = author  # type: ignore
+        self.channel = channel  # type: ignore
+        self.attachments = []
+        self.embeds = []
+        self.reference = FakeReference(parent.id, parent) if parent is not None else None  # type: ignore
+        self._edited_timestamp = None
+        self.latency = latency
+        self.counters = counters
+
+    async def fetch(self) -> "FakeMessage":
+        self.counters.fetches += 1
+        await asyncio.sleep(self.latency.fetch)
+        return self
+
+    async def reply(self, content: Optional[str] = None, **kwargs) -> "FakeMessage":
+        self.counters.replies += 1
+        await asyncio.sleep(self.latency.reply)
+        self.counters.saw_content(content)
+        return FakeMessage(content or "", BOT_USER, self.channel, self.latency, self.counters, parent=self)
+
+    async def edit(self, content: Optional[str] = None, **kwargs) -> "FakeMessage":
+        self.counters.edits += 1
+        await asyncio.sleep(self.latency.edit)
+        self.counters.saw_content(content)
+        if content is not None:
+            self.content = content
+        return self
+
+    async def add_files(self, *files: discord.File) -> "FakeMessage":
+        return await self.edit()
+
+    async def add_reaction(self, emoji: Any):
+        self.counters.reactions += 1
+        await asyncio.sleep(self.latency.reaction)
+
+BOT_USER = FakeUser(id=1, name="bot", bot=True)
+
+def make_reply_chain(
+        depth: int,
+        user_id: int,
+        channel_id: int,
+        latency: FakeLatency,
+        counters: FakeCounters,
+        parent: Optional[FakeMessage] = None) -> FakeMessage:
+    # the chain ends on the user's turn, and continues from parent when one is given
+    user = FakeUser(id=user_id)
+    channel = FakeChannel(id=channel_id)
+
+    message : Optional[FakeMessage] = parent
+    for i in range(depth):
+        author = user if (depth - 1 - i) % 2 == 0 else BOT_USER
+        message = FakeMessage(f"message {i} of a conversation about benchmarks " * 4, author, channel, latency, counters, parent=message)
+
+    assert message is not None
+    return message
+
+def make_thread(depth: int, user_id: int, channel_id: int, latency: FakeLatency) -> FakeMessage:
+    # history that many messages reply to, ending on the bot's turn so each of them is the user's next one
+    chain = make_reply_chain(depth + 1, user_id, channel_id, latency, FakeCounters())
+    assert chain.reference is not None and chain.reference.resolved is not None
+    return chain.reference.resolved
+
+@dataclass
+class FakeToolScript:
+    # tool names the model asks for on each round, the reply after the last round is plain text
+    rounds : List[List[str]] = field(default_factory=list)
+
+    def tool_calls_for(self, messages: List[Any]) -> List[str]:
+        # count the tool rounds since the last user message, so the script needs no state per conversation
+        round = 0
+        for m in reversed(messages):
+            role = m.get("role") if isinstance(m, dict) else getattr(m, "role", None)
+            content = m.get("content") if isinstance(m, dict) else getattr(m, "content", None)
+            is_tool_result = isinstance(content, list) and any(isinstance(b, dict) and b.get("type") == "tool_result" for b in content)
+            if role == "user" and not is_tool_result:
+                break
+            if role == "assistant":
+                round += 1
+        return self.rounds[round] if round < len(self.rounds) else []
+
+class FakeMessageStream:
+    def __init__(self, messages: "FakeMessages", message: Dict[str, Any]):
+        self.messages = messages
+        self.message = message
+
+    async def __aenter__(self) -> "FakeMessageStream":
+        await asyncio.sleep(self.messages.latency.first_token)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return None
+
+    @property
+    async def text_stream(self) -> AsyncIterator[str]:
+        for block in self.message["content"]:
+            if block["type"] != "text":
+                continue
+            for _ in range(self.messages.latency.tokens):
+                await asyncio.sleep(self.messages.latency.per_token)
+                yield "token "
+
+    async def get_final_message(self) -> Message:
+        return self.messages.to_message(self.message)
+
+class FakeMessages:
+    def __init__(self, latency: FakeLatency, script: FakeToolScript):
+        self.latency = latency
+        self.script = script
+        self.calls = 0
+
+    def build_message(self, messages: List[Any], tools_offered: bool) -> Dict[str, Any]:
+        self.calls += 1
+        tool_names = self.script.tool_calls_for(messages) if tools_offered else []
+        if tool_names:
+            content = [{ "type": "tool_use", "id": f"toolu_{self.calls}_{i}", "name": name, "input": {} } for i, name in enumerate(tool_names)]
+            return { "content": content, "stop_reason": "tool_use" }
+        return { "content": [{ "type": "text", "text": " ".join(["token"] * self.latency.tokens) }], "stop_reason": "end_turn" }
+
+    def to_message(self, message: Dict[str, Any]) -> Message:
+        return Message.model_validate({
+            "id": f"msg_{self.calls}",
+            "type": "message",
+            "role": "assistant",
+            "model": "fake",
+            "content": message["content"],
+            "stop_reason": message["stop_reason"],
+            "stop_sequence": None,
+            "usage": { "input_tokens": 100, "output_tokens": self.latency.tokens, "cache_creation_input_tokens": 0, "cache_read_input_tokens": 0 } })
+
+    async def create(self, messages: List[Any], tools: Any = None, **kwargs) -> Message:
+        message = self.build_message(messages, bool(tools))
+        await asyncio.sleep(self.latency.first_token + self.latency.per_token * self.latency.tokens)
+        return self.to_message(message)
+
+    def stream(self, messages: List[Any], tools: Any = None, **kwargs) -> FakeMessageStream:
+        return FakeMessageStream(self, self.build_message(messages, bool(tools)))
+
+class FakeAnthropicClient:
+    def __init__(self, latency: FakeLatency, script: FakeToolScript):
+        self.messages = FakeMessages(latency, script)
+
+@dataclass
+class FakeTool(ToolBase):
+    emoji : str = "🧪"
+    name : str = "fake_tool"
+    latency : float = 0.2
+
+    @staticmethod
+    def create_anthropic_tool_param() -> ToolParam:
+        return ToolParam(
+            {
+                "name": "fake_tool",
+                "description": "A tool that only waits",
+                "input_schema": {
+                    "type": "object",
+                    "properties": {},
+                    "required": [],
+                }
+            }
+        )
+
+    parameter : ToolParam = field(default_factory=create_anthropic_tool_param)
+
+    def __post_init__(self):
+        self.parameter["name"] = self.name
+
+    async def get_tool_result(self, arguments: str, message_handler) -> str:
+        await asyncio.sleep(self.latency)
+        return json.dumps({ "result": "ok" })
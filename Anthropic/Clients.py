@@ -0,0 +1,22 @@
+import functools
+
+# one pooled transport is shared by every conversation the bot has in flight
+ANTHROPIC_MAX_CONNECTIONS = 100
+ANTHROPIC_MAX_KEEPALIVE_CONNECTIONS = 20
+
+# sdk clients are built on first use rather than at import time, so a restarted process
+# that never talks to a provider never pays for its client, and every user shares one pool
+
+@functools.lru_cache(maxsize=None)
+def get_anthropic_client():
+    import httpx
+    from anthropic import AsyncAnthropic, DefaultAsyncHttpxClient
+
+    # Resilience owns retries, the sdk's own would multiply with them
+    return AsyncAnthropic(
+        max_retries=0,
+        # defaults to os.environ.get("ANTHROPIC_API_KEY")
+        http_client=DefaultAsyncHttpxClient(
+            limits=httpx.Limits(
+                max_connections=ANTHROPIC_MAX_CONNECTIONS,
+                max_keepalive_connections=ANTHROPIC_MAX_KEEPALIVE_CONNECTIONS)))
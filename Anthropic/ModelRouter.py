@@ -0,0 +1,141 @@
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+import asyncio
+import logging
+import math
+import time
+from typing import Deque, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import Metrics
+
+# latencies and errors older than this no longer count, so a model that was routed around gets another chance
+ROLLING_WINDOW_SECONDS = 5 * 60
+MAX_SAMPLES = 200
+# fewer samples than this and a model is assumed to be fine
+MIN_SAMPLES = 5
+MAX_ERROR_RATE = 0.2
+
+# conversations up to this size, in a channel that hasn't used tools lately, count as quick chat
+QUICK_CHAT_TOKENS = 4_000
+# a channel that used tools within this long is treated as a tool-heavy thread
+TOOL_HEAVY_SECONDS = 15 * 60
+MAX_TRACKED_CHANNELS = 10_000
+
+DEFAULT_LATENCY_SLO_SECONDS = 30.0
+
+@dataclass(frozen=True)
+class ModelRoute:
+    model : str
+    # higher is more capable; quick chat goes to the weakest model that fits, tool-heavy threads to the strongest
+    strength : int = 1
+    # the largest conversation, in tokens, the model is sent
+    max_context_tokens : int = 128_000
+    supports_tools : bool = True
+    # the p95 latency the model is expected to hold, it is routed around while it doesn't
+    latency_slo : float = DEFAULT_LATENCY_SLO_SECONDS
+
+@dataclass
+class ModelStats:
+    # (finished at, seconds, succeeded)
+    samples : Deque[Tuple[float, float, bool]] = field(default_factory=lambda: deque(maxlen=MAX_SAMPLES))
+
+    def prune(self, now: float):
+        while self.samples and self.samples[0][0] < now - ROLLING_WINDOW_SECONDS:
+            self.samples.popleft()
+
+    def record(self, seconds: float, succeeded: bool):
+        now = time.monotonic()
+        self.prune(now)
+        self.samples.append((now, seconds, succeeded))
+
+    def p95(self) -> Optional[float]:
+        latencies = sorted(seconds for _, seconds, succeeded in self.samples if succeeded)
+        if not latencies:
+            return None
+        return latencies[math.ceil(0.95 * len(latencies)) - 1]
+
+    def error_rate(self) -> float:
+        if not self.samples:
+            return 0.0
+        return sum(1 for _, _, succeeded in self.samples if not succeeded) / len(self.samples)
+
+@dataclass
+class ModelRouter:
+    routes : Sequence[ModelRoute]
+    name : str = "provider"
+
+    quick_chat_tokens : int = QUICK_CHAT_TOKENS
+    max_error_rate : float = MAX_ERROR_RATE
+
+    stats : Dict[str, ModelStats] = field(default_factory=dict)
+    tool_use : "OrderedDict[int, float]" = field(default_factory=OrderedDict)
+
+    def __post_init__(self):
+        if not self.routes:
+            raise ValueError("A model router needs at least one route")
+
+    def stats_for(self, model: str) -> ModelStats:
+        stats = self.stats.get(model)
+        if stats is None:
+            stats = self.stats[model] = ModelStats()
+        return stats
+
+    def is_healthy(self, route: ModelRoute) -> bool:
+        stats = self.stats_for(route.model)
+        stats.prune(time.monotonic())
+        if len(stats.samples) < MIN_SAMPLES:
+            return True
+        p95 = stats.p95()
+        return stats.error_rate() <= self.max_error_rate and (p95 is None or p95 <= route.latency_slo)
+
+    def record_tool_use(self, channel_id: int):
+        self.tool_use[channel_id] = time.monotonic()
+        self.tool_use.move_to_end(channel_id)
+        while len(self.tool_use) > MAX_TRACKED_CHANNELS:
+            self.tool_use.popitem(last=False)
+
+    def is_tool_heavy(self, channel_id: int) -> bool:
+        used_at = self.tool_use.get(channel_id)
+        return used_at is not None and time.monotonic() - used_at < TOOL_HEAVY_SECONDS
+
+    def choose(self, tokens: int, tools_available: bool, channel_id: Optional[int] = None) -> ModelRoute:
+        # a channel that has been calling tools is expected to keep calling them, anywhere else
+        # a model without tools will do, and the request goes out without any
+        tool_heavy = channel_id is not None and self.is_tool_heavy(channel_id)
+        needs_tools = tools_available and tool_heavy
+
+        candidates : List[ModelRoute] = [
+            r for r in self.routes
+            if r.max_context_tokens >= tokens and (r.supports_tools or not needs_tools)]
+        if not candidates:
+            # nothing is big enough, the largest context has the best chance
+            candidates = [max(self.routes, key=lambda r: r.max_context_tokens)]
+
+        heavy = tokens > self.quick_chat_tokens or tool_heavy
+        candidates.sort(key=lambda r: r.strength, reverse=heavy)
+
+        reason = "heavy" if heavy else "quick"
+        route = next((r for r in candidates if self.is_healthy(r)), None)
+        if route is None:
+            # everything is over its slo, take the one failing least
+            route = min(candidates, key=lambda r: self.stats_for(r.model).error_rate())
+            reason = "degraded"
+        elif route is not candidates[0]:
+            logging.info(f"{self.name} router skipped {candidates[0].model}, it is outside its slo.")
+
+        Metrics.get_sink().increment("model_routes_total", provider=self.name, model=route.model, route=reason)
+        return route
+
+    @contextmanager
+    def track(self, model: str) -> Iterator[None]:
+        started = time.monotonic()
+        try:
+            yield
+        except asyncio.CancelledError:
+            # a cancelled hedge or request says nothing about the model
+            raise
+        except Exception:
+            self.stats_for(model).record(time.monotonic() - started, succeeded=False)
+            raise
+        self.stats_for(model).record(time.monotonic() - started, succeeded=True)
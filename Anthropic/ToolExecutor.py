@@ -0,0 +1,105 @@
+from dataclasses import dataclass, field
+import asyncio
+import functools
+import json
+import logging
+import multiprocessing
+import multiprocessing.pool
+import os
+from typing import Any, Callable, List
+
+import Metrics
+from RequestContext import RequestContext
+from tools.toolbase import ToolBase
+
+TOOL_TIMEOUT_SECONDS = 120.0
+MAX_PROCESS_WORKERS = max(1, min(4, (os.cpu_count() or 1) - 1))
+
+def run_in_process(tool: ToolBase, arguments: str) -> str:
+    # runs in a worker process: the tool comes over pickled, gets a loop and a context of its own,
+    # and only its json result goes back, anything it tries to attach stays behind
+    result = asyncio.run(tool.get_tool_result(arguments, RequestContext()))
+    json.loads(result)
+    return result
+
+@dataclass
+class ToolExecutor:
+    default_timeout : float = TOOL_TIMEOUT_SECONDS
+    max_workers : int = MAX_PROCESS_WORKERS
+
+    # each worker is a pool of one process running one call at a time, so a call that overruns
+    # can be killed along with its worker without touching anyone else's
+    idle : List[multiprocessing.pool.Pool] = field(default_factory=list)
+    slots : asyncio.Semaphore = field(init=False)
+
+    def __post_init__(self):
+        self.slots = asyncio.Semaphore(self.max_workers)
+
+    def timeout_for(self, tool: ToolBase) -> float:
+        return tool.timeout if tool.timeout is not None else self.default_timeout
+
+    def get_worker(self) -> multiprocessing.pool.Pool:
+        if self.idle:
+            return self.idle.pop()
+        # spawned rather than forked, the parent has an event loop and worker threads
+        return multiprocessing.get_context("spawn").Pool(processes=1)
+
+    async def run_in_pool(self, tool: ToolBase, arguments: str) -> str:
+        async with self.slots:
+            worker = self.get_worker()
+            loop = asyncio.get_running_loop()
+            future : "asyncio.Future[str]" = loop.create_future()
+
+            def settle(set_outcome: Callable[[Any], None], outcome: Any):
+                # a call that has been given up on is left unsettled
+                if not future.done():
+                    set_outcome(outcome)
+
+            # the callbacks run on the pool's result thread, the future is only touched on the loop
+            worker.apply_async(
+                run_in_process,
+                (tool, arguments),
+                callback=lambda result: loop.call_soon_threadsafe(settle, future.set_result, result),
+                error_callback=lambda e: loop.call_soon_threadsafe(settle, future.set_exception, e))
+
+            try:
+                result = await future
+            except asyncio.CancelledError:
+                # a worker can't be interrupted, the one running this call is killed and the next call gets a fresh one;
+                # terminate joins the pool's threads, so it happens off the loop
+                loop.run_in_executor(None, worker.terminate)
+                raise
+            except BaseException:
+                self.idle.append(worker)
+                raise
+
+            self.idle.append(worker)
+            return result
+
+    async def run(
+            self,
+            tool: ToolBase,
+            tool_name: str,
+            arguments: str,
+            context: RequestContext,
+            **attributes: Any) -> str:
+        cpu_bound = tool.is_cpu_bound(arguments)
+        call = functools.partial(self.run_in_pool, tool, arguments) if cpu_bound else None
+
+        with Metrics.span("tool", tool=tool_name, cpu_bound=cpu_bound, **attributes):
+            # waiting for capacity the tool shares with every other request doesn't count against its own deadline
+            await tool.reserve(arguments, context)
+            try:
+                # cancelling the request, or running out of time, cancels the tool with it,
+                # and a call in a worker process takes that worker down with it
+                return await asyncio.wait_for(tool.run(arguments, context, call), timeout=self.timeout_for(tool))
+            except asyncio.TimeoutError:
+                if cpu_bound:
+                    logging.warning(f"Killed the worker process running {tool_name}, it overran its deadline.")
+                raise
+
+    def shutdown(self):
+        while self.idle:
+            worker = self.idle.pop()
+            worker.close()
+            worker.join()
@@ -0,0 +1,74 @@
+from dataclasses import dataclass, field
+import copy
+import hashlib
+import json
+import logging
+import time
+from types import MappingProxyType
+from typing import List, Mapping, Optional, Tuple
+
+from anthropic.types import ToolParam
+
+from config import CONFIG
+from tools.toolbase import ToolBase
+from ToolLoader import ToolSource, load_tools
+
+def get_tool_name(tool: ToolBase) -> str:
+    return tool.parameter["name"]
+
+# everything the api calls need for one permission tier, computed once at startup
+@dataclass(frozen=True)
+class ToolTier:
+    tools : Tuple[ToolBase, ...]
+    by_name : Mapping[str, ToolBase]
+    parameters : Tuple[ToolParam, ...]
+    schema_json : str
+    schema_hash : str
+
+    @staticmethod
+    def build(tools: List[ToolBase]) -> "ToolTier":
+        by_name = { get_tool_name(t): t for t in tools }
+        if len(by_name) != len(tools):
+            raise ValueError("Tool names must be unique")
+
+        # private copies, so the payload sent to the provider is byte-identical on every request
+        parameters = tuple(copy.deepcopy(t.parameter) for t in tools)
+
+        # a breakpoint on the last tool caches the whole tools block
+        if parameters:
+            parameters[-1]["cache_control"] = {"type": "ephemeral"}
+        schema_json = json.dumps(parameters, sort_keys=True, separators=(",", ":"))
+
+        return ToolTier(
+            tools=tuple(tools),
+            by_name=MappingProxyType(by_name),
+            parameters=parameters,
+            schema_json=schema_json,
+            schema_hash=hashlib.sha256(schema_json.encode()).hexdigest())
+
+    def get(self, name: str) -> Optional[ToolBase]:
+        return self.by_name.get(name)
+
+@dataclass
+class ToolRegistry:
+    standard_tools : List[ToolSource]
+    admin_tools : List[ToolSource]
+
+    # tiers are built, and lazy tools imported, on the first request rather than at startup
+    standard : Optional[ToolTier] = field(default=None, init=False)
+    admin : Optional[ToolTier] = field(default=None, init=False)
+
+    def load(self):
+        started = time.perf_counter()
+
+        standard_tools = load_tools(self.standard_tools)
+        self.standard = ToolTier.build(standard_tools)
+        self.admin = ToolTier.build(standard_tools + load_tools(self.admin_tools))
+
+        logging.info(f"Registered {len(self.standard.tools)} standard tools ({self.standard.schema_hash[:12]}) and {len(self.admin.tools)} admin tools ({self.admin.schema_hash[:12]}) in {(time.perf_counter() - started) * 1000:.1f}ms.")
+
+    def tier_for(self, user_id: int) -> ToolTier:
+        if self.standard is None or self.admin is None:
+            self.load()
+        assert self.standard is not None and self.admin is not None
+        return self.admin if user_id == CONFIG.admin_user_id else self.standard
@@ -0,0 +1,189 @@
+from collections import OrderedDict
+from dataclasses import dataclass, field
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+import Metrics
+
+TOOL_CACHE_DIR = os.path.join(".cache", "tool_results")
+MAX_CACHED_RESULTS = 1_000
+# results bigger than this aren't worth keeping around, they are usually one-off dumps
+MAX_CACHED_RESULT_LENGTH = 64 * 1024
+
+# how often the running hit rate is written to the log
+LOG_EVERY_LOOKUPS = 50
+
+@dataclass(frozen=True)
+class ToolCachePolicy:
+    # seconds a result stays valid, zero means the tool is never cached
+    ttl : float = 0.0
+    # also keep results on disk so they survive a restart
+    disk : bool = False
+    # results are only shared within the channel that asked for them
+    per_channel : bool = False
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0
+
+# only tools whose result depends on nothing but their arguments should opt in:
+# anything random, time sensitive or with side effects (like attaching files) keeps this
+NEVER_CACHE = ToolCachePolicy()
+
+@dataclass
+class ToolResultCache:
+    directory : str = TOOL_CACHE_DIR
+    max_entries : int = MAX_CACHED_RESULTS
+
+    entries : "OrderedDict[str, Tuple[float, str]]" = field(default_factory=OrderedDict)
+    in_flight : Dict[str, "asyncio.Task[str]"] = field(default_factory=dict)
+    # callers still waiting on each shared execution
+    waiters : Dict["asyncio.Task[str]", int] = field(default_factory=dict)
+
+    hits : int = 0
+    disk_hits : int = 0
+    coalesced : int = 0
+    misses : int = 0
+
+    @staticmethod
+    def canonical_arguments(arguments: str) -> str:
+        # the same call can arrive with keys in any order and any whitespace
+        try:
+            return json.dumps(json.loads(arguments), sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+        except ValueError:
+            return arguments.strip()
+
+    def key(self, tool_name: str, arguments: str, scope: Optional[int] = None) -> str:
+        raw = f"{tool_name}\n{scope if scope is not None else ''}\n{self.canonical_arguments(arguments)}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def read(self, key: str) -> Optional[Tuple[float, str]]:
+        try:
+            with open(self.path(key), "r", encoding="utf-8") as f:
+                entry = json.load(f)
+            return entry["expires_at"], entry["result"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def write(self, key: str, expires_at: float, result: str):
+        os.makedirs(self.directory, exist_ok=True)
+        # write then rename, so a crash never leaves a torn entry behind
+        temp_path = self.path(key) + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump({ "expires_at": expires_at, "result": result }, f)
+        os.replace(temp_path, self.path(key))
+
+    def get_memory(self, key: str) -> Optional[str]:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.time():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    def put_memory(self, key: str, expires_at: float, result: str):
+        self.entries[key] = (expires_at, result)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def record(self, tool_name: str, outcome: str):
+        Metrics.get_sink().increment("tool_cache_total", tool=tool_name, outcome=outcome)
+
+        lookups = self.hits + self.disk_hits + self.coalesced + self.misses
+        if lookups % LOG_EVERY_LOOKUPS == 0:
+            logging.info(f"Tool result cache: {self.hit_rate:.0%} hit rate over {lookups} lookups ({self.hits} memory, {self.disk_hits} disk, {self.coalesced} coalesced, {self.misses} misses), {len(self.entries)} entries.")
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.disk_hits + self.coalesced + self.misses
+        return (lookups - self.misses) / lookups if lookups else 0.0
+
+    async def get_or_run(
+            self,
+            tool_name: str,
+            arguments: str,
+            policy: ToolCachePolicy,
+            run: Callable[[], Awaitable[str]],
+            scope: Optional[int] = None) -> str:
+        key = self.key(tool_name, arguments, scope if policy.per_channel else None)
+
+        result = self.get_memory(key)
+        if result is not None:
+            self.hits += 1
+            self.record(tool_name, "hit")
+            return result
+
+        # identical calls running at the same time share one execution
+        task = self.in_flight.get(key)
+        if task is not None:
+            self.coalesced += 1
+            self.record(tool_name, "coalesced")
+            return await self.join(key, task)
+
+        task = asyncio.ensure_future(self.load(tool_name, key, policy, run))
+        self.in_flight[key] = task
+
+        def done(_: "asyncio.Task[str]"):
+            # a cancelled execution may already have made way for a new one under the same key
+            if self.in_flight.get(key) is task:
+                del self.in_flight[key]
+
+        task.add_done_callback(done)
+
+        return await self.join(key, task)
+
+    async def join(self, key: str, task: "asyncio.Task[str]") -> str:
+        # a caller that times out or is cancelled only leaves the shared execution, the others keep waiting;
+        # once the last one has left it is cancelled, rather than left running for later calls to attach to
+        self.waiters[task] = self.waiters.get(task, 0) + 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            self.waiters[task] -= 1
+            if self.waiters[task] == 0:
+                del self.waiters[task]
+                if not task.done():
+                    if self.in_flight.get(key) is task:
+                        del self.in_flight[key]
+                    task.cancel()
+
+    async def load(self, tool_name: str, key: str, policy: ToolCachePolicy, run: Callable[[], Awaitable[str]]) -> str:
+        if policy.disk:
+            entry = await asyncio.to_thread(self.read, key)
+            if entry is not None and entry[0] >= time.time():
+                self.put_memory(key, *entry)
+                self.disk_hits += 1
+                self.record(tool_name, "disk_hit")
+                return entry[1]
+
+        self.misses += 1
+        self.record(tool_name, "miss")
+
+        # errors propagate to every waiter and are never cached
+        result = await run()
+        if len(result) > MAX_CACHED_RESULT_LENGTH:
+            return result
+
+        expires_at = time.time() + policy.ttl
+        self.put_memory(key, expires_at, result)
+
+        if policy.disk:
+            try:
+                await asyncio.to_thread(self.write, key, expires_at, result)
+            except OSError as e:
+                logging.exception(e)
+
+        return result
+
+TOOL_RESULT_CACHE = ToolResultCache()
@@ -1,14 +1,101 @@
+import asyncio
 import datetime
 import json
-import requests
+import logging
+import os
+import time
+import httpx
 from dataclasses import dataclass, field
-from typing import Dict, Any
+from typing import Dict, Any, Optional, Tuple
 from anthropic.types import ToolParam
 from config import NASA_API_KEY
 from tools.toolbase import ToolBase
 
 NASA_APOD_URL = "https://api.nasa.gov/planetary/apod"
 
+APOD_CACHE_DIR = os.path.join(".cache", "nasa_apod")
+# past entries never change, today's entry can still be published or corrected
+APOD_TODAY_TTL_SECONDS = 15 * 60
+
+APOD_MAX_CONNECTIONS = 10
+
+@dataclass
+class ApodCache:
+    directory: str = APOD_CACHE_DIR
+    today_ttl: float = APOD_TODAY_TTL_SECONDS
+
+    entries: Dict[str, Tuple[float, str]] = field(default_factory=dict)
+    in_flight: Dict[str, "asyncio.Task[str]"] = field(default_factory=dict)
+    http_client: Optional[httpx.AsyncClient] = None
+
+    def is_fresh(self, date: str, fetched_at: float) -> bool:
+        if date < datetime.date.today().strftime("%Y-%m-%d"):
+            return True
+        return time.time() - fetched_at < self.today_ttl
+
+    def path(self, date: str) -> str:
+        return os.path.join(self.directory, f"{date}.json")
+
+    def read(self, date: str) -> Optional[Tuple[float, str]]:
+        try:
+            with open(self.path(date), "r", encoding="utf-8") as f:
+                entry = json.load(f)
+            return entry["fetched_at"], entry["payload"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def write(self, date: str, fetched_at: float, payload: str):
+        os.makedirs(self.directory, exist_ok=True)
+        # write then rename, so a crash never leaves a torn entry behind
+        temp_path = self.path(date) + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump({ "fetched_at": fetched_at, "payload": payload }, f)
+        os.replace(temp_path, self.path(date))
+
+    def get_http_client(self) -> httpx.AsyncClient:
+        if self.http_client is None:
+            self.http_client = httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=APOD_MAX_CONNECTIONS),
+                timeout=httpx.Timeout(30.0))
+        return self.http_client
+
+    async def get(self, date: str) -> str:
+        entry = self.entries.get(date)
+        if entry is not None and self.is_fresh(date, entry[0]):
+            return entry[1]
+
+        # concurrent requests for the same date share one fetch
+        task = self.in_flight.get(date)
+        if task is None:
+            task = asyncio.ensure_future(self.load(date))
+            self.in_flight[date] = task
+            task.add_done_callback(lambda _: self.in_flight.pop(date, None))
+
+        return await asyncio.shield(task)
+
+    async def load(self, date: str) -> str:
+        entry = await asyncio.to_thread(self.read, date)
+        if entry is not None and self.is_fresh(date, entry[0]):
+            self.entries[date] = entry
+            return entry[1]
+
+        logging.info(f"Fetching NASA APOD for {date}...")
+
+        response = await self.get_http_client().get(NASA_APOD_URL, params={ 'api_key': NASA_API_KEY, 'date': date })
+        response.raise_for_status()
+        payload = json.dumps(response.json())
+
+        fetched_at = time.time()
+        self.entries[date] = (fetched_at, payload)
+        try:
+            await asyncio.to_thread(self.write, date, fetched_at, payload)
+        except OSError as e:
+            logging.exception(e)
+
+        return payload
+
+APOD_CACHE = ApodCache()
+
 @dataclass 
 class NasaApodTool(ToolBase):
     emoji: str = "🚀"
@@ -37,24 +124,15 @@ class NasaApodTool(ToolBase):
     async def get_tool_result(self, arguments: str, message_handler) -> str:
         args = json.loads(arguments)
 
-        # Initialize params with api_key and thumbs as they can always be included
-        params = {'api_key': NASA_API_KEY}
-            
         if "date" in args:    
-            params['date'] = args["date"]
+            date = args["date"]
         else:
-            params['date'] = datetime.date.today().strftime("%Y-%m-%d")
+            date = datetime.date.today().strftime("%Y-%m-%d")
 
-        # ensure date is in YYYY-MM-DD format by trying to parse to a date
+        # ensure date is in YYYY-MM-DD format by trying to parse to a date, normalized so it is a stable cache key
         try:
-            datetime.datetime.strptime(params['date'], '%Y-%m-%d')
+            date = datetime.datetime.strptime(date, '%Y-%m-%d').strftime('%Y-%m-%d')
         except ValueError:
             raise ValueError("Date must be in YYYY-MM-DD format")    
             
-        # Make the GET request with the parameters
-        response = requests.get(NASA_APOD_URL, params=params)
-        if response.status_code == 200:
-            return json.dumps(response.json())
-        else:
-            response.raise_for_status()
-            return ""
\ No newline at end of file
+        return await APOD_CACHE.get(date)
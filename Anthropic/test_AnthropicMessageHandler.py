@@ -0,0 +1,53 @@
+import asyncio
+import os
+
+import pytest
+
+# the handler needs the provider sdk and the tools package, as deployed
+pytest.importorskip("anthropic")
+pytest.importorskip("tools.toolbase")
+
+from BenchmarkFakes import FakeCounters, FakeLatency, FakeAnthropicClient, FakeToolScript, make_reply_chain
+from ConversationStore import ConversationStore
+from AnthropicMessageHandler import AnthropicMessageHandler
+from ResponseCache import ResponseCache
+
+LATENCY = FakeLatency(fetch=0, reply=0, edit=0, reaction=0, first_token=0, per_token=0, tokens=4, tool=0)
+
+def test_forget_drops_a_message_from_every_cache(tmp_path):
+    async def run():
+        handler = AnthropicMessageHandler(
+            standard_tools=[],
+            admin_tools=[],
+            temperature=0,
+            router=None,
+            conversation_store=ConversationStore(path=os.path.join(str(tmp_path), "conversations.sqlite3")),
+            response_cache=ResponseCache(),
+            anthropic_client=FakeAnthropicClient(LATENCY, FakeToolScript()))  # type: ignore
+        message = make_reply_chain(3, user_id=10, channel_id=0, latency=LATENCY, counters=FakeCounters())
+        root = message.reference.resolved.reference.resolved  # type: ignore
+
+        await handler.on_message(message)
+        handler.context_window.summaries[message.id] = (frozenset({root.id}), "summary")
+        handler.attachment_cache.put((root.id, None, ((1, 1),)), { "role": "user", "content": "image" })
+        assert handler.conversation_store is not None and handler.response_cache is not None
+        await handler.conversation_store.flush()
+
+        assert root.id in handler.conversation_cache.records
+        assert root.id in handler.context_window.token_counts
+        assert await handler.conversation_store.get_chain(message.id, 10) is not None
+        assert len(handler.response_cache.entries) == 1
+
+        handler.on_raw_message_delete(type("Payload", (), { "message_id": root.id })())  # type: ignore
+        await handler.conversation_store.flush()
+
+        assert root.id not in handler.conversation_cache.records
+        assert root.id not in handler.context_window.token_counts
+        assert not handler.context_window.summaries
+        assert not handler.attachment_cache.entries and handler.attachment_cache.total_bytes == 0
+        assert await handler.conversation_store.get_chain(message.id, 10) is None
+        assert not handler.response_cache.entries
+
+        await handler.conversation_store.close()
+
+    asyncio.run(run())
@@ -0,0 +1,120 @@
+import asyncio
+import re
+from typing import List
+
+from DiscordDelivery import open_fence
+from DiscordStreamWriter import DiscordStreamWriter
+
+class StubMessage:
+    def __init__(self, sent: List["StubMessage"], content: str = ""):
+        self.sent = sent
+        self.content = content
+
+    async def edit(self, content: str) -> "StubMessage":
+        self.content = content
+        return self
+
+    async def reply(self, content: str) -> "StubMessage":
+        message = StubMessage(self.sent, content)
+        self.sent.append(message)
+        return message
+
+async def stream(deltas: List[str], max_length: int) -> List[str]:
+    sent : List[StubMessage] = []
+    first = StubMessage(sent, "🤔")
+    sent.append(first)
+
+    writer = DiscordStreamWriter(first, edit_interval=0, max_length=max_length) # type: ignore
+    for delta in deltas:
+        await writer.write(delta)
+    await writer.close()
+
+    return [m.content for m in sent]
+
+def test_fenced_block_streamed_across_the_limit():
+    lines = [f"x = {i}\n" for i in range(40)]
+    contents = asyncio.run(stream(["Here you go:\n```py\n", *lines, "```\nDone."], max_length=100))
+
+    assert len(contents) > 2
+    for content in contents:
+        assert len(content) <= 100
+        # every message closes the block it opens, with nothing after the closing fence
+        assert open_fence(content) is None
+    for content in contents[:-1]:
+        assert content.endswith("```")
+    for content in contents[1:-1]:
+        assert content.startswith("```py\n")
+
+    assert contents[0].startswith("Here you go:\n```py\n")
+    assert contents[-1].endswith("```\nDone.")
+
+    # every line of code arrives exactly once, in order
+    code = re.findall(r"x = \d+", "\n".join(contents))
+    assert code == [line.strip() for line in lines]
+
+def test_fence_with_text_streamed_across_the_limit():
+    deltas = ["```", *("a" * 10 for _ in range(20)), "\n```\n"]
+    contents = asyncio.run(stream(deltas, max_length=40))
+
+    assert "".join(contents).count("a") == 200
+    for content in contents:
+        assert len(content) <= 40
+
+def test_finished_messages_are_handed_on_once():
+    async def run() -> List[str]:
+        handed : List[str] = []
+        sent : List[StubMessage] = []
+        first = StubMessage(sent, "🤔")
+        sent.append(first)
+
+        async def on_message(message: StubMessage):
+            handed.append(message.content)
+
+        writer = DiscordStreamWriter(first, edit_interval=0, max_length=100, on_message=on_message) # type: ignore
+        for i in range(40):
+            await writer.write(f"word{i} ")
+            await asyncio.sleep(0)
+        await writer.close()
+
+        assert handed == [m.content for m in sent]
+        return handed
+
+    assert len(asyncio.run(run())) > 1
+
+def test_error_replaces_a_throttled_partial_reply():
+    async def run() -> List[StubMessage]:
+        sent : List[StubMessage] = []
+        first = StubMessage(sent, "🤔")
+        sent.append(first)
+
+        writer = DiscordStreamWriter(first, edit_interval=0.05) # type: ignore
+        await writer.write("partial")
+        await asyncio.sleep(0)
+        # this edit waits out the throttle, it must never land after the error
+        await writer.write(" reply")
+        await asyncio.sleep(0)
+
+        assert await writer.fail("error") is first
+        await asyncio.sleep(0.1)
+        return sent
+
+    assert [m.content for m in asyncio.run(run())] == ["error"]
+
+def test_error_goes_to_the_message_being_written():
+    async def run() -> List[StubMessage]:
+        sent : List[StubMessage] = []
+        first = StubMessage(sent, "🤔")
+        sent.append(first)
+
+        writer = DiscordStreamWriter(first, edit_interval=0, max_length=100) # type: ignore
+        for i in range(30):
+            await writer.write(f"word{i} ")
+            await asyncio.sleep(0)
+
+        assert await writer.fail("error") is sent[-1]
+        return sent
+
+    sent = asyncio.run(run())
+    assert len(sent) > 1
+    assert sent[0].content.startswith("word0 ")
+    assert sent[-1].content == "error"
@@ -0,0 +1,72 @@
+from dataclasses import dataclass, field
+import asyncio
+import json
+import os
+import time
+from typing import Any, ClassVar, Dict
+
+import pytest
+
+# the executor needs the tools package and the provider sdk, as deployed
+pytest.importorskip("tools.toolbase")
+
+from RequestContext import RequestContext
+from ToolExecutor import ToolExecutor
+from tools.toolbase import ToolBase
+
+@dataclass
+class SleepTool(ToolBase):
+    emoji : str = "💤"
+    parameter : Dict[str, Any] = field(default_factory=dict)
+    cpu_bound : ClassVar[bool] = True
+
+    @staticmethod
+    def create_anthropic_tool_param():
+        return {}
+
+    async def get_tool_result(self, arguments: str, message_handler) -> str:
+        time.sleep(json.loads(arguments)["seconds"])
+        return json.dumps({ "pid": os.getpid() })
+
+@dataclass
+class QueuedTool(ToolBase):
+    emoji : str = "🎟️"
+    parameter : Dict[str, Any] = field(default_factory=dict)
+    timeout : ClassVar[float] = 0.1
+
+    @staticmethod
+    def create_anthropic_tool_param():
+        return {}
+
+    async def reserve(self, arguments: str, message_handler) -> None:
+        await asyncio.sleep(0.3)
+
+    async def get_tool_result(self, arguments: str, message_handler) -> str:
+        await asyncio.sleep(0.05)
+        return json.dumps({ "ok": True })
+
+def test_waiting_for_capacity_does_not_count_against_the_deadline():
+    executor = ToolExecutor()
+    result = asyncio.run(executor.run(QueuedTool(), "queued", "{}", RequestContext()))
+    assert json.loads(result) == { "ok": True }
+
+def test_an_overrunning_call_only_takes_its_own_worker_down():
+    executor = ToolExecutor(default_timeout=5.0, max_workers=2)
+    tool = SleepTool()
+
+    async def run():
+        stuck, quick = await asyncio.gather(
+            executor.run(tool, "sleep", json.dumps({ "seconds": 60 }), RequestContext()),
+            executor.run(tool, "sleep", json.dumps({ "seconds": 0.1 }), RequestContext()),
+            return_exceptions=True)
+        assert isinstance(stuck, asyncio.TimeoutError)
+        assert isinstance(quick, str)
+
+        # the worker that finished is reused, the one that overran is gone
+        again = await executor.run(tool, "sleep", json.dumps({ "seconds": 0.1 }), RequestContext())
+        assert json.loads(again)["pid"] == json.loads(quick)["pid"]
+
+    try:
+        asyncio.run(run())
+    finally:
+        executor.shutdown()
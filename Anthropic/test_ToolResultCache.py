@@ -0,0 +1,55 @@
+import asyncio
+
+from ToolResultCache import ToolCachePolicy, ToolResultCache
+
+POLICY = ToolCachePolicy(ttl=60)
+
+def test_shared_execution_is_cancelled_when_every_caller_times_out():
+    cache = ToolResultCache()
+    started = 0
+    cancelled = 0
+
+    async def hang() -> str:
+        nonlocal started, cancelled
+        started += 1
+        try:
+            await asyncio.sleep(60)
+        except asyncio.CancelledError:
+            cancelled += 1
+            raise
+        return "never"
+
+    async def run():
+        calls = [asyncio.wait_for(cache.get_or_run("tool", "{}", POLICY, hang), timeout=0.05) for _ in range(3)]
+        results = await asyncio.gather(*calls, return_exceptions=True)
+        assert all(isinstance(r, asyncio.TimeoutError) for r in results)
+        await asyncio.sleep(0)
+
+        assert not cache.in_flight
+        assert not cache.waiters
+
+        # a later identical call runs again instead of attaching to the abandoned one
+        async def quick() -> str:
+            return "done"
+        assert await asyncio.wait_for(cache.get_or_run("tool", "{}", POLICY, quick), timeout=1) == "done"
+
+    asyncio.run(run())
+    assert started == 1
+    assert cancelled == 1
+
+def test_shared_execution_outlives_a_caller_that_leaves_early():
+    cache = ToolResultCache()
+
+    async def slow() -> str:
+        await asyncio.sleep(0.1)
+        return "result"
+
+    async def run():
+        impatient = asyncio.wait_for(cache.get_or_run("tool", "{}", POLICY, slow), timeout=0.01)
+        patient = cache.get_or_run("tool", "{}", POLICY, slow)
+        results = await asyncio.gather(impatient, patient, return_exceptions=True)
+        assert isinstance(results[0], asyncio.TimeoutError)
+        assert results[1] == "result"
+
+    asyncio.run(run())
+    assert cache.coalesced == 1
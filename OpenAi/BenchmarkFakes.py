@@ -0,0 +1,243 @@
+from dataclasses import dataclass, field
+import asyncio
+import itertools
+import json
+import time
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+import discord
+import openai.types.chat as chat
+import openai.types.shared_params as shared_params
+
+from tools.toolbase import ToolBase
+
+# in-process stand-ins for discord and the openai api, so the handler can be driven with no network at all
+
+MESSAGE_IDS = itertools.count(1_000_000)
+
+@dataclass
+class FakeLatency:
+    # discord rest calls
+    fetch : float = 0.05
+    reply : float = 0.08
+    edit : float = 0.05
+    reaction : float = 0.03
+    # model
+    first_token : float = 0.4
+    per_token : float = 0.005
+    tokens : int = 60
+    # tools
+    tool : float = 0.2
+
+@dataclass
+class FakeUser:
+    id : int
+    name : str = "user"
+    bot : bool = False
+
+    @property
+    def display_name(self) -> str:
+        return self.name
+
+    @property
+    def mention(self) -> str:
+        return f"<@{self.id}>"
+
+@dataclass
+class FakeChannel:
+    id : int
+
+@dataclass
+class FakeReference:
+    message_id : int
+    resolved : Optional["FakeMessage"] = None
+
+@dataclass
+class FakeCounters:
+    fetches : int = 0
+    replies : int = 0
+    edits : int = 0
+    reactions : int = 0
+    first_content_at : Optional[float] = None
+
+    def saw_content(self, content: Optional[str]):
+        # the placeholder doesn't count, the first real text the user can read does
+        if content and content != "🤔" and self.first_content_at is None:
+            self.first_content_at = time.perf_counter()
+
+class FakeMessage(discord.Message):
+    # discord.Message has no usable constructor outside the gateway, so the slots it relies on are filled in by hand
+    def __init__(
+            self,
+            content: str,
+            author: FakeUser,
+            channel: FakeChannel,
+            latency: FakeLatency,
+            counters: FakeCounters,
+            parent: Optional["FakeMessage"] = None):
+        self.id = next(MESSAGE_IDS)
+        self.content = content
+        self.author = author  # type: ignore
+        self.channel = channel  # type: ignore
+        self.attachments = []
+        self.embeds = []
+        self.reference = FakeReference(parent.id, parent) if parent is not None else None  # type: ignore
+        self._edited_timestamp = None
+        self.latency = latency
+        self.counters = counters
+
+    async def fetch(self) -> "FakeMessage":
+        self.counters.fetches += 1
+        await asyncio.sleep(self.latency.fetch)
+        return self
+
+    async def reply(self, content: Optional[str] = None, **kwargs) -> "FakeMessage":
+        self.counters.replies += 1
+        await asyncio.sleep(self.latency.reply)
+        self.counters.saw_content(content)
+        return FakeMessage(content or "", BOT_USER, self.channel, self.latency, self.counters, parent=self)
+
+    async def edit(self, content: Optional[str] = None, **kwargs) -> "FakeMessage":
+        self.counters.edits += 1
+        await asyncio.sleep(self.latency.edit)
+        self.counters.saw_content(content)
+        if content is not None:
+            self.content = content
+        return self
+
+    async def add_files(self, *files: discord.File) -> "FakeMessage":
+        return await self.edit()
+
+    async def add_reaction(self, emoji: Any):
+        self.counters.reactions += 1
+        await asyncio.sleep(self.latency.reaction)
+
+BOT_USER = FakeUser(id=1, name="bot", bot=True)
+
+def make_reply_chain(
+        depth: int,
+        user_id: int,
+        channel_id: int,
+        latency: FakeLatency,
+        counters: FakeCounters,
+        parent: Optional[FakeMessage] = None) -> FakeMessage:
+    # the chain ends on the user's turn, and continues from parent when one is given
+    user = FakeUser(id=user_id)
+    channel = FakeChannel(id=channel_id)
+
+    message : Optional[FakeMessage] = parent
+    for i in range(depth):
+        author = user if (depth - 1 - i) % 2 == 0 else BOT_USER
+        message = FakeMessage(f"message {i} of a conversation about benchmarks " * 4, author, channel, latency, counters, parent=message)
+
+    assert message is not None
+    return message
+
+def make_thread(depth: int, user_id: int, channel_id: int, latency: FakeLatency) -> FakeMessage:
+    # history that many messages reply to, ending on the bot's turn so each of them is the user's next one
+    chain = make_reply_chain(depth + 1, user_id, channel_id, latency, FakeCounters())
+    assert chain.reference is not None and chain.reference.resolved is not None
+    return chain.reference.resolved
+
+@dataclass
+class FakeToolScript:
+    # tool names the model asks for on each round, the reply after the last round is plain text
+    rounds : List[List[str]] = field(default_factory=list)
+
+    def tool_calls_for(self, messages: List[Any]) -> List[str]:
+        # count the tool rounds since the last user message, so the script needs no state per conversation
+        round = 0
+        for m in reversed(messages):
+            role = m.get("role") if isinstance(m, dict) else getattr(m, "role", None)
+            content = m.get("content") if isinstance(m, dict) else getattr(m, "content", None)
+            is_tool_result = isinstance(content, list) and any(isinstance(b, dict) and b.get("type") == "tool_result" for b in content)
+            if role == "user" and not is_tool_result:
+                break
+            if role == "assistant":
+                round += 1
+        return self.rounds[round] if round < len(self.rounds) else []
+
+class FakeCompletions:
+    def __init__(self, latency: FakeLatency, script: FakeToolScript):
+        self.latency = latency
+        self.script = script
+        self.calls = 0
+
+    def build_message(self, messages: List[Any]) -> Dict[str, Any]:
+        # the script is followed whether or not tools were offered: the handler sends its first request
+        # without them, and only ever offers them again once the model has asked for one
+        tool_names = self.script.tool_calls_for(messages)
+        if tool_names:
+            return {
+                "role": "assistant",
+                "content": None,
+                "tool_calls": [
+                    { "id": f"call_{self.calls}_{i}", "type": "function", "function": { "name": name, "arguments": "{}" } }
+                    for i, name in enumerate(tool_names)] }
+        return { "role": "assistant", "content": " ".join(["token"] * self.latency.tokens) }
+
+    async def create(self, messages: List[Any], stream: bool = False, tools: Any = None, **kwargs) -> Any:
+        self.calls += 1
+        message = self.build_message(messages)
+
+        if stream:
+            return self.stream(message)
+
+        await asyncio.sleep(self.latency.first_token + self.latency.per_token * self.latency.tokens)
+        return chat.ChatCompletion.model_validate({
+            "id": f"chatcmpl-{self.calls}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": kwargs.get("model", "fake"),
+            "choices": [{ "index": 0, "finish_reason": "stop", "message": message }],
+            "usage": { "prompt_tokens": 100, "completion_tokens": self.latency.tokens, "total_tokens": 100 + self.latency.tokens } })
+
+    async def stream(self, message: Dict[str, Any]) -> AsyncIterator[chat.ChatCompletionChunk]:
+        await asyncio.sleep(self.latency.first_token)
+
+        deltas : List[Dict[str, Any]] = []
+        if message.get("tool_calls"):
+            deltas.append({ "tool_calls": [{ "index": i, **t } for i, t in enumerate(message["tool_calls"])] })
+        else:
+            deltas.extend({ "content": "token " } for _ in range(self.latency.tokens))
+
+        for delta in deltas:
+            await asyncio.sleep(self.latency.per_token)
+            yield chat.ChatCompletionChunk.model_validate({
+                "id": f"chatcmpl-{self.calls}",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": "fake",
+                "choices": [{ "index": 0, "delta": delta, "finish_reason": None }] })
+
+@dataclass
+class FakeChat:
+    completions : FakeCompletions
+
+class FakeOpenAiClient:
+    def __init__(self, latency: FakeLatency, script: FakeToolScript):
+        self.chat = FakeChat(FakeCompletions(latency, script))
+
+@dataclass
+class FakeTool(ToolBase):
+    emoji : str = "🧪"
+    name : str = "fake_tool"
+    latency : float = 0.2
+
+    @staticmethod
+    def create_chat_completion_tool_param():
+        return chat.ChatCompletionToolParam(
+            type="function",
+            function=shared_params.FunctionDefinition(
+                name="fake_tool",
+                description="A tool that only waits",
+                parameters=dict(type="object", properties={})))
+
+    parameter : chat.ChatCompletionToolParam = field(default_factory=create_chat_completion_tool_param)
+
+    def __post_init__(self):
+        self.parameter["function"]["name"] = self.name
+
+    async def get_tool_result(self, arguments: str, message_handler) -> str:
+        await asyncio.sleep(self.latency)
+        return json.dumps({ "result": "ok" })
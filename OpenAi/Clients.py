@@ -0,0 +1,12 @@
+import functools
+
+# sdk clients are built on first use rather than at import time, so a restarted process
+# that never talks to a provider never pays for its client, and every user shares one pool
+
+@functools.lru_cache(maxsize=None)
+def get_openai_client():
+    import openai
+
+    # defaults to os.environ.get("OPENAI_API_KEY")
+    # Resilience owns retries, the sdk's own would multiply with them
+    return openai.AsyncOpenAI(max_retries=0)
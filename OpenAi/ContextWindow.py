@@ -0,0 +1,208 @@
+from collections import OrderedDict
+from dataclasses import dataclass, field
+import json
+import logging
+from typing import Any, Awaitable, Callable, Dict, FrozenSet, List, Optional, Tuple
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+DEFAULT_CONTEXT_BUDGET = 32_000
+DEFAULT_SUMMARY_BUDGET = 1_000
+DEFAULT_TOKEN_ENCODING = "o200k_base"
+
+MAX_CACHED_COUNTS = 50_000
+MAX_CACHED_SUMMARIES = 1_000
+
+# rough costs used when the real tokenizer isn't around or can't see the content
+MESSAGE_OVERHEAD_TOKENS = 4
+IMAGE_TOKENS = 1_600
+CHARS_PER_TOKEN = 4
+
+# a conversation entry is the discord message id it came from (None for messages made up along the way) and its param
+ContextEntry = Tuple[Optional[int], Dict[str, Any]]
+Summarizer = Callable[[str], Awaitable[str]]
+
+@dataclass
+class ContextWindowResult:
+    messages : List[Dict[str, Any]]
+    total_tokens : int
+    kept_tokens : int
+    dropped_messages : int = 0
+    summarized : bool = False
+
+    @property
+    def saved_tokens(self) -> int:
+        return self.total_tokens - self.kept_tokens
+
+@dataclass
+class ContextWindow:
+    budget : int = DEFAULT_CONTEXT_BUDGET
+    summarizer : Optional[Summarizer] = None
+    summary_budget : int = DEFAULT_SUMMARY_BUDGET
+    summary_role : str = "system"
+    encoding_name : str = DEFAULT_TOKEN_ENCODING
+
+    token_counts : "OrderedDict[int, int]" = field(default_factory=OrderedDict)
+    # keyed by the last message summarized, along with the ids of every message the summary covers
+    summaries : "OrderedDict[int, Tuple[FrozenSet[int], str]]" = field(default_factory=OrderedDict)
+    encoding : Any = field(default=None, init=False)
+
+    def __post_init__(self):
+        if tiktoken is not None:
+            self.encoding = tiktoken.get_encoding(self.encoding_name)
+
+    def count_text(self, text: str) -> int:
+        if self.encoding is not None:
+            return len(self.encoding.encode(text, disallowed_special=()))
+        return len(text) // CHARS_PER_TOKEN + 1
+
+    def count_block(self, block: Any) -> int:
+        if hasattr(block, "model_dump"):
+            block = block.model_dump(exclude_none=True)
+        if isinstance(block, str):
+            return self.count_text(block)
+        if not isinstance(block, dict):
+            return self.count_text(str(block))
+
+        if block.get("type") in ("image", "image_url"):
+            return IMAGE_TOKENS
+        if isinstance(block.get("text"), str):
+            return self.count_text(block["text"])
+        if block.get("type") == "tool_result":
+            content = block.get("content", "")
+            if isinstance(content, list):
+                return sum(self.count_block(b) for b in content)
+            return self.count_text(str(content))
+
+        return self.count_text(json.dumps(block, default=str))
+
+    def count_message(self, param: Dict[str, Any]) -> int:
+        tokens = MESSAGE_OVERHEAD_TOKENS
+
+        content = param.get("content")
+        if isinstance(content, str):
+            tokens += self.count_text(content)
+        elif content is not None:
+            tokens += sum(self.count_block(b) for b in content)
+
+        for tool_call in param.get("tool_calls") or []:
+            tokens += self.count_block(tool_call)
+
+        return tokens
+
+    def count(self, entry: ContextEntry) -> int:
+        message_id, param = entry
+        if message_id is None:
+            return self.count_message(param)
+
+        tokens = self.token_counts.get(message_id)
+        if tokens is None:
+            tokens = self.count_message(param)
+            self.token_counts[message_id] = tokens
+            while len(self.token_counts) > MAX_CACHED_COUNTS:
+                self.token_counts.popitem(last=False)
+        else:
+            self.token_counts.move_to_end(message_id)
+
+        return tokens
+
+    # an edited message is counted, and summarized, again the next time a conversation reaches it
+    def forget(self, message_id: int):
+        self.token_counts.pop(message_id, None)
+        stale = [key for key, (covered, _) in self.summaries.items() if message_id in covered]
+        for key in stale:
+            del self.summaries[key]
+
+    @staticmethod
+    def is_tool_result(param: Dict[str, Any]) -> bool:
+        if param.get("role") == "tool":
+            return True
+        content = param.get("content")
+        if isinstance(content, list):
+            return any(isinstance(b, dict) and b.get("type") == "tool_result" for b in content)
+        return False
+
+    def group(self, entries: List[ContextEntry]) -> List[List[ContextEntry]]:
+        # tool results always travel with the call that produced them
+        groups : List[List[ContextEntry]] = []
+        for entry in entries:
+            if groups and self.is_tool_result(entry[1]):
+                groups[-1].append(entry)
+            else:
+                groups.append([entry])
+        return groups
+
+    @staticmethod
+    def render_transcript(entries: List[ContextEntry]) -> str:
+        lines = []
+        for _, param in entries:
+            content = param.get("content")
+            if not isinstance(content, str):
+                content = " ".join(b["text"] for b in content or [] if isinstance(b, dict) and isinstance(b.get("text"), str))
+            if content:
+                lines.append(f'{param.get("role", "user")}: {content}')
+        return "\n".join(lines)
+
+    async def summarize(self, dropped: List[ContextEntry]) -> Optional[str]:
+        if self.summarizer is None:
+            return None
+
+        # the prefix ending at a given message never changes, so its summary can be reused every turn
+        key = dropped[-1][0]
+        if key is not None and key in self.summaries:
+            self.summaries.move_to_end(key)
+            return self.summaries[key][1]
+
+        try:
+            summary = await self.summarizer(self.render_transcript(dropped))
+        except Exception as e:
+            logging.exception(e)
+            return None
+
+        if key is not None:
+            self.summaries[key] = (frozenset(e[0] for e in dropped if e[0] is not None), summary)
+            while len(self.summaries) > MAX_CACHED_SUMMARIES:
+                self.summaries.popitem(last=False)
+
+        return summary
+
+    async def fit(self, entries: List[ContextEntry]) -> ContextWindowResult:
+        groups = self.group(entries)
+        group_tokens = [sum(self.count(e) for e in g) for g in groups]
+        total = sum(group_tokens)
+
+        if total <= self.budget:
+            return ContextWindowResult(messages=[p for _, p in entries], total_tokens=total, kept_tokens=total)
+
+        budget = self.budget - (self.summary_budget if self.summarizer is not None else 0)
+
+        # newest first, the latest group is always kept even if it is over budget on its own
+        kept = 0
+        start = len(groups)
+        while start > 0 and (start == len(groups) or kept + group_tokens[start - 1] <= budget):
+            start -= 1
+            kept += group_tokens[start]
+
+        # a trimmed conversation still has to open with a user turn
+        while start < len(groups) - 1 and groups[start][0][1].get("role") == "assistant":
+            kept -= group_tokens[start]
+            start += 1
+
+        dropped = [e for g in groups[:start] for e in g]
+        messages = [p for g in groups[start:] for _, p in g]
+
+        summary = await self.summarize(dropped) if dropped else None
+        if summary:
+            summary_message = { "role": self.summary_role, "content": f"Summary of the earlier conversation: {summary}" }
+            kept += self.count_message(summary_message)
+            messages.insert(0, summary_message)
+
+        return ContextWindowResult(
+            messages=messages,
+            total_tokens=total,
+            kept_tokens=kept,
+            dropped_messages=len(dropped),
+            summarized=summary is not None)
@@ -0,0 +1,146 @@
+from collections import OrderedDict
+from dataclasses import dataclass, field
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple, Union
+
+import discord
+
+DEFAULT_MAX_CACHED_MESSAGES = 10_000
+# converted messages can carry images, so the cache is bounded by size as well as count
+DEFAULT_MAX_CACHED_BYTES = 32 * 1024 * 1024
+DEFAULT_MAX_CHAIN_DEPTH = 100
+
+Converter = Callable[[discord.Message], Awaitable[Dict[str, Any]]]
+
+def estimate_size(value: Any) -> int:
+    # the text and any encoded image data dominate, everything else is a rounding error
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(estimate_size(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(estimate_size(v) for v in value)
+    return 8
+
+def parent_of(message: discord.Message) -> Optional[int]:
+    return message.reference.message_id if message.reference is not None else None
+
+# what the cache keeps of a message: its place in the reply chain and its converted param,
+# rather than the gateway object with everything hanging off it
+@dataclass(frozen=True, slots=True)
+class MessageRecord:
+    id: int
+    parent_id: Optional[int]
+    author_id: int
+    edited_at: Optional[float]
+    # (id, filename, size) of each attachment
+    attachments: Tuple[Tuple[int, str, int], ...]
+    # None until a conversation has needed the message converted
+    param: Optional[Dict[str, Any]]
+    size: int
+
+    @staticmethod
+    def from_message(message: discord.Message, param: Optional[Dict[str, Any]] = None) -> "MessageRecord":
+        return MessageRecord(
+            id=message.id,
+            parent_id=parent_of(message),
+            author_id=message.author.id,
+            edited_at=message.edited_at.timestamp() if message.edited_at is not None else None,
+            attachments=tuple((a.id, a.filename, a.size) for a in message.attachments),
+            param=param,
+            size=estimate_size(param) if param is not None else 0)
+
+@dataclass
+class ConversationCache:
+    max_messages : int = DEFAULT_MAX_CACHED_MESSAGES
+    max_bytes : int = DEFAULT_MAX_CACHED_BYTES
+    max_chain_depth : int = DEFAULT_MAX_CHAIN_DEPTH
+
+    hits : int = 0
+    misses : int = 0
+
+    records : "OrderedDict[int, MessageRecord]" = field(default_factory=OrderedDict)
+    total_bytes : int = 0
+
+    def get(self, message_id: int) -> Optional[MessageRecord]:
+        record = self.records.get(message_id)
+        if record is not None:
+            self.records.move_to_end(message_id)
+        return record
+
+    def remember(self, message: discord.Message, param: Optional[Dict[str, Any]] = None) -> MessageRecord:
+        record = MessageRecord.from_message(message, param)
+
+        previous = self.records.pop(record.id, None)
+        if previous is not None:
+            self.total_bytes -= previous.size
+            # seeing the same version of a message again keeps the param converted for it
+            if param is None and previous.param is not None and previous.edited_at == record.edited_at:
+                record = previous
+
+        self.records[record.id] = record
+        self.total_bytes += record.size
+
+        while len(self.records) > self.max_messages or self.total_bytes > self.max_bytes:
+            _, evicted = self.records.popitem(last=False)
+            self.total_bytes -= evicted.size
+
+        return record
+
+    def forget(self, message_id: int):
+        record = self.records.pop(message_id, None)
+        if record is not None:
+            self.total_bytes -= record.size
+
+    # gateway event hook, wire it to the client's on_message; edits and deletes go through the handler's forget
+    def on_message(self, message: discord.Message):
+        self.remember(message)
+
+    async def fetch_parent(self, message: discord.Message, child: Optional[discord.Message], parent_id: int) -> Optional[discord.Message]:
+        if child is not None:
+            reference = child.reference
+            if reference is None or not isinstance(reference.resolved, discord.Message):
+                return None
+            return await reference.resolved.fetch()
+
+        # the child came from the cache, so there is no resolved reference to follow
+        try:
+            return await message.channel.fetch_message(parent_id)
+        except discord.HTTPException:
+            return None
+
+    async def get_chain(self, message: discord.Message, convert: Converter) -> List[MessageRecord]:
+        links : List[Union[MessageRecord, discord.Message]] = [message]
+        child : Optional[discord.Message] = message
+        parent_id = parent_of(message)
+
+        while parent_id is not None and len(links) < self.max_chain_depth:
+            record = self.get(parent_id)
+            if record is not None and record.param is not None:
+                self.hits += 1
+                links.append(record)
+                child = None
+                parent_id = record.parent_id
+                continue
+
+            parent = await self.fetch_parent(message, child, parent_id)
+            if parent is None:
+                break
+
+            self.misses += 1
+            links.append(parent)
+            child = parent
+            parent_id = parent_of(parent)
+
+        # everything discord had to provide is converted at once, each may be downloading attachments
+        fetched = [l for l in links if isinstance(l, discord.Message)]
+        params = await asyncio.gather(*[convert(m) for m in fetched])
+        converted = { m.id: self.remember(m, param) for m, param in zip(fetched, params) }
+
+        chain = [converted[l.id] if isinstance(l, discord.Message) else l for l in links]
+        chain.reverse()
+
+        logging.info(f"Conversation cache: {self.hits} hits, {self.misses} misses, {len(self.records)} cached messages, {self.total_bytes / (1024 * 1024):.1f} MiB.")
+
+        return chain
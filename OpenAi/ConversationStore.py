@@ -0,0 +1,241 @@
+from dataclasses import dataclass, field
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import discord
+
+CONVERSATION_DB_PATH = os.path.join(".cache", "conversations.sqlite3")
+
+WRITE_BATCH_SIZE = 500
+# writes are dropped rather than queued without bound if the disk can't keep up
+MAX_PENDING_WRITES = 50_000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    parent_id INTEGER,
+    channel_id INTEGER,
+    author_id INTEGER,
+    param TEXT NOT NULL,
+    stored_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tool_calls (
+    id TEXT NOT NULL,
+    message_id INTEGER,
+    name TEXT NOT NULL,
+    arguments TEXT,
+    result TEXT,
+    is_error INTEGER NOT NULL DEFAULT 0,
+    elapsed REAL,
+    stored_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tool_calls_message_id ON tool_calls (message_id);
+CREATE TABLE IF NOT EXISTS usage (
+    message_id INTEGER,
+    provider TEXT NOT NULL,
+    model TEXT NOT NULL,
+    input_tokens INTEGER,
+    output_tokens INTEGER,
+    cache_read_tokens INTEGER,
+    cache_write_tokens INTEGER,
+    stored_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS usage_message_id ON usage (message_id);
+"""
+
+# walk up from a message to the root of its reply chain in one query
+CHAIN_QUERY = """
+WITH RECURSIVE chain(id, parent_id, param, depth) AS (
+    SELECT id, parent_id, param, 1 FROM messages WHERE id = ?
+    UNION ALL
+    SELECT m.id, m.parent_id, m.param, chain.depth + 1 FROM messages m JOIN chain ON m.id = chain.parent_id
+    WHERE chain.depth < ?
+)
+SELECT id, parent_id, param FROM chain ORDER BY depth
+"""
+
+INSERT_MESSAGE = "INSERT OR REPLACE INTO messages (id, parent_id, channel_id, author_id, param, stored_at) VALUES (?, ?, ?, ?, ?, ?)"
+INSERT_TOOL_CALL = "INSERT INTO tool_calls (id, message_id, name, arguments, result, is_error, elapsed, stored_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+INSERT_USAGE = "INSERT INTO usage (message_id, provider, model, input_tokens, output_tokens, cache_read_tokens, cache_write_tokens, stored_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+DELETE_MESSAGE = "DELETE FROM messages WHERE id = ?"
+
+Write = Tuple[str, Tuple[Any, ...]]
+
+@dataclass(frozen=True, slots=True)
+class StoredMessage:
+    id: int
+    parent_id: Optional[int]
+    param: Dict[str, Any]
+
+@dataclass
+class ConversationStore:
+    path : str = CONVERSATION_DB_PATH
+    batch_size : int = WRITE_BATCH_SIZE
+    max_pending : int = MAX_PENDING_WRITES
+
+    queue : "asyncio.Queue[Write]" = field(default_factory=asyncio.Queue)
+    writer_task : Optional["asyncio.Task[None]"] = None
+
+    # message writes and deletes queued but not yet on disk, so a read never misses one still in flight
+    pending : Dict[int, Tuple[Optional[StoredMessage], Write]] = field(default_factory=dict)
+
+    write_connection : Optional[sqlite3.Connection] = None
+    read_connection : Optional[sqlite3.Connection] = None
+    write_lock : threading.Lock = field(default_factory=threading.Lock)
+    read_lock : threading.Lock = field(default_factory=threading.Lock)
+
+    hits : int = 0
+    misses : int = 0
+    written : int = 0
+    dropped : int = 0
+
+    def connect(self) -> sqlite3.Connection:
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        connection = sqlite3.connect(self.path, check_same_thread=False)
+        # wal lets the reader run while a batch is being written
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.executescript(SCHEMA)
+        return connection
+
+    def enqueue(self, write: Write) -> bool:
+        if self.queue.qsize() >= self.max_pending:
+            self.dropped += 1
+            return False
+
+        self.queue.put_nowait(write)
+
+        if self.writer_task is None or self.writer_task.done():
+            self.writer_task = asyncio.get_running_loop().create_task(self.write_behind())
+
+        return True
+
+    async def write_behind(self):
+        while True:
+            batch = [await self.queue.get()]
+            # everything that piled up during the last write goes in this one
+            while len(batch) < self.batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+
+            try:
+                await asyncio.to_thread(self.write_batch, batch)
+                self.written += len(batch)
+            except sqlite3.Error as e:
+                logging.exception(e)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+            for write in batch:
+                sql, params = write
+                # only if nothing newer for the same message was queued behind it
+                if sql in (INSERT_MESSAGE, DELETE_MESSAGE) and params[0] in self.pending and self.pending[params[0]][1] is write:
+                    del self.pending[params[0]]
+
+    def write_batch(self, batch: List[Write]):
+        with self.write_lock:
+            if self.write_connection is None:
+                self.write_connection = self.connect()
+            with self.write_connection:
+                for sql, params in batch:
+                    self.write_connection.execute(sql, params)
+
+    async def flush(self):
+        await self.queue.join()
+
+    def read_chain(self, message_id: int, max_depth: int) -> List[Tuple[int, Optional[int], str]]:
+        with self.read_lock:
+            if self.read_connection is None:
+                if not os.path.exists(self.path):
+                    return []
+                self.read_connection = self.connect()
+            return self.read_connection.execute(CHAIN_QUERY, (message_id, max_depth)).fetchall()
+
+    async def get_chain(self, message_id: int, max_depth: int) -> Optional[List[StoredMessage]]:
+        # the stored ancestors of a message, root first, or None if any of them has to come from discord
+        chain : List[StoredMessage] = []
+        next_id : Optional[int] = message_id
+
+        while next_id is not None and len(chain) < max_depth:
+            if next_id in self.pending:
+                stored, _ = self.pending[next_id]
+                if stored is None:
+                    self.misses += 1
+                    return None
+                chain.append(stored)
+                next_id = stored.parent_id
+                continue
+
+            rows = await asyncio.to_thread(self.read_chain, next_id, max_depth - len(chain))
+            if not rows:
+                self.misses += 1
+                return None
+
+            for id, parent_id, param in rows:
+                # a newer write or a delete that hasn't reached the disk yet wins over what is there
+                if id in self.pending:
+                    break
+                chain.append(StoredMessage(id=id, parent_id=parent_id, param=json.loads(param)))
+                next_id = parent_id
+
+        self.hits += 1
+        chain.reverse()
+        return chain
+
+    def remember_message(self, message: discord.Message, param: Dict[str, Any]):
+        try:
+            serialized = json.dumps(param)
+        except (TypeError, ValueError):
+            # anything that won't round trip through json is simply converted again next time
+            return
+
+        parent_id = message.reference.message_id if message.reference is not None else None
+        write = (INSERT_MESSAGE, (message.id, parent_id, message.channel.id, message.author.id, serialized, time.time()))
+        if self.enqueue(write):
+            self.pending[message.id] = (StoredMessage(id=message.id, parent_id=parent_id, param=param), write)
+
+    def record_tool_call(
+            self,
+            tool_call_id: str,
+            message_id: Optional[int],
+            name: str,
+            arguments: str,
+            result: str,
+            is_error: bool,
+            elapsed: Optional[float]):
+        self.enqueue((INSERT_TOOL_CALL, (tool_call_id, message_id, name, arguments, result, int(is_error), elapsed, time.time())))
+
+    def record_usage(
+            self,
+            message_id: Optional[int],
+            provider: str,
+            model: str,
+            input_tokens: int,
+            output_tokens: int,
+            cache_read_tokens: int = 0,
+            cache_write_tokens: int = 0):
+        self.enqueue((INSERT_USAGE, (message_id, provider, model, input_tokens, output_tokens, cache_read_tokens, cache_write_tokens, time.time())))
+
+    # the stored param is stale once its message is edited, the next turn converts it again
+    def forget(self, message_id: int):
+        write = (DELETE_MESSAGE, (message_id,))
+        if self.enqueue(write):
+            self.pending[message_id] = (None, write)
+        else:
+            self.pending.pop(message_id, None)
+
+    async def close(self):
+        await self.flush()
+        if self.writer_task is not None:
+            self.writer_task.cancel()
+        for connection in (self.write_connection, self.read_connection):
+            if connection is not None:
+                connection.close()
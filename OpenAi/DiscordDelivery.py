@@ -0,0 +1,144 @@
+import asyncio
+import logging
+import random
+import unicodedata
+from typing import Awaitable, Callable, List, Optional, Set, Tuple, TypeVar
+
+import discord
+
+from config import DISCORD_MAX_MESSAGE_LENGTH
+
+T = TypeVar("T")
+
+FENCE = "```"
+# never cut on either side of a zero width joiner, or in front of a modifier that belongs to the character before it
+JOINERS = frozenset({ "‍" })
+MODIFIERS = frozenset({ "︎", "️", *(chr(c) for c in range(0x1F3FB, 0x1F400)) })
+
+SEND_ATTEMPTS = 4
+SEND_BASE_DELAY_SECONDS = 1.0
+SEND_MAX_DELAY_SECONDS = 30.0
+
+# fire and forget tasks, held here so they aren't garbage collected half way through
+background_tasks : Set["asyncio.Task[object]"] = set()
+
+def find_cut(line: str, room: int) -> int:
+    # the last space that leaves a reasonably full chunk, otherwise a hard cut
+    space = line.rfind(" ", 0, room)
+    if space > room // 2:
+        return space + 1
+
+    cut = room
+    while cut > 1 and (unicodedata.combining(line[cut]) or line[cut] in MODIFIERS or line[cut] in JOINERS or line[cut - 1] in JOINERS):
+        cut -= 1
+    return cut
+
+def open_fence(text: str) -> Optional[str]:
+    # the fence line of a code block left open at the end of text, if any
+    fence : Optional[str] = None
+    for line in text.splitlines():
+        if line.lstrip().startswith(FENCE):
+            fence = None if fence is not None else line.strip()
+    return fence
+
+def close_chunk(text: str, fence: Optional[str]) -> str:
+    if fence is None:
+        return text
+    return text + ("" if text.endswith("\n") else "\n") + FENCE
+
+def is_filler(body: str, reopened: bool) -> bool:
+    # what follows a reopened fence says nothing when it is blank, or only closes the block straight away
+    return not body.strip() or (reopened and body.strip() == FENCE)
+
+def split_stream(content: str, max_length: int = DISCORD_MAX_MESSAGE_LENGTH) -> Tuple[List[str], str]:
+    # one pass over the lines, filling each chunk as far as it goes; a code block that straddles
+    # two chunks is closed at the end of the first and opened again, with its language, in the next.
+    # returns the finished chunks and the unfinished tail as it is, a code block in it still open
+    chunks : List[str] = []
+    parts : List[str] = []
+    length = 0
+    opened = 0
+    fence : Optional[str] = None
+
+    def finish():
+        nonlocal parts, length, opened
+        text = "".join(parts)
+        # only a chunk holding nothing but the splitter's own fences and whitespace is left out
+        if not is_filler(text[opened:], opened > 0):
+            chunks.append(close_chunk(text, fence))
+
+        # a fence line too long to repeat is reopened without its language, so the chunk still has room
+        if fence is not None:
+            parts = [(fence if len(fence) <= max_length // 4 else FENCE) + "\n"]
+        else:
+            parts = []
+        length = opened = len(parts[0]) if parts else 0
+
+    for line in content.splitlines(keepends=True):
+        is_fence = line.lstrip().startswith(FENCE)
+        while line:
+            # room is kept to close a code block that is still open, or that this line opens
+            closes_later = fence is not None or is_fence
+            room = max_length - length - (len(FENCE) + 1 if closes_later else 0)
+            if len(line) <= room:
+                parts.append(line)
+                length += len(line)
+                if is_fence:
+                    fence = None if fence is not None else line.strip()
+                break
+
+            # a line that fits in a fresh chunk isn't cut
+            if length > opened:
+                finish()
+                continue
+
+            cut = find_cut(line, max(1, room))
+            parts.append(line[:cut])
+            length += cut
+            # a fence line cut in two still opens or closes its block where it starts,
+            # the rest of it carries on as ordinary text
+            if is_fence:
+                fence = None if fence is not None else line[:cut].strip()
+                is_fence = False
+            line = line[cut:]
+            finish()
+
+    tail = "".join(parts)
+    return chunks, tail if not is_filler(tail[opened:], opened > 0) else ""
+
+def split_message(content: str, max_length: int = DISCORD_MAX_MESSAGE_LENGTH) -> List[str]:
+    chunks, tail = split_stream(content, max_length)
+    if tail:
+        chunks.append(close_chunk(tail, open_fence(tail)))
+    return chunks
+
+async def with_backoff(call: Callable[[], Awaitable[T]], attempts: int = SEND_ATTEMPTS) -> T:
+    # discord.py already waits out ordinary 429s, this covers the ones it gives up on and server errors
+    for attempt in range(attempts):
+        try:
+            return await call()
+        except discord.RateLimited as e:
+            if attempt == attempts - 1:
+                raise
+            delay = e.retry_after
+        except discord.HTTPException as e:
+            if attempt == attempts - 1 or (e.status != 429 and e.status < 500):
+                raise
+            delay = SEND_BASE_DELAY_SECONDS * 2 ** attempt
+
+        delay = min(SEND_MAX_DELAY_SECONDS, delay) * random.uniform(1.0, 1.25)
+        logging.warning(f"Discord send failed, retrying in {delay:.2f}s.")
+        await asyncio.sleep(delay)
+
+    raise AssertionError("unreachable")
+
+def in_background(coroutine: Awaitable[object]):
+    task = asyncio.ensure_future(coroutine)
+    background_tasks.add(task)
+
+    def done(task: "asyncio.Task[object]"):
+        background_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logging.warning(f"Background discord call failed: {task.exception()}")
+
+    task.add_done_callback(done)
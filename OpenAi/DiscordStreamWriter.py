@@ -0,0 +1,127 @@
+from dataclasses import dataclass, field
+import asyncio
+import functools
+import inspect
+import logging
+import time
+from typing import Callable, List, Optional
+
+import discord
+
+from config import DISCORD_MAX_MESSAGE_LENGTH
+from DiscordDelivery import split_stream, with_backoff
+
+# discord allows roughly 5 edits per 5 seconds on a message, stay comfortably under that
+STREAM_EDIT_INTERVAL_SECONDS = 1.2
+
+@dataclass
+class DiscordStreamWriter:
+    message : discord.Message
+    edit_interval : float = STREAM_EDIT_INTERVAL_SECONDS
+    max_length : int = DISCORD_MAX_MESSAGE_LENGTH
+    on_message : Optional[Callable[[discord.Message], object]] = None
+
+    messages : List[discord.Message] = field(default_factory=list)
+    written : int = 0
+
+    text : str = ""
+    shown : str = ""
+    rollover : bool = False
+    separate : bool = False
+    last_edit : float = 0.0
+    flush_task : Optional[asyncio.Task] = None
+    sleeping : bool = False
+    lock : asyncio.Lock = field(default_factory=asyncio.Lock)
+
+    def __post_init__(self):
+        self.messages.append(self.message)
+
+    def paragraph(self):
+        #the next write starts a new paragraph, if anything has been written yet
+        self.separate = self.written > 0
+
+    async def write(self, delta: str):
+        if not delta:
+            return
+
+        if self.separate:
+            delta = "\n\n" + delta
+            self.separate = False
+
+        self.written += len(delta)
+        self.text += delta
+
+        #the current message is full, finish it at a clean break and carry on in a new reply;
+        #the unfinished tail stays raw, so a code block it is in is still open for the next tokens
+        if len(self.text) > self.max_length:
+            chunks, tail = split_stream(self.text, self.max_length)
+            for chunk in chunks:
+                self.text = chunk
+                await self.flush()
+                await self.finished()
+                self.shown = ""
+                self.rollover = True
+            self.text = tail
+
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.create_task(self.delayed_flush())
+
+    async def delayed_flush(self):
+        delay = self.last_edit + self.edit_interval - time.monotonic()
+        if delay > 0:
+            self.sleeping = True
+            try:
+                await asyncio.sleep(delay)
+            finally:
+                self.sleeping = False
+        await self.flush()
+
+    async def flush(self):
+        #edits are serialized, so a slow or rate limited edit pushes the next one back instead of piling up
+        async with self.lock:
+            if not self.text or (self.text == self.shown and not self.rollover):
+                return
+
+            text = self.text
+            try:
+                if self.rollover:
+                    self.message = await with_backoff(functools.partial(self.message.reply, content=text))
+                    self.messages.append(self.message)
+                    self.rollover = False
+                else:
+                    self.message = await with_backoff(functools.partial(self.message.edit, content=text))
+            except discord.HTTPException as e:
+                logging.exception(e)
+                return
+
+            self.shown = text
+            self.last_edit = time.monotonic()
+
+    async def finished(self):
+        #only a message that won't change again is handed on, not every throttled edit of it
+        if self.on_message is None or not self.shown:
+            return
+        result = self.on_message(self.message)
+        if inspect.isawaitable(result):
+            await result
+
+    async def stop_flushing(self):
+        #skip the wait for a throttled edit, but never cancel one that is already talking to discord
+        if self.flush_task is not None and not self.flush_task.done():
+            if self.sleeping:
+                self.flush_task.cancel()
+            await asyncio.gather(self.flush_task, return_exceptions=True)
+
+    async def close(self) -> discord.Message:
+        await self.stop_flushing()
+        await self.flush()
+        await self.finished()
+        return self.message
+
+    async def fail(self, content: str) -> discord.Message:
+        #the error takes the place of the partial reply in the message the user is looking at,
+        #after any throttled edit that would have put the partial reply back over it
+        await self.stop_flushing()
+        self.text = content
+        await self.flush()
+        return self.message
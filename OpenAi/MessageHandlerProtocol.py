@@ -1,7 +1,13 @@
-from typing import List, Protocol
+from typing import Any, Dict, List, Optional, Protocol, Union
 
 import discord
 
 
 class MessageHandlerProtocol(Protocol):
-    files: List[discord.File]  
\ No newline at end of file
+    files: List[discord.File]
+    author: Optional[Union[discord.User, discord.Member]]
+    channel: Optional[discord.abc.Messageable]
+    started_at: float
+    tool_state: Dict[str, Any]
+
+    async def add_file(self, file: discord.File) -> None: ...
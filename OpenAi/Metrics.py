@@ -0,0 +1,204 @@
+from dataclasses import dataclass, field
+import bisect
+import time
+from typing import Any, Dict, List, Optional, Protocol, Tuple
+
+METRIC_PREFIX = "llm_tools"
+
+DEFAULT_SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+DEFAULT_COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21)
+
+# span attributes that become prometheus labels, everything else would explode the label cardinality
+LABEL_ATTRIBUTES = ("provider", "model", "tool", "stream", "error")
+# numeric span attributes that are summed into counters
+COUNTER_ATTRIBUTES = ("input_tokens", "output_tokens", "cache_read_tokens", "cache_write_tokens")
+# numeric span attributes that are observed into count histograms
+COUNT_ATTRIBUTES = ("tool_round", "tool_rounds", "messages")
+
+Labels = Tuple[Tuple[str, str], ...]
+
+class MetricsSink(Protocol):
+    enabled: bool
+
+    def record_span(self, span: "Span") -> None: ...
+
+    def observe(self, name: str, value: float, **labels: Any) -> None: ...
+
+    def increment(self, name: str, value: float = 1, **labels: Any) -> None: ...
+
+class NullSink:
+    enabled = False
+
+    def record_span(self, span: "Span") -> None:
+        pass
+
+    def observe(self, name: str, value: float, **labels: Any) -> None:
+        pass
+
+    def increment(self, name: str, value: float = 1, **labels: Any) -> None:
+        pass
+
+@dataclass
+class Histogram:
+    buckets : Tuple[float, ...]
+    counts : List[int] = field(default_factory=list)
+    sum : float = 0.0
+    count : int = 0
+
+    def __post_init__(self):
+        if not self.counts:
+            self.counts = [0] * len(self.buckets)
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+@dataclass
+class PrometheusSink:
+    enabled : bool = True
+    seconds_buckets : Tuple[float, ...] = DEFAULT_SECONDS_BUCKETS
+    count_buckets : Tuple[float, ...] = DEFAULT_COUNT_BUCKETS
+
+    histograms : Dict[Tuple[str, Labels], Histogram] = field(default_factory=dict)
+    counters : Dict[Tuple[str, Labels], float] = field(default_factory=dict)
+
+    @staticmethod
+    def labels(labels: Dict[str, Any]) -> Labels:
+        return tuple(sorted((k, str(v)) for k, v in labels.items() if v is not None))
+
+    def observe(self, name: str, value: float, **labels: Any) -> None:
+        key = (name, self.labels(labels))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            buckets = self.seconds_buckets if name.endswith("_seconds") else self.count_buckets
+            histogram = self.histograms[key] = Histogram(buckets)
+        histogram.observe(value)
+
+    def increment(self, name: str, value: float = 1, **labels: Any) -> None:
+        key = (name, self.labels(labels))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def record_span(self, span: "Span") -> None:
+        labels = { k: span.attributes[k] for k in LABEL_ATTRIBUTES if k in span.attributes }
+        self.observe("stage_seconds", span.duration, stage=span.name, **labels)
+
+        for attribute in COUNTER_ATTRIBUTES:
+            if attribute in span.attributes:
+                self.increment("tokens_total", span.attributes[attribute], stage=span.name, kind=attribute, **labels)
+
+        for attribute in COUNT_ATTRIBUTES:
+            if attribute in span.attributes:
+                self.observe(attribute, span.attributes[attribute], stage=span.name, **labels)
+
+    @staticmethod
+    def format_labels(labels: Labels, extra: Optional[Tuple[str, str]] = None) -> str:
+        pairs = list(labels) + ([extra] if extra is not None else [])
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+    def render(self) -> str:
+        lines : List[str] = []
+
+        for name in sorted({ n for n, _ in self.histograms }):
+            metric = f"{METRIC_PREFIX}_{name}"
+            lines.append(f"# TYPE {metric} histogram")
+            for (n, labels), histogram in sorted(self.histograms.items()):
+                if n != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(f"{metric}_bucket{self.format_labels(labels, ('le', str(bound)))} {cumulative}")
+                lines.append(f"{metric}_bucket{self.format_labels(labels, ('le', '+Inf'))} {histogram.count}")
+                lines.append(f"{metric}_sum{self.format_labels(labels)} {histogram.sum}")
+                lines.append(f"{metric}_count{self.format_labels(labels)} {histogram.count}")
+
+        for name in sorted({ n for n, _ in self.counters }):
+            metric = f"{METRIC_PREFIX}_{name}"
+            lines.append(f"# TYPE {metric} counter")
+            for (n, labels), value in sorted(self.counters.items()):
+                if n == name:
+                    lines.append(f"{metric}{self.format_labels(labels)} {value}")
+
+        return "\n".join(lines) + "\n"
+
+@dataclass
+class InMemorySink:
+    enabled : bool = True
+
+    spans : List["Span"] = field(default_factory=list)
+    observations : List[Tuple[str, float, Dict[str, Any]]] = field(default_factory=list)
+    counters : Dict[str, float] = field(default_factory=dict)
+
+    def record_span(self, span: "Span") -> None:
+        self.spans.append(span)
+
+    def observe(self, name: str, value: float, **labels: Any) -> None:
+        self.observations.append((name, value, labels))
+
+    def increment(self, name: str, value: float = 1, **labels: Any) -> None:
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def spans_named(self, name: str) -> List["Span"]:
+        return [s for s in self.spans if s.name == name]
+
+    def clear(self):
+        self.spans.clear()
+        self.observations.clear()
+        self.counters.clear()
+
+class Span:
+    __slots__ = ("name", "attributes", "started", "duration", "sink")
+
+    def __init__(self, name: str, attributes: Dict[str, Any], sink: MetricsSink):
+        self.name = name
+        self.attributes = attributes
+        self.sink = sink
+        self.started = 0.0
+        self.duration = 0.0
+
+    def set(self, key: str, value: Any):
+        self.attributes[key] = value
+
+    def __enter__(self) -> "Span":
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback) -> None:
+        self.duration = time.perf_counter() - self.started
+        if exc_type is not None:
+            self.attributes["error"] = exc_type.__name__
+        self.sink.record_span(self)
+
+class NullSpan:
+    __slots__ = ()
+
+    def set(self, key: str, value: Any):
+        pass
+
+    def __enter__(self) -> "NullSpan":
+        return self
+
+    def __exit__(self, exc_type, exc, traceback) -> None:
+        pass
+
+NULL_SPAN = NullSpan()
+
+sink : MetricsSink = NullSink()
+
+def set_sink(new_sink: MetricsSink):
+    global sink
+    sink = new_sink
+
+def get_sink() -> MetricsSink:
+    return sink
+
+def span(name: str, **attributes: Any) -> Any:
+    # with no sink configured this is one attribute check and a shared no-op object
+    if not sink.enabled:
+        return NULL_SPAN
+    return Span(name, attributes, sink)
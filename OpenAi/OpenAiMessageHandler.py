@@ -1,41 +1,147 @@
 from dataclasses import dataclass, field
+import asyncio
+import contextlib
+import functools
 import json
+import time
 import discord
 import emojis
 import logging
 import openai
 import openai.types.chat as chat
-from tools.toolbase import ToolBase
+from Clients import get_openai_client
+from ToolLoader import ToolSource
+from ToolExecutor import TOOL_TIMEOUT_SECONDS, ToolExecutor
+from ToolRegistry import ToolRegistry, ToolTier
+from ModelRouter import ModelRoute, ModelRouter
+from ContextWindow import ContextEntry, ContextWindow, DEFAULT_CONTEXT_BUDGET
+from ConversationCache import ConversationCache
+from ConversationStore import ConversationStore, StoredMessage
+from DiscordDelivery import in_background, split_message, with_backoff
+from DiscordStreamWriter import DiscordStreamWriter
+import Metrics
+from RequestContext import RequestContext
+from RequestScheduler import RequestScheduler, SchedulerRejectedError
+from Resilience import Resilience
+from ResponseCache import ResponseCache, is_deterministic
 import utilities.discord as discord_utilities
 import utilities.openai as openai_utilities
 
-from config import CONFIG, DISCORD_MAX_MESSAGE_LENGTH
-from typing import List
+from config import CONFIG
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+MAX_CONCURRENT_TOOLS = 4
+
+SUMMARY_PROMPT = "Summarize the following conversation in a few sentences. Keep names, decisions, open questions and any facts later messages may rely on."
+SUMMARY_MAX_TOKENS = 512
+
+# used for a single request while the configured model is failing or unavailable
+FALLBACK_MODEL = "gpt-4o-mini"
+
+DEFAULT_TEMPERATURE = 1.0
+
+# the default routes: quick chat on the small model, long or tool-heavy threads on the configured one
+DEFAULT_ROUTES = (
+    ModelRoute(FALLBACK_MODEL, strength=1, latency_slo=10.0),
+    ModelRoute(CONFIG.default_model, strength=2, latency_slo=30.0))
 
 @dataclass
 class OpenAiMessageHandler:
-    standard_tools : List[ToolBase]
-    admin_tools : List[ToolBase]
+    standard_tools : List[ToolSource]
+    admin_tools : List[ToolSource]
     
     model : str = CONFIG.default_model
 
-    @staticmethod   
-    def get_empty_file_list() -> List[discord.File]:
-        return []
-    
-    files : List[discord.File] = field(default_factory=get_empty_file_list)
+    max_concurrent_tools : int = MAX_CONCURRENT_TOOLS
+    # the default deadline, tools can set their own
+    tool_timeout : float = TOOL_TIMEOUT_SECONDS
+
+    stream : bool = False
+
+    # 0 makes replies repeatable, which is also what lets the response cache answer them
+    temperature : float = DEFAULT_TEMPERATURE
+
+    conversation_cache : ConversationCache = field(default_factory=ConversationCache)
+    # optional history on disk, so a conversation can be picked up again without walking discord
+    conversation_store : Optional[ConversationStore] = None
+    # optional, answers a request identical to an earlier one without calling the api again
+    response_cache : Optional[ResponseCache] = None
+    # picks the model for each request from DEFAULT_ROUTES; None sends every request to model
+    router : Optional[ModelRouter] = field(default_factory=lambda: ModelRouter(DEFAULT_ROUTES, name="openai"))
+
+    scheduler : RequestScheduler = field(default_factory=lambda: RequestScheduler(name="openai"))
 
-    openai_client = openai.AsyncOpenAI()
+    resilience : Resilience = field(default_factory=lambda: Resilience(name="openai", fallback_model=FALLBACK_MODEL))
+
+    context_budget : int = DEFAULT_CONTEXT_BUDGET
+    summarize_dropped_context : bool = False
+
+    tool_registry : ToolRegistry = field(init=False)
+    tool_executor : ToolExecutor = field(init=False)
+    context_window : ContextWindow = field(init=False)
+
+    # injectable for tests and benchmarks, otherwise the process-wide client is built on first use
+    openai_client : Optional[openai.AsyncOpenAI] = None
+
+    def __post_init__(self):
+        self.tool_registry = ToolRegistry(self.standard_tools, self.admin_tools)
+        self.tool_executor = ToolExecutor(default_timeout=self.tool_timeout)
+        self.context_window = ContextWindow(
+            budget=self.context_budget,
+            summarizer=self.summarize_transcript if self.summarize_dropped_context else None)
+
+    @property
+    def client(self) -> openai.AsyncOpenAI:
+        if self.openai_client is None:
+            self.openai_client = get_openai_client()
+        return self.openai_client
+
+    async def get_stored_history(
+            self,
+            message: discord.Message) -> Optional[List[StoredMessage]]:
+        if self.conversation_store is None or message.reference is None:
+            return None
+        return await self.conversation_store.get_chain(message.reference.message_id, self.conversation_cache.max_chain_depth - 1)
+
+    async def convert_message(self, message: discord.Message) -> Dict[str, Any]:
+        param = discord_utilities.discord_message_to_openai_chat_completion_param(message)
+        if self.conversation_store is not None:
+            self.conversation_store.remember_message(message, param) # type: ignore
+        return param # type: ignore
 
     async def get_conversation(
             self,
-            message: discord.Message) -> List[discord.Message]:
-        conversation : List[discord.Message] = [message]
+            message: discord.Message) -> List[ContextEntry]:
+        with Metrics.span("get_conversation", provider="openai") as span:
+            # when everything before this message is on disk, it is the only one discord has to provide
+            stored = await self.get_stored_history(message) or []
+            if stored:
+                records = [self.conversation_cache.remember(message, await self.convert_message(message))]
+            else:
+                records = await self.conversation_cache.get_chain(message, self.convert_message)
+            span.set("messages", len(stored) + len(records))
+
+        return [(s.id, s.param) for s in stored] + [(r.id, r.param) for r in records] # type: ignore
 
-        while conversation[0].reference is not None and isinstance(conversation[0].reference.resolved, discord.Message):
-            conversation.insert(0, await conversation[0].reference.resolved.fetch())
-            
-        return conversation
+    async def remember_reply(self, message: discord.Message):
+        self.conversation_cache.remember(message, await self.convert_message(message))
+
+    # everything cached about a message, or built from it, goes at once when it is edited or deleted
+    def forget(self, message_id: int):
+        self.conversation_cache.forget(message_id)
+        self.context_window.forget(message_id)
+        if self.conversation_store is not None:
+            self.conversation_store.forget(message_id)
+        if self.response_cache is not None:
+            self.response_cache.forget_message(message_id)
+
+    # gateway event hooks, wire these to the client's on_message_edit / on_raw_message_delete
+    def on_message_edit(self, before: discord.Message, after: discord.Message):
+        self.forget(after.id)
+        self.conversation_cache.remember(after)
+
+    def on_raw_message_delete(self, payload: discord.RawMessageDeleteEvent):
+        self.forget(payload.message_id)
 
     async def on_message(
             self,
@@ -43,145 +149,387 @@ class OpenAiMessageHandler:
         
         conversation = await self.get_conversation(message)
 
-        #convert the messages to chat completion params
-        chat_completion_messages = [discord_utilities.discord_message_to_openai_chat_completion_param(m) for m in conversation]
+        #keep the newest messages that fit the token budget
+        window = await self.context_window.fit(conversation)
 
-        logging.info(f"Found {len(chat_completion_messages)} messages in the conversation.")
+        logging.info(f"Found {len(conversation)} messages in the conversation, sending {len(window.messages)} ({window.kept_tokens} tokens, {window.saved_tokens} tokens saved).")
 
-        await self.get_discord_message_response(
-            messages=chat_completion_messages,
-            discord_message=message)
+        model : Optional[str] = None
+        use_tools = True
+        if self.router is not None:
+            tools_available = bool(self.tool_registry.tier_for(message.author.id).tools)
+            route = self.router.choose(window.kept_tokens, tools_available, message.channel.id)
+            model, use_tools = route.model, route.supports_tools
+
+        #wait for a fair share of the provider before calling it
+        try:
+            async with self.scheduler.slot(message.author.id, message.channel.id):
+                await self.get_discord_message_response(
+                    messages=window.messages,
+                    discord_message=message,
+                    model=model,
+                    use_tools=use_tools,
+                    conversation_ids=tuple(i for i, _ in conversation if i is not None))
+        except SchedulerRejectedError as e:
+            logging.warning(str(e))
+            reply = await message.reply(content=f"I'm sorry, {message.author.mention}, I'm a little busy right now. Please try again in a moment.")
+            await reply.add_reaction(emojis.HAL9000)
         
 
+    async def summarize_transcript(self, transcript: str) -> str:
+        chat_completion = await self.resilience.call(self.model, lambda model: self.client.chat.completions.create(
+            messages=[
+                { "role": "system", "content": SUMMARY_PROMPT },
+                { "role": "user", "content": transcript }],
+            model=model,
+            max_tokens=SUMMARY_MAX_TOKENS))
+        return chat_completion.choices[0].message.content or ""
+
     async def get_discord_message_response(
             self,
             discord_message: discord.Message,
             messages: list[chat.ChatCompletionMessageParam],        
-            temperature: float = 1.0,
-            max_tokens: int = 1024):
+            temperature: Optional[float] = None,
+            max_tokens: int = 1024,
+            model: Optional[str] = None,
+            use_tools: bool = True,
+            conversation_ids: Tuple[int, ...] = ()):
         
-        logging.info(f"Getting discord message response with {self.model}...")
+        if temperature is None:
+            temperature = self.temperature
+        if model is None:
+            model = self.model
+
+        logging.info(f"Getting discord message response with {model}...")
 
         author = discord_message.author    
 
+        context = RequestContext(author=author, channel=discord_message.channel, message_id=discord_message.id, model=model, conversation_ids=conversation_ids)
+
         #messages.insert(0, openai_utilities.get_system_message(self.model))
 
-        available_tools : List[ToolBase] = self.standard_tools + (self.admin_tools if author.id == CONFIG.admin_user_id else [])
+        # a model routed to without tools gets none offered
+        available_tools : ToolTier = self.tool_registry.tier_for(author.id) if use_tools else ToolTier.build([])
+
+        #in streaming mode the placeholder goes out straight away and tokens are edited into it as they arrive
+        writer : Optional[DiscordStreamWriter] = None
+        if self.stream:
+            discord_message = await discord_message.reply("🤔")
+            in_background(discord_utilities.add_model_reactions(model, discord_message))
+            writer = DiscordStreamWriter(discord_message, on_message=self.remember_reply)
 
         try:
-            chat_completion = await self.openai_client.chat.completions.create(
+            completion_message = await self.create_completion(
+                writer,
+                context,
+                available_tools,
                 messages=messages,
-                model=self.model,
+                model=model,
                 temperature=temperature,
                 top_p=1.0,
                 #max_tokens=max_tokens,
                 
                 #tool_choice="auto",
-                #tools=[t.parameter for t in available_tools],
+                #tools=available_tools.parameters,
                 user=str(author.id))
         except Exception as e:
             logging.exception(e)
-            discord_message = await discord_message.reply(content = f"I'm sorry, {author.mention}, I'm afraid I can't do that.\n{e}")
+            if writer is not None:
+                discord_message = await writer.fail(f"I'm sorry, {author.mention}, I'm afraid I can't do that.\n{e}")
+            else:
+                discord_message = await discord_message.reply(content = f"I'm sorry, {author.mention}, I'm afraid I can't do that.\n{e}")
             await discord_message.add_reaction(emojis.HAL9000)        
             return
         
         #the model has generated a text reply
-        if (chat_completion.choices[0].message.content is not None):        
-            await self.send_response(content=chat_completion.choices[0].message.content, message=discord_message, is_edit=False)        
+        if (completion_message.content is not None and not completion_message.tool_calls):        
+            if writer is not None:
+                await writer.close()
+            else:
+                await self.send_response(content=completion_message.content, message=discord_message, is_edit=False, model=model)        
 
         #the model has elected to use a tool        
-        elif (chat_completion.choices[0].message.tool_calls is not None):        
-            discord_message = await discord_message.reply("🤔")
-            #if ()
-            #discord_message = await discord
+        elif (completion_message.tool_calls):        
+            if writer is None:
+                discord_message = await discord_message.reply("🤔")
+                #if ()
+                #discord_message = await discord
 
-            await discord_utilities.add_model_reactions(self.model, discord_message)
+                in_background(discord_utilities.add_model_reactions(model, discord_message))
 
-            num_tools = 0         
+            #generated files are attached to the placeholder as soon as each one is ready
+            context.attachment_message = discord_message
 
-            self.files.clear()
+            num_tools = 0         
 
-            while chat_completion.choices[0].message.content is None: 
-                assert chat_completion.choices[0].message.tool_calls is not None                    
-               
+            while completion_message.tool_calls: 
                 # it complains here but this works correctly
-                messages += [chat_completion.choices[0].message]                 # type: ignore
+                messages += [completion_message]                 # type: ignore
                 # do not try to fix this 
 
-                for tool_call in chat_completion.choices[0].message.tool_calls:
-                    #todo: do this in parallel
-                    num_tools += 1                
-                    
-                    #log the tool call. i still think this may need to go into a db for full conversation history
-                    log_message = f'{{ "id" = "{tool_call.id}", "name" = "{tool_call.function.name}", "args" = {tool_call.function.arguments}}}'            
-                    logging.info(log_message)                
-
-                    tool = next(filter(lambda t: t.parameter["function"]["name"] == tool_call.function.name, available_tools), None)
-                    if tool is not None:
-                        await discord_message.add_reaction(tool.emoji)
-                        try:
-                            tool_result = await tool.get_tool_result(tool_call.function.arguments, self)
-                        except Exception as e:
-                            logging.exception(e)
-                            await discord_message.add_reaction(emojis.HAL9000)
-                            tool_result = json.dumps({ "error" : str(e) })
-                    else:
-                        tool_result = f'{{ "status": "error", "message": "Unknown tool {tool_call.function.name}" }}'                   
-                        await discord_message.add_reaction(emojis.HAL9000)          
-                
-                    tool_response = openai_utilities.get_function_message(                        
-                        tool_call_id=tool_call.id,
-                        name=tool_call.function.name,
-                        content=tool_result)
-                    
-                    messages += [tool_response]
+                tool_calls = completion_message.tool_calls
+                num_tools += len(tool_calls)
+                context.tool_rounds += 1
+
+                # run every tool requested this turn concurrently, reactions go out alongside them
+                semaphore = asyncio.Semaphore(self.max_concurrent_tools)
+                reactions : List[asyncio.Task] = []
 
-                    log_message = f'{{ "id" = "{tool_call.id}", "content" = {tool_response["content"]}}}'
+                # gather keeps the call order, so the transcript the model sees stays deterministic
+                tool_responses = await asyncio.gather(*[
+                    self.run_tool_call(tool_call, available_tools, context, discord_message, semaphore, reactions)
+                    for tool_call in tool_calls])
 
-                    logging.info(log_message)                
+                messages += tool_responses
+
+                # reactions finish on their own time, the follow-up call does not wait for them
+                in_background(asyncio.gather(*reactions, return_exceptions=True))
                 
                 #tool calls have been processed
-                logging.info(f"Returning tool results to {self.model}...")            
+                logging.info(f"Returning tool results to {model}...")            
+
+                if writer is not None:
+                    writer.paragraph()
 
                 # hit the api again with our tool results in tow
                 try:
-                    chat_completion = await self.openai_client.chat.completions.create(
+                    completion_message = await self.create_completion(
+                        writer,
+                        context,
+                        available_tools,
                         messages=messages,
-                        model=self.model,
+                        model=model,
                         temperature=temperature,
                         top_p=1.0,
                         max_tokens=max_tokens,             
                         tool_choice="auto",
-                        tools=[t.parameter for t in available_tools],
+                        tools=available_tools.parameters,
                         user=str(author.id))
-                except openai.NotFoundError as e:
-                    logging.exception(e)
-                    await discord_message.add_reaction(emojis.HAL9000)
-                    await discord_message.edit(content=f"I'm sorry, {author.mention}, I'm afraid I can't do that.\n{e}")
-                    self.model = CONFIG.default_model
-                    return
                 except Exception as e:
                     logging.exception(e)
+                    if writer is not None:
+                        discord_message = await writer.fail(f"I'm sorry, {author.mention}, I'm afraid I can't do that.\n{str(e)}")
+                    else:
+                        await discord_message.edit(content=f"I'm sorry, {author.mention}, I'm afraid I can't do that.\n{str(e)}")
                     await discord_message.add_reaction(emojis.HAL9000)
-                    await discord_message.edit(content=f"I'm sorry, {author.mention}, I'm afraid I can't do that.\n{str(e)}")
                     return                
                 
+            Metrics.get_sink().observe("tool_rounds", context.tool_rounds, provider="openai", model=model)
+            if self.router is not None:
+                self.router.record_tool_use(discord_message.channel.id)
+
             #handle files that may have been generated
-            for file in self.files:
-                discord_message = await discord_message.add_files(file)
-            await self.send_response(content=chat_completion.choices[0].message.content, message=discord_message, is_edit=True)
+            await context.attach_pending_files()
+            discord_message = context.attachment_message
+
+            if writer is not None:
+                await writer.close()
+                if not writer.written:
+                    await discord_message.edit(content="I processed the tool result, but I don't have any additional comments.")
+            else:
+                await self.send_response(content=completion_message.content or "I processed the tool result, but I don't have any additional comments.", message=discord_message, is_edit=True, model=model)
+
+        elif writer is not None:
+            await discord_message.edit(content=f"I'm sorry, {author.mention}, but I didn't generate any response or tool calls.")
+
+    def response_cache_key(self, available_tools: ToolTier, kwargs: Dict[str, Any]) -> Optional[str]:
+        if self.response_cache is None or not is_deterministic(kwargs.get("temperature")):
+            return None
+        # the user id is left out, an identical question gets the same answer whoever asks it
+        return self.response_cache.key(
+            provider="openai",
+            model=kwargs["model"],
+            system=None,
+            # the tier's hash stands in for its schemas, which are the same bytes on every request
+            tools=available_tools.schema_hash if "tools" in kwargs else None,
+            temperature=kwargs.get("temperature"),
+            messages=kwargs["messages"],
+            top_p=kwargs.get("top_p"),
+            max_tokens=kwargs.get("max_tokens"),
+            tool_choice=kwargs.get("tool_choice"))
+
+    @staticmethod
+    def only_cacheable_tools(tool_names: Iterable[str], available_tools: ToolTier) -> bool:
+        # a reply that came out of, or asks for, a tool with side effects or a random result can't be replayed
+        for name in tool_names:
+            tool = available_tools.get(name)
+            if tool is None or not tool.cache_policy.enabled:
+                return False
+        return True
+
+    async def create_completion(
+            self,
+            writer: Optional[DiscordStreamWriter],
+            context: RequestContext,
+            available_tools: ToolTier,
+            **kwargs) -> chat.ChatCompletionMessage:
+        cache_key = self.response_cache_key(available_tools, kwargs)
+        if cache_key is not None:
+            assert self.response_cache is not None
+            cached = await self.response_cache.get(cache_key, "openai", kwargs["model"])
+            if cached is not None:
+                completion_message = chat.ChatCompletionMessage.model_validate_json(cached)
+                if writer is not None and completion_message.content:
+                    await writer.write(completion_message.content)
+                return completion_message
+
+        # a stream can only be retried while nothing has reached discord yet, and is never hedged
+        written = writer.written if writer is not None else 0
+        served_by : Optional[str] = None
+        started = time.monotonic()
+
+        async def attempt(model: str) -> chat.ChatCompletionMessage:
+            nonlocal served_by
+            served_by = model
+            # the router's latency and error rate come from every attempt that ran to the end
+            tracked = self.router.track(model) if self.router is not None else contextlib.nullcontext()
+            with tracked, Metrics.span("completion", provider="openai", model=model, stream=writer is not None, tool_round=context.tool_rounds) as span:
+                if writer is None:
+                    chat_completion = await self.client.chat.completions.create(**{ **kwargs, "model": model })
+                    if chat_completion.usage is not None:
+                        span.set("input_tokens", chat_completion.usage.prompt_tokens)
+                        span.set("output_tokens", chat_completion.usage.completion_tokens)
+                        self.record_usage(context, model, chat_completion.usage)
+                    return chat_completion.choices[0].message
+
+                return await self.stream_completion(writer, context, span, **{ **kwargs, "model": model })
+
+        completion_message = await self.resilience.call(
+            kwargs["model"],
+            attempt,
+            hedge=writer is None,
+            can_retry=lambda: writer is None or writer.written == written)
+
+        # a fallback model's reply is not what the requested model would have said
+        tool_names = [name for name, _ in context.tool_timings] + [t.function.name for t in completion_message.tool_calls or []]
+        if cache_key is not None and served_by == kwargs["model"] and self.only_cacheable_tools(tool_names, available_tools):
+            assert self.response_cache is not None
+            self.response_cache.put(cache_key, completion_message.model_dump_json(), time.monotonic() - started, context.conversation_ids)
+
+        return completion_message
+
+    def record_usage(self, context: RequestContext, model: str, usage: Any):
+        if self.conversation_store is not None:
+            self.conversation_store.record_usage(context.message_id, "openai", model, usage.prompt_tokens, usage.completion_tokens)
+
+    async def stream_completion(
+            self,
+            writer: DiscordStreamWriter,
+            context: RequestContext,
+            span: Any,
+            **kwargs) -> chat.ChatCompletionMessage:
+        content = ""
+        tool_calls : Dict[int, Dict[str, Any]] = {}
+
+        stream = await self.client.chat.completions.create(stream=True, stream_options={ "include_usage": True }, **kwargs)
+        async for chunk in stream:
+            #the usage arrives on a final chunk with no choices
+            if chunk.usage is not None:
+                span.set("input_tokens", chunk.usage.prompt_tokens)
+                span.set("output_tokens", chunk.usage.completion_tokens)
+                self.record_usage(context, kwargs["model"], chunk.usage)
+
+            if not chunk.choices:
+                continue
+
+            delta = chunk.choices[0].delta
+            if delta.content:
+                content += delta.content
+                await writer.write(delta.content)
+
+            #tool calls arrive in fragments, stitch them back together by index
+            for tool_call_delta in delta.tool_calls or []:
+                tool_call = tool_calls.setdefault(tool_call_delta.index, { "id": "", "type": "function", "function": { "name": "", "arguments": "" } })
+                if tool_call_delta.id:
+                    tool_call["id"] = tool_call_delta.id
+                if tool_call_delta.function is not None:
+                    tool_call["function"]["name"] += tool_call_delta.function.name or ""
+                    tool_call["function"]["arguments"] += tool_call_delta.function.arguments or ""
+
+        return chat.ChatCompletionMessage.model_validate({
+            "role": "assistant",
+            "content": content or None,
+            "tool_calls": [tool_calls[i] for i in sorted(tool_calls)] or None })
+
+    async def run_tool_call(
+            self,
+            tool_call: chat.ChatCompletionMessageToolCall,
+            available_tools: ToolTier,
+            context: RequestContext,
+            discord_message: discord.Message,
+            semaphore: asyncio.Semaphore,
+            reactions: List[asyncio.Task]) -> chat.ChatCompletionToolMessageParam:
+        #log the tool call. i still think this may need to go into a db for full conversation history
+        log_message = f'{{ "id" = "{tool_call.id}", "name" = "{tool_call.function.name}", "args" = {tool_call.function.arguments}}}'            
+        logging.info(log_message)                
+
+        tool = available_tools.get(tool_call.function.name)
+        elapsed : Optional[float] = None
+        is_error = True
+        if tool is not None:
+            reactions.append(asyncio.create_task(discord_message.add_reaction(tool.emoji)))
+            try:
+                async with semaphore:
+                    started = time.monotonic()
+                    try:
+                        tool_result = await self.tool_executor.run(
+                            tool,
+                            tool_call.function.name,
+                            tool_call.function.arguments,
+                            context,
+                            provider="openai",
+                            model=context.model,
+                            tool_round=context.tool_rounds)
+                        is_error = False
+                    finally:
+                        elapsed = time.monotonic() - started
+                        context.record_tool_timing(tool_call.function.name, elapsed)
+            except asyncio.TimeoutError:
+                timeout = self.tool_executor.timeout_for(tool)
+                logging.error(f"Tool {tool_call.function.name} timed out after {timeout}s.")
+                reactions.append(asyncio.create_task(discord_message.add_reaction(emojis.HAL9000)))
+                tool_result = json.dumps({ "error" : f"Tool {tool_call.function.name} timed out after {timeout} seconds" })
+            except Exception as e:
+                logging.exception(e)
+                reactions.append(asyncio.create_task(discord_message.add_reaction(emojis.HAL9000)))
+                tool_result = json.dumps({ "error" : str(e) })
+        else:
+            tool_result = f'{{ "status": "error", "message": "Unknown tool {tool_call.function.name}" }}'                   
+            reactions.append(asyncio.create_task(discord_message.add_reaction(emojis.HAL9000)))
+    
+        tool_response = openai_utilities.get_function_message(                        
+            tool_call_id=tool_call.id,
+            name=tool_call.function.name,
+            content=tool_result)
+
+        log_message = f'{{ "id" = "{tool_call.id}", "content" = {tool_response["content"]}}}'
+
+        logging.info(log_message)                
+
+        if self.conversation_store is not None:
+            self.conversation_store.record_tool_call(tool_call.id, context.message_id, tool_call.function.name, tool_call.function.arguments, tool_result, is_error, elapsed)
+
+        return tool_response
 
     async def send_response(
             self, 
             content: str, 
             message: discord.Message, 
-            is_edit: bool):
-        chunks = [content[i:i + DISCORD_MAX_MESSAGE_LENGTH] for i in range(0, len(content), DISCORD_MAX_MESSAGE_LENGTH)]
-        start = 0
-        if is_edit:
-            message = await message.edit(content=chunks[start])
-            start += 1
-        
-        for i in range(start, len(chunks)):
-            message = await message.reply(content = chunks[i])
-            await discord_utilities.add_model_reactions(self.model, message)
+            is_edit: bool,
+            model: Optional[str] = None):
+        if model is None:
+            model = self.model
+
+        with Metrics.span("send_response", provider="openai", model=model):
+            # split at line and word breaks, without cutting code blocks in half
+            chunks = split_message(content) or [content]
+            for i, chunk in enumerate(chunks):
+                if i == 0 and is_edit:
+                    message = await with_backoff(functools.partial(message.edit, content=chunk))
+                else:
+                    message = await with_backoff(functools.partial(message.reply, content=chunk))
+                await self.remember_reply(message)
+
+            # one set of reactions on the last new message, nobody waits for them
+            if len(chunks) > (1 if is_edit else 0):
+                in_background(discord_utilities.add_model_reactions(model, message))
@@ -0,0 +1,54 @@
+from dataclasses import dataclass, field
+import asyncio
+import time
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import discord
+
+from MessageHandlerProtocol import MessageHandlerProtocol
+
+# everything a single conversation turn owns lives here rather than on the shared handler,
+# so one handler instance can serve any number of overlapping conversations
+@dataclass
+class RequestContext(MessageHandlerProtocol):
+    author : Optional[Union[discord.User, discord.Member]] = None
+    channel : Optional[discord.abc.Messageable] = None
+    # the discord message being answered
+    message_id : Optional[int] = None
+    # every discord message the prompt was built from, a cached reply is forgotten along with any of them
+    conversation_ids : Tuple[int, ...] = ()
+    # the model answering this turn, it can differ from the handler's when a router picks it
+    model : Optional[str] = None
+
+    files : List[discord.File] = field(default_factory=list)
+    tool_state : Dict[str, Any] = field(default_factory=dict)
+    tool_timings : List[Tuple[str, float]] = field(default_factory=list)
+    tool_rounds : int = 0
+
+    started_at : float = field(default_factory=time.monotonic)
+
+    # when set, files are attached to this message as soon as a tool produces them
+    attachment_message : Optional[discord.Message] = None
+    attached_count : int = 0
+    attach_lock : asyncio.Lock = field(default_factory=asyncio.Lock)
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started_at
+
+    async def add_file(self, file: discord.File):
+        self.files.append(file)
+        await self.attach_pending_files()
+
+    async def attach_pending_files(self):
+        if self.attachment_message is None:
+            return
+
+        # add_files re-sends the attachments the message already has, so edits must not overlap
+        async with self.attach_lock:
+            while self.attached_count < len(self.files):
+                file = self.files[self.attached_count]
+                self.attachment_message = await self.attachment_message.add_files(file)
+                self.attached_count += 1
+
+    def record_tool_timing(self, tool_name: str, seconds: float):
+        self.tool_timings.append((tool_name, seconds))
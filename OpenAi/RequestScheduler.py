@@ -0,0 +1,219 @@
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+import asyncio
+import itertools
+import logging
+import time
+from typing import AsyncIterator, Dict, List, Optional
+
+from config import CONFIG
+
+ADMIN_PRIORITY = 0
+STANDARD_PRIORITY = 1
+
+# requests per second and burst size for each bucket
+USER_RATE = 0.2
+USER_BURST = 3
+CHANNEL_RATE = 1.0
+CHANNEL_BURST = 5
+PROVIDER_RATE = 5.0
+PROVIDER_BURST = 10
+
+MAX_IN_FLIGHT = 16
+MAX_QUEUE_DEPTH = 100
+MAX_QUEUE_WAIT_SECONDS = 60.0
+
+MAX_IDLE_BUCKETS = 10_000
+
+class SchedulerRejectedError(Exception):
+    pass
+
+@dataclass
+class TokenBucket:
+    rate : float
+    capacity : float
+    tokens : float = -1.0
+    updated_at : float = field(default_factory=time.monotonic)
+
+    def __post_init__(self):
+        if self.tokens < 0:
+            self.tokens = self.capacity
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_time(self, now: float) -> float:
+        self.refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+@dataclass(order=True)
+class Waiter:
+    priority : int
+    sequence : int
+    user_id : int = field(compare=False)
+    channel_id : int = field(compare=False)
+    enqueued_at : float = field(compare=False)
+    future : "asyncio.Future[None]" = field(compare=False)
+
+@dataclass
+class SchedulerMetrics:
+    queue_depth : int = 0
+    peak_queue_depth : int = 0
+    in_flight : int = 0
+    admitted : int = 0
+    rejected : int = 0
+    total_wait : float = 0.0
+    max_wait : float = 0.0
+
+@dataclass
+class RequestScheduler:
+    name : str = "provider"
+
+    user_rate : float = USER_RATE
+    user_burst : float = USER_BURST
+    channel_rate : float = CHANNEL_RATE
+    channel_burst : float = CHANNEL_BURST
+    provider_rate : float = PROVIDER_RATE
+    provider_burst : float = PROVIDER_BURST
+
+    max_in_flight : int = MAX_IN_FLIGHT
+    max_queue_depth : int = MAX_QUEUE_DEPTH
+    max_wait : float = MAX_QUEUE_WAIT_SECONDS
+
+    metrics : SchedulerMetrics = field(default_factory=SchedulerMetrics)
+
+    user_buckets : Dict[int, TokenBucket] = field(default_factory=dict)
+    channel_buckets : Dict[int, TokenBucket] = field(default_factory=dict)
+    provider_bucket : Optional[TokenBucket] = None
+
+    waiting : List[Waiter] = field(default_factory=list)
+    sequence : "itertools.count[int]" = field(default_factory=itertools.count)
+    timer : Optional[asyncio.TimerHandle] = None
+
+    def __post_init__(self):
+        if self.provider_bucket is None:
+            self.provider_bucket = TokenBucket(self.provider_rate, self.provider_burst)
+
+    @staticmethod
+    def priority_for(user_id: int) -> int:
+        return ADMIN_PRIORITY if user_id == CONFIG.admin_user_id else STANDARD_PRIORITY
+
+    def get_bucket(self, buckets: Dict[int, TokenBucket], key: int, rate: float, burst: float) -> TokenBucket:
+        bucket = buckets.get(key)
+        if bucket is None:
+            # a full bucket carries no state, so idle ones can go whenever the map gets large
+            if len(buckets) >= MAX_IDLE_BUCKETS:
+                now = time.monotonic()
+                for k in [k for k, b in buckets.items() if b.wait_time(now) == 0 and b.tokens >= b.capacity]:
+                    del buckets[k]
+            bucket = buckets[key] = TokenBucket(rate, burst)
+        return bucket
+
+    def buckets_for(self, waiter: Waiter) -> List[TokenBucket]:
+        assert self.provider_bucket is not None
+        buckets = [
+            self.get_bucket(self.channel_buckets, waiter.channel_id, self.channel_rate, self.channel_burst),
+            self.provider_bucket]
+        # admins are not throttled per user
+        if waiter.priority != ADMIN_PRIORITY:
+            buckets.append(self.get_bucket(self.user_buckets, waiter.user_id, self.user_rate, self.user_burst))
+        return buckets
+
+    def dispatch(self):
+        now = time.monotonic()
+        next_check : Optional[float] = None
+
+        # highest priority first, oldest first within a priority, skipping anyone whose own buckets are empty
+        for waiter in sorted(self.waiting):
+            if self.metrics.in_flight >= self.max_in_flight:
+                break
+
+            if waiter.future.done():
+                self.waiting.remove(waiter)
+                continue
+
+            if now - waiter.enqueued_at > self.max_wait:
+                self.waiting.remove(waiter)
+                self.metrics.rejected += 1
+                waiter.future.set_exception(SchedulerRejectedError(f"Timed out after {self.max_wait}s in the {self.name} queue"))
+                continue
+
+            buckets = self.buckets_for(waiter)
+            wait = max(b.wait_time(now) for b in buckets)
+            if wait > 0:
+                next_check = wait if next_check is None else min(next_check, wait)
+                continue
+
+            for bucket in buckets:
+                bucket.take()
+
+            self.waiting.remove(waiter)
+            self.metrics.in_flight += 1
+            self.metrics.admitted += 1
+            self.metrics.total_wait += now - waiter.enqueued_at
+            self.metrics.max_wait = max(self.metrics.max_wait, now - waiter.enqueued_at)
+            waiter.future.set_result(None)
+
+        self.metrics.queue_depth = len(self.waiting)
+
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        if self.waiting and self.metrics.in_flight < self.max_in_flight:
+            # come back when the soonest bucket refills, or when the oldest waiter would time out
+            oldest = min(w.enqueued_at for w in self.waiting)
+            delay = max(0.0, oldest + self.max_wait - now)
+            if next_check is not None:
+                delay = min(delay, next_check)
+            self.timer = asyncio.get_running_loop().call_later(delay + 0.001, self.dispatch)
+
+    async def acquire(self, user_id: int, channel_id: int, priority: Optional[int] = None):
+        if len(self.waiting) >= self.max_queue_depth:
+            self.metrics.rejected += 1
+            raise SchedulerRejectedError(f"The {self.name} queue is full ({len(self.waiting)} waiting)")
+
+        waiter = Waiter(
+            priority=self.priority_for(user_id) if priority is None else priority,
+            sequence=next(self.sequence),
+            user_id=user_id,
+            channel_id=channel_id,
+            enqueued_at=time.monotonic(),
+            future=asyncio.get_running_loop().create_future())
+
+        self.waiting.append(waiter)
+        self.metrics.queue_depth = len(self.waiting)
+        self.metrics.peak_queue_depth = max(self.metrics.peak_queue_depth, len(self.waiting))
+
+        self.dispatch()
+
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter in self.waiting:
+                self.waiting.remove(waiter)
+                self.metrics.queue_depth = len(self.waiting)
+            elif waiter.future.done() and not waiter.future.cancelled() and waiter.future.exception() is None:
+                # the slot was granted just as we were cancelled, hand it straight back
+                self.release()
+            raise
+
+    def release(self):
+        self.metrics.in_flight -= 1
+        self.dispatch()
+
+    @asynccontextmanager
+    async def slot(self, user_id: int, channel_id: int, priority: Optional[int] = None) -> AsyncIterator[None]:
+        await self.acquire(user_id, channel_id, priority)
+
+        if self.metrics.queue_depth:
+            logging.info(f"{self.name} scheduler: {self.metrics.queue_depth} queued, {self.metrics.in_flight} in flight, {self.metrics.rejected} rejected.")
+
+        try:
+            yield
+        finally:
+            self.release()
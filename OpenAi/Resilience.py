@@ -0,0 +1,235 @@
+from dataclasses import dataclass, field
+import asyncio
+import email.utils
+import logging
+import random
+import time
+from typing import Awaitable, Callable, Dict, Optional, TypeVar
+
+import Metrics
+
+T = TypeVar("T")
+
+MAX_ATTEMPTS = 3
+BASE_DELAY_SECONDS = 0.5
+MAX_DELAY_SECONDS = 20.0
+# never sleep longer than this on a provider's say-so, the user is still waiting
+MAX_RETRY_AFTER_SECONDS = 30.0
+
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_RESET_SECONDS = 30.0
+
+# both sdks raise errors carrying the http status, the names cover the failures that never got one
+RETRYABLE_STATUS_CODES = frozenset({ 408, 409, 429, 500, 502, 503, 504, 529 })
+RETRYABLE_ERROR_NAMES = frozenset({ "APIConnectionError", "APITimeoutError", "TimeoutError" })
+# the model itself is gone or not allowed, retrying it is pointless but another model may work
+MODEL_ERROR_STATUS_CODES = frozenset({ 403, 404 })
+
+def status_code(e: BaseException) -> Optional[int]:
+    status = getattr(e, "status_code", None)
+    return status if isinstance(status, int) else None
+
+def is_retryable(e: BaseException) -> bool:
+    if status_code(e) in RETRYABLE_STATUS_CODES:
+        return True
+    return any(c.__name__ in RETRYABLE_ERROR_NAMES for c in type(e).__mro__)
+
+def is_model_error(e: BaseException) -> bool:
+    return status_code(e) in MODEL_ERROR_STATUS_CODES
+
+def is_provider_failure(e: BaseException) -> bool:
+    # a bad request, a prompt that is too long or a refused one is the caller's problem, not the model's
+    status = status_code(e)
+    return is_retryable(e) or is_model_error(e) or (status is not None and status >= 500)
+
+def retry_after(e: BaseException) -> Optional[float]:
+    response = getattr(e, "response", None)
+    headers = getattr(response, "headers", None)
+    if headers is None:
+        return None
+
+    value = headers.get("retry-after-ms")
+    if value is not None:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+
+    value = headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+
+    # it may also be an http date
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+@dataclass
+class CircuitBreaker:
+    failure_threshold : int = BREAKER_FAILURE_THRESHOLD
+    reset_timeout : float = BREAKER_RESET_SECONDS
+
+    failures : int = 0
+    opened_at : Optional[float] = None
+    trial_in_flight : bool = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        # once the timeout has passed a single request is let through to test the water
+        if state == "half_open" and not self.trial_in_flight:
+            self.trial_in_flight = True
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+
+    def record_failure(self, trip: bool = False) -> bool:
+        self.failures += 1
+        self.trial_in_flight = False
+        if trip or self.failures >= self.failure_threshold or self.opened_at is not None:
+            opened = self.opened_at is None
+            self.opened_at = time.monotonic()
+            return opened
+        return False
+
+@dataclass
+class Resilience:
+    name : str = "provider"
+    # used for a single request when the requested model is failing, the handler's own model never changes
+    fallback_model : Optional[str] = None
+
+    max_attempts : int = MAX_ATTEMPTS
+    base_delay : float = BASE_DELAY_SECONDS
+    max_delay : float = MAX_DELAY_SECONDS
+    max_retry_after : float = MAX_RETRY_AFTER_SECONDS
+
+    # send a second identical request if the first is slower than this, None turns hedging off
+    hedge_after : Optional[float] = None
+
+    breaker_failure_threshold : int = BREAKER_FAILURE_THRESHOLD
+    breaker_reset_timeout : float = BREAKER_RESET_SECONDS
+
+    breakers : Dict[str, CircuitBreaker] = field(default_factory=dict)
+
+    def breaker_for(self, model: str) -> CircuitBreaker:
+        breaker = self.breakers.get(model)
+        if breaker is None:
+            breaker = self.breakers[model] = CircuitBreaker(self.breaker_failure_threshold, self.breaker_reset_timeout)
+        return breaker
+
+    def delay_for(self, attempt: int, e: BaseException) -> float:
+        # full jitter keeps a burst of failed requests from coming back in lockstep
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        hinted = retry_after(e)
+        if hinted is not None:
+            delay = max(delay, min(hinted, self.max_retry_after))
+        return delay
+
+    def choose_model(self, model: str) -> str:
+        if self.breaker_for(model).allow():
+            return model
+        if self.fallback_model is not None and self.fallback_model != model and self.breaker_for(self.fallback_model).allow():
+            logging.warning(f"{self.name} circuit for {model} is open, using {self.fallback_model} for this request.")
+            Metrics.get_sink().increment("provider_fallbacks_total", provider=self.name, model=model)
+            return self.fallback_model
+        # nothing better to try, let the request find out for itself
+        return model
+
+    async def hedged(self, call: Callable[[], Awaitable[T]], model: str) -> T:
+        assert self.hedge_after is not None
+
+        pending = { asyncio.ensure_future(call()) }
+        try:
+            done, pending = await asyncio.wait(pending, timeout=self.hedge_after)
+            if done:
+                return done.pop().result()
+
+            logging.info(f"{self.name} request to {model} is slower than {self.hedge_after}s, hedging.")
+            Metrics.get_sink().increment("provider_hedges_total", provider=self.name, model=model)
+
+            pending.add(asyncio.ensure_future(call()))
+            error : Optional[BaseException] = None
+            # the first success wins, a failure only counts once both have failed
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            assert error is not None
+            raise error
+        finally:
+            # whatever ends this, a result, an error or the caller being cancelled, nothing is left running
+            for task in pending:
+                task.cancel()
+
+    async def call(
+            self,
+            model: str,
+            attempt: Callable[[str], Awaitable[T]],
+            hedge: bool = True,
+            can_retry: Optional[Callable[[], bool]] = None) -> T:
+        current = self.choose_model(model)
+
+        for attempt_number in range(self.max_attempts):
+            breaker = self.breaker_for(current)
+            try:
+                if hedge and self.hedge_after is not None:
+                    result = await self.hedged(lambda: attempt(current), current)
+                else:
+                    result = await attempt(current)
+                breaker.record_success()
+                return result
+            except asyncio.CancelledError:
+                breaker.trial_in_flight = False
+                raise
+            except Exception as e:
+                if not is_provider_failure(e):
+                    # the provider answered, a request it refused says nothing about its health
+                    breaker.trial_in_flight = False
+                    raise
+
+                model_error = is_model_error(e)
+                if breaker.record_failure(trip=model_error):
+                    logging.warning(f"{self.name} circuit for {current} opened after {breaker.failures} failures.")
+                    Metrics.get_sink().increment("provider_circuit_opened_total", provider=self.name, model=current)
+
+                last_attempt = attempt_number == self.max_attempts - 1
+                if last_attempt or not (model_error or is_retryable(e)) or (can_retry is not None and not can_retry()):
+                    raise
+
+                if model_error:
+                    if self.fallback_model is None or self.fallback_model == current:
+                        raise
+                    logging.warning(f"{self.name} model {current} is unavailable ({e}), using {self.fallback_model} for this request.")
+                    Metrics.get_sink().increment("provider_fallbacks_total", provider=self.name, model=current)
+                    current = self.fallback_model
+                    continue
+
+                delay = self.delay_for(attempt_number, e)
+                logging.warning(f"{self.name} request to {current} failed ({type(e).__name__}: {e}), retrying in {delay:.2f}s.")
+                Metrics.get_sink().increment("provider_retries_total", provider=self.name, model=current)
+                await asyncio.sleep(delay)
+
+                if not breaker.allow():
+                    current = self.choose_model(model)
+
+        raise AssertionError("unreachable")
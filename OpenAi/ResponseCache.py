@@ -0,0 +1,240 @@
+from collections import OrderedDict
+from dataclasses import dataclass, field
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Awaitable, Dict, FrozenSet, Iterable, Optional, Set, Tuple
+
+import Metrics
+
+RESPONSE_CACHE_DB_PATH = os.path.join(".cache", "responses.sqlite3")
+RESPONSE_CACHE_TTL_SECONDS = 60 * 60
+MAX_CACHED_RESPONSES = 1_000
+
+# how often the running hit rate is written to the log
+LOG_EVERY_LOOKUPS = 50
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    payload TEXT NOT NULL,
+    latency REAL NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_expires_at ON responses (expires_at);
+CREATE TABLE IF NOT EXISTS response_messages (
+    message_id INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    PRIMARY KEY (message_id, key)
+);
+"""
+
+SELECT_RESPONSE = "SELECT payload, latency, expires_at FROM responses WHERE key = ? AND expires_at >= ?"
+INSERT_RESPONSE = "INSERT OR REPLACE INTO responses (key, payload, latency, expires_at) VALUES (?, ?, ?, ?)"
+DELETE_EXPIRED = "DELETE FROM responses WHERE expires_at < ?"
+
+SELECT_SOURCES = "SELECT message_id FROM response_messages WHERE key = ?"
+INSERT_SOURCE = "INSERT OR IGNORE INTO response_messages (message_id, key) VALUES (?, ?)"
+DELETE_MESSAGE_RESPONSES = "DELETE FROM responses WHERE key IN (SELECT key FROM response_messages WHERE message_id = ?)"
+DELETE_ORPHANED_SOURCES = "DELETE FROM response_messages WHERE key NOT IN (SELECT key FROM responses)"
+
+def is_deterministic(temperature: Optional[float]) -> bool:
+    # at any other temperature a second answer is supposed to differ from the first
+    return temperature is not None and temperature == 0
+
+def to_jsonable(value: Any) -> Any:
+    # sdk objects, like an assistant message fed back with its tool calls, hash by their content
+    if hasattr(value, "model_dump"):
+        return value.model_dump(mode="json", exclude_none=True)
+    raise TypeError(f"{type(value).__name__} can't be part of a response cache key")
+
+# exact match only: the same model, prompt, tools, settings and conversation get the same reply
+@dataclass
+class ResponseCache:
+    ttl : float = RESPONSE_CACHE_TTL_SECONDS
+    max_entries : int = MAX_CACHED_RESPONSES
+    # also keep responses in sqlite, RESPONSE_CACHE_DB_PATH say, so they survive a restart; None keeps them in memory only
+    path : Optional[str] = None
+
+    entries : "OrderedDict[str, Tuple[float, float, str]]" = field(default_factory=OrderedDict)
+    # the discord messages each response was built from, forgetting any of them forgets the response
+    sources : Dict[str, FrozenSet[int]] = field(default_factory=dict)
+    writes : Set["asyncio.Task[None]"] = field(default_factory=set)
+
+    connection : Optional[sqlite3.Connection] = None
+    lock : threading.Lock = field(default_factory=threading.Lock)
+
+    hits : int = 0
+    disk_hits : int = 0
+    misses : int = 0
+    saved_seconds : float = 0.0
+
+    @staticmethod
+    def key(provider: str, model: str, system: Any, tools: Any, temperature: Optional[float], messages: Any, **settings: Any) -> Optional[str]:
+        request = {
+            "provider": provider,
+            "model": model,
+            "system": system,
+            "tools": tools,
+            "temperature": float(temperature) if temperature is not None else None,
+            "messages": messages,
+            "settings": settings }
+        try:
+            # sorted and compact, so key order and whitespace never split one request into two entries
+            raw = json.dumps(request, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=to_jsonable)
+        except (TypeError, ValueError):
+            return None
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def connect(self) -> sqlite3.Connection:
+        assert self.path is not None
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        connection = sqlite3.connect(self.path, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.executescript(SCHEMA)
+        return connection
+
+    def read(self, key: str) -> Optional[Tuple[Tuple[float, float, str], FrozenSet[int]]]:
+        with self.lock:
+            if self.connection is None:
+                if self.path is None or not os.path.exists(self.path):
+                    return None
+                self.connection = self.connect()
+            row = self.connection.execute(SELECT_RESPONSE, (key, time.time())).fetchone()
+            if row is None:
+                return None
+            sources = frozenset(r[0] for r in self.connection.execute(SELECT_SOURCES, (key,)))
+        payload, latency, expires_at = row
+        return (expires_at, latency, payload), sources
+
+    def write(self, key: str, expires_at: float, latency: float, payload: str, sources: FrozenSet[int]):
+        with self.lock:
+            if self.connection is None:
+                self.connection = self.connect()
+            with self.connection:
+                self.connection.execute(INSERT_RESPONSE, (key, payload, latency, expires_at))
+                self.connection.executemany(INSERT_SOURCE, [(message_id, key) for message_id in sources])
+                self.connection.execute(DELETE_EXPIRED, (time.time(),))
+                self.connection.execute(DELETE_ORPHANED_SOURCES)
+
+    def delete_message(self, message_id: int):
+        with self.lock:
+            if self.connection is None:
+                if self.path is None or not os.path.exists(self.path):
+                    return
+                self.connection = self.connect()
+            with self.connection:
+                self.connection.execute(DELETE_MESSAGE_RESPONSES, (message_id,))
+                self.connection.execute(DELETE_ORPHANED_SOURCES)
+
+    def get_memory(self, key: str) -> Optional[Tuple[float, float, str]]:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.time():
+            self.drop_memory(key)
+            return None
+        self.entries.move_to_end(key)
+        return entry
+
+    def put_memory(self, key: str, entry: Tuple[float, float, str], sources: FrozenSet[int]):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        self.sources[key] = sources
+        while len(self.entries) > self.max_entries:
+            evicted, _ = self.entries.popitem(last=False)
+            self.sources.pop(evicted, None)
+
+    def drop_memory(self, key: str):
+        self.entries.pop(key, None)
+        self.sources.pop(key, None)
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.disk_hits + self.misses
+        return (lookups - self.misses) / lookups if lookups else 0.0
+
+    def record(self, provider: str, model: str, outcome: str, saved: float = 0.0):
+        sink = Metrics.get_sink()
+        sink.increment("response_cache_total", provider=provider, model=model, outcome=outcome)
+        if saved:
+            self.saved_seconds += saved
+            sink.increment("response_cache_saved_seconds_total", saved, provider=provider, model=model)
+
+        lookups = self.hits + self.disk_hits + self.misses
+        if lookups % LOG_EVERY_LOOKUPS == 0:
+            logging.info(f"Response cache: {self.hit_rate:.0%} hit rate over {lookups} lookups ({self.hits} memory, {self.disk_hits} disk, {self.misses} misses), {self.saved_seconds:.1f}s saved, {len(self.entries)} entries.")
+
+    async def get(self, key: str, provider: str, model: str) -> Optional[str]:
+        entry = self.get_memory(key)
+        if entry is not None:
+            self.hits += 1
+            self.record(provider, model, "hit", entry[1])
+            return entry[2]
+
+        if self.path is not None:
+            try:
+                stored = await asyncio.to_thread(self.read, key)
+            except sqlite3.Error as e:
+                logging.exception(e)
+                stored = None
+            if stored is not None:
+                entry, sources = stored
+                self.put_memory(key, entry, sources)
+                self.disk_hits += 1
+                self.record(provider, model, "disk_hit", entry[1])
+                return entry[2]
+
+        self.misses += 1
+        self.record(provider, model, "miss")
+        return None
+
+    def put(self, key: str, payload: str, latency: float, message_ids: Iterable[int] = ()):
+        # latency is what the provider took, it is what a later hit saves
+        entry = (time.time() + self.ttl, latency, payload)
+        sources = frozenset(message_ids)
+        self.put_memory(key, entry, sources)
+
+        if self.path is not None:
+            # the reply doesn't wait for the disk
+            self.in_background(self.write_to_disk(key, entry, sources))
+
+    def forget_message(self, message_id: int):
+        # an edited or deleted message takes every response built from it along
+        for key in [k for k, ids in self.sources.items() if message_id in ids]:
+            self.drop_memory(key)
+
+        if self.path is not None:
+            self.in_background(self.delete_from_disk(message_id))
+
+    def in_background(self, coroutine: Awaitable[None]):
+        task = asyncio.ensure_future(coroutine)
+        self.writes.add(task)
+        task.add_done_callback(self.writes.discard)
+
+    async def write_to_disk(self, key: str, entry: Tuple[float, float, str], sources: FrozenSet[int]):
+        try:
+            await asyncio.to_thread(self.write, key, *entry, sources)
+        except (OSError, sqlite3.Error) as e:
+            logging.exception(e)
+
+    async def delete_from_disk(self, message_id: int):
+        try:
+            await asyncio.to_thread(self.delete_message, message_id)
+        except (OSError, sqlite3.Error) as e:
+            logging.exception(e)
+
+    async def close(self):
+        if self.writes:
+            await asyncio.gather(*self.writes, return_exceptions=True)
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
@@ -0,0 +1,26 @@
+from dataclasses import dataclass, field
+import importlib
+import logging
+import time
+from typing import Any, Dict, List, Union
+
+from tools.toolbase import ToolBase
+
+# a tool named by where it lives, its module is only imported when the tool is first needed
+@dataclass(frozen=True)
+class LazyTool:
+    module : str
+    class_name : str
+    kwargs : Dict[str, Any] = field(default_factory=dict, hash=False)
+
+    def load(self) -> ToolBase:
+        started = time.perf_counter()
+        tool_class = getattr(importlib.import_module(self.module), self.class_name)
+        tool = tool_class(**self.kwargs)
+        logging.info(f"Loaded tool {self.module}.{self.class_name} in {(time.perf_counter() - started) * 1000:.1f}ms.")
+        return tool
+
+ToolSource = Union[ToolBase, LazyTool]
+
+def load_tools(sources: List[ToolSource]) -> List[ToolBase]:
+    return [s.load() if isinstance(s, LazyTool) else s for s in sources]
@@ -0,0 +1,192 @@
+import argparse
+import asyncio
+from collections import defaultdict
+from dataclasses import dataclass, field
+import functools
+import inspect
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+from typing import Callable, Dict, List, Tuple
+
+import utilities.discord as discord_utilities
+
+from BenchmarkFakes import FakeCounters, FakeLatency, FakeOpenAiClient, FakeTool, FakeToolScript, make_reply_chain, make_thread
+from OpenAiMessageHandler import OpenAiMessageHandler
+from RequestScheduler import RequestScheduler
+
+# run in a fresh interpreter each time, so nothing is already imported or warm
+STARTUP_PROBE = """
+import json, resource, sys, time
+started = time.perf_counter()
+import OpenAiMessageHandler
+from ToolLoader import LazyTool
+imported = time.perf_counter()
+handler = OpenAiMessageHandler.OpenAiMessageHandler(standard_tools=[LazyTool("tools.rng", "RngTool")], admin_tools=[])
+constructed = time.perf_counter()
+print(json.dumps({
+    "import_ms": (imported - started) * 1000,
+    "construct_ms": (constructed - imported) * 1000,
+    "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    "modules": len(sys.modules) }))
+"""
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(p / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+@dataclass
+class StageTimings:
+    samples : Dict[str, List[float]] = field(default_factory=lambda: defaultdict(list))
+
+    def record(self, stage: str, seconds: float):
+        self.samples[stage].append(seconds)
+
+    def wrap(self, stage: str, fn: Callable) -> Callable:
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def timed_async(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await fn(*args, **kwargs)
+                finally:
+                    self.record(stage, time.perf_counter() - started)
+            return timed_async
+
+        @functools.wraps(fn)
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.record(stage, time.perf_counter() - started)
+        return timed
+
+    def report(self) -> str:
+        lines = [f"{'stage':<24}{'n':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"]
+        for stage, values in sorted(self.samples.items()):
+            lines.append(f"{stage:<24}{len(values):>8}{percentile(values, 50) * 1000:>10.1f}{percentile(values, 95) * 1000:>10.1f}{percentile(values, 99) * 1000:>10.1f}")
+        return "\n".join(lines)
+
+def build_handler(args: argparse.Namespace, timings: StageTimings, latency: FakeLatency) -> OpenAiMessageHandler:
+    tools = [FakeTool(name=f"fake_tool_{i}", latency=latency.tool) for i in range(args.tools)]
+    for tool in tools:
+        tool.get_tool_result = timings.wrap("tool", tool.get_tool_result)  # type: ignore
+
+    # nothing is throttled unless asked, the point is to measure the handler rather than the limits
+    scheduler = RequestScheduler(name="benchmark") if args.throttle else RequestScheduler(
+        name="benchmark", user_rate=1e9, user_burst=1e9, channel_rate=1e9, channel_burst=1e9,
+        provider_rate=1e9, provider_burst=1e9, max_in_flight=1_000_000, max_queue_depth=1_000_000)
+
+    handler = OpenAiMessageHandler(standard_tools=tools, admin_tools=[], stream=args.stream, scheduler=scheduler)  # type: ignore
+    handler.openai_client = FakeOpenAiClient(latency, FakeToolScript([[t.name for t in tools]] * args.tool_rounds))  # type: ignore
+
+    handler.get_conversation = timings.wrap("get_conversation", handler.get_conversation)  # type: ignore
+    handler.create_completion = timings.wrap("completion", handler.create_completion)  # type: ignore
+    handler.send_response = timings.wrap("send_response", handler.send_response)  # type: ignore
+    return handler
+
+async def run_level(args: argparse.Namespace, concurrency: int) -> Tuple[OpenAiMessageHandler, StageTimings]:
+    latency = FakeLatency(
+        fetch=args.discord_latency, reply=args.discord_latency, edit=args.discord_latency, reaction=args.discord_latency,
+        first_token=args.first_token, per_token=args.per_token, tokens=args.tokens, tool=args.tool_latency)
+
+    timings = StageTimings()
+    handler = build_handler(args, timings, latency)
+
+    convert = discord_utilities.discord_message_to_openai_chat_completion_param
+    discord_utilities.discord_message_to_openai_chat_completion_param = timings.wrap("convert_message", convert)
+
+    # messages spread over long running threads all reply to the same history, which is what the conversation cache is for,
+    # with --threads 0 every message starts a conversation of its own
+    threads = [
+        make_thread(args.depth - 1, user_id=20_000 + t, channel_id=t % args.channels, latency=latency)
+        for t in range(args.threads if args.depth > 1 else 0)]
+
+    queue : "asyncio.Queue[int]" = asyncio.Queue()
+    for i in range(args.messages):
+        queue.put_nowait(i)
+
+    async def worker():
+        while not queue.empty():
+            i = queue.get_nowait()
+            counters = FakeCounters()
+            if threads:
+                thread = threads[i % len(threads)]
+                message = make_reply_chain(1, user_id=10_000 + i, channel_id=thread.channel.id, latency=latency, counters=counters, parent=thread)
+            else:
+                message = make_reply_chain(args.depth, user_id=10_000 + i, channel_id=i % args.channels, latency=latency, counters=counters)
+
+            started = time.perf_counter()
+            await handler.on_message(message)
+            timings.record("end_to_end", time.perf_counter() - started)
+            if counters.first_content_at is not None:
+                timings.record("first_visible_token", counters.first_content_at - started)
+
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+    finally:
+        discord_utilities.discord_message_to_openai_chat_completion_param = convert
+    elapsed = time.perf_counter() - started
+
+    print(f"\n== {concurrency} concurrent conversations: {args.messages} messages in {elapsed:.2f}s, {args.messages / elapsed:.1f} messages/s")
+    print(f"   conversation cache: {handler.conversation_cache.hits} hits, {handler.conversation_cache.misses} misses")
+    print(timings.report())
+    return handler, timings
+
+def run_startup(args: argparse.Namespace) -> None:
+    samples : Dict[str, List[float]] = defaultdict(list)
+    for _ in range(args.startup_runs):
+        output = subprocess.run(
+            [sys.executable, "-c", STARTUP_PROBE],
+            capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+        for name, value in json.loads(output.stdout.splitlines()[-1]).items():
+            samples[name].append(value)
+
+    print(f"\n== startup over {args.startup_runs} fresh processes")
+    print(f"{'measure':<24}{'p50':>10}{'p95':>10}{'max':>10}")
+    for name, values in samples.items():
+        print(f"{name:<24}{percentile(values, 50):>10.1f}{percentile(values, 95):>10.1f}{max(values):>10.1f}")
+
+async def main(args: argparse.Namespace):
+    for concurrency in args.concurrency:
+        await run_level(args, concurrency)
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Offline latency and throughput benchmark for OpenAiMessageHandler.")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16, 64])
+    parser.add_argument("--messages", type=int, default=128)
+    parser.add_argument("--depth", type=int, default=6, help="messages in each reply chain")
+    parser.add_argument("--channels", type=int, default=8)
+    parser.add_argument("--threads", type=int, default=16, help="reply chains the messages are spread over, 0 gives each message its own")
+    parser.add_argument("--tools", type=int, default=2, help="tools the model calls on each tool round")
+    parser.add_argument("--tool-rounds", type=int, default=1)
+    parser.add_argument("--tool-latency", type=float, default=0.2)
+    parser.add_argument("--discord-latency", type=float, default=0.05)
+    parser.add_argument("--first-token", type=float, default=0.4)
+    parser.add_argument("--per-token", type=float, default=0.005)
+    parser.add_argument("--tokens", type=int, default=60)
+    parser.add_argument("--stream", action="store_true")
+    parser.add_argument("--throttle", action="store_true", help="keep the default scheduler limits")
+    parser.add_argument("--startup", action="store_true", help="measure import time and memory instead of message handling")
+    parser.add_argument("--startup-runs", type=int, default=10)
+    parser.add_argument("--verbose", action="store_true")
+    return parser
+
+if __name__ == "__main__":
+    args = build_parser().parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+
+    if args.startup:
+        run_startup(args)
+    else:
+        asyncio.run(main(args))
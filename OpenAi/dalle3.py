@@ -1,7 +1,10 @@
-import base64
+import asyncio
+import binascii
 import logging
-from typing import Literal
+import time
+from typing import Any, ClassVar, Dict, Literal, Optional, Tuple
 import discord
+import httpx
 import json
 from openai import AsyncOpenAI
 import openai.types.chat as chat
@@ -11,6 +14,17 @@ from MessageHandlerProtocol import MessageHandlerProtocol
 from dataclasses import dataclass, field
 from io import BytesIO
 from tools.toolbase import ToolBase
+from Clients import get_openai_client
+from config import CONFIG
+from RequestScheduler import TokenBucket
+from Resilience import Resilience
+from ToolResultCache import NEVER_CACHE, ToolCachePolicy
+
+# optional, without it images are uploaded as the png the api returns
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
 
 AVAILABLE_SIZES = Literal["1024x1024", "1792x1024", "1024x1792"]
 AVAILABLE_QUALITIES = Literal["standard", "hd"]
@@ -22,10 +36,80 @@ DEFAULT_STYLE = "vivid"
 
 MAX_IMAGES = 7
 
+# both are shared by every request in the process: the semaphore caps how many images are generating at once,
+# the bucket keeps the process at or below the account's images-per-minute limit
+MAX_CONCURRENT_IMAGES = 5
+IMAGE_GENERATION_SEMAPHORE = asyncio.Semaphore(MAX_CONCURRENT_IMAGES)
+# the limit depends on the account's usage tier, a config without images_per_minute gets the lowest tier's
+DEFAULT_IMAGES_PER_MINUTE = 5
+IMAGES_PER_MINUTE = getattr(CONFIG, "images_per_minute", DEFAULT_IMAGES_PER_MINUTE)
+IMAGE_RATE_LIMIT = TokenBucket(rate=IMAGES_PER_MINUTE / 60, capacity=IMAGES_PER_MINUTE)
+# tool_state key for the slots a request took before its deadline started and hasn't spent yet
+RESERVED_SLOTS = "dall-e-3 reserved slots"
+# no fallback model, and never hedged: a second request would be a second, billed, image
+IMAGE_RESILIENCE = Resilience(name="images")
+
+# an hd png comes back at a few megabytes, anything far past that is not an image we asked for
+MAX_IMAGE_BYTES = 32 * 1024 * 1024
+DOWNLOAD_CHUNK_BYTES = 64 * 1024
+DOWNLOAD_MAX_CONNECTIONS = MAX_CONCURRENT_IMAGES
+
+REENCODE_FORMATS = { "webp": "WEBP", "jpeg": "JPEG" }
+# tried in order until the image fits the target size, then the image is scaled down and tried again
+REENCODE_QUALITIES = (90, 80, 70, 60, 50)
+REENCODE_MAX_DOWNSCALES = 3
+REENCODE_DOWNSCALE_FACTOR = 0.75
+
+async def wait_for_image_slot():
+    # nothing is awaited between the check and the take, so two requests can't spend the same token
+    while True:
+        wait = IMAGE_RATE_LIMIT.wait_time(time.monotonic())
+        if wait <= 0:
+            IMAGE_RATE_LIMIT.take()
+            return
+        await asyncio.sleep(wait)
+
+def decode_image(b64_json: str) -> BytesIO:
+    # a2b_base64 takes the ascii string as it is, so the decoded bytes are the only copy made,
+    # and BytesIO shares them rather than copying again
+    return BytesIO(binascii.a2b_base64(b64_json))
+
+def reencode_image(data: BytesIO, image_format: str, target_bytes: Optional[int]) -> Tuple[BytesIO, str]:
+    # runs in a worker thread, pillow holds the gil for most of it but the loop keeps ticking between images
+    assert Image is not None
+
+    with Image.open(data) as image:
+        image = image.convert("RGB")
+
+        output = BytesIO()
+        for downscale in range(REENCODE_MAX_DOWNSCALES + 1):
+            for quality in REENCODE_QUALITIES:
+                output = BytesIO()
+                image.save(output, format=REENCODE_FORMATS[image_format], quality=quality)
+                if target_bytes is None or output.tell() <= target_bytes:
+                    output.seek(0)
+                    return output, image_format
+
+            if downscale < REENCODE_MAX_DOWNSCALES:
+                width, height = image.size
+                image = image.resize((int(width * REENCODE_DOWNSCALE_FACTOR), int(height * REENCODE_DOWNSCALE_FACTOR)), Image.LANCZOS)
+
+    # the smallest attempt is still better than the original
+    output.seek(0)
+    return output, image_format
+
 @dataclass
 class DallE3Tool(ToolBase):
     emoji: str = "🎨"
-    openai = AsyncOpenAI()
+    # shares the handler's client, built on first use rather than when the module is imported
+    openai: Optional[AsyncOpenAI] = field(default=None, repr=False)
+
+    # "url" streams each image from openai's storage in chunks instead of receiving it as base64
+    response_format: Literal["b64_json", "url"] = "b64_json"
+    # "webp" or "jpeg" re-encodes the png before upload, down to target_bytes if given, None keeps the png
+    image_format: Optional[str] = None
+    target_bytes: Optional[int] = None
+    http_client: Optional[httpx.AsyncClient] = field(default=None, repr=False)
 
     @staticmethod
     def create_chat_completion_tool_param():
@@ -59,33 +143,128 @@ class DallE3Tool(ToolBase):
         )
     
     parameter: chat.ChatCompletionToolParam = field(default_factory=create_chat_completion_tool_param)
+    # a new image every time, and it works by attaching files rather than through its result
+    cache_policy: ClassVar[ToolCachePolicy] = NEVER_CACHE
+
+    @property
+    def client(self) -> AsyncOpenAI:
+        if self.openai is None:
+            self.openai = get_openai_client()
+        return self.openai
+
+    def __post_init__(self):
+        if self.image_format is not None and self.image_format not in REENCODE_FORMATS:
+            raise ValueError(f"image_format must be one of {', '.join(REENCODE_FORMATS)}")
+        if self.image_format is not None and Image is None:
+            logging.warning("Pillow is not installed, generated images are uploaded as png.")
+            self.image_format = None
+
+    async def reserve(self, arguments: str, message_handler: MessageHandlerProtocol):
+        # a slot for each image's first request, so a busy minute doesn't eat into the tool's deadline
+        for _ in range(self.image_count(json.loads(arguments))):
+            await wait_for_image_slot()
+            message_handler.tool_state[RESERVED_SLOTS] = message_handler.tool_state.get(RESERVED_SLOTS, 0) + 1
+
+    @staticmethod
+    def image_count(args: Dict[str, Any]) -> int:
+        # never trust the model with the upper bound
+        return max(1, min(int(args.get("n", 1)), MAX_IMAGES))
+
+    def get_http_client(self) -> httpx.AsyncClient:
+        if self.http_client is None:
+            self.http_client = httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=DOWNLOAD_MAX_CONNECTIONS),
+                timeout=httpx.Timeout(60.0))
+        return self.http_client
+
+    async def download_image(self, url: str) -> BytesIO:
+        data = BytesIO()
+        async with self.get_http_client().stream("GET", url) as response:
+            response.raise_for_status()
+            async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_BYTES):
+                if data.tell() + len(chunk) > MAX_IMAGE_BYTES:
+                    raise ValueError(f"Generated image is larger than {MAX_IMAGE_BYTES} bytes")
+                data.write(chunk)
+        data.seek(0)
+        return data
 
     async def get_tool_result(self, arguments: str, message_handler: MessageHandlerProtocol) -> str:
         args = json.loads(arguments)
 
         prompt = args.get("prompt")
         size = args.get("size", DEFAULT_SIZE)
-        n = args.get("n", 1)
+        n = self.image_count(args)
         quality = args.get("quality", DEFAULT_QUALITY)
         style = args.get("style", DEFAULT_STYLE)
-        
-        logging.info(f"Generating image for '{args['prompt'][:20]}' with model 'dall-e-3' and size '{args['size']}' and quality='hd' and style='vivid' and n={1}")
-
-        for i in range(n):
-            imagesReponse = await self.openai.images.generate(
-                prompt=prompt,
-                model="dall-e-3",
-                size=size,
-                quality=quality,
-                style=style,
-                n=1,
-                response_format="b64_json")
-            
-            if imagesReponse.data[0].b64_json is not None:
-                bytes_io = BytesIO(base64.b64decode(imagesReponse.data[0].b64_json))
-                bytes_io.seek(0)                            
-                message_handler.files.append(discord.File(bytes_io, filename=f"dalle3-{i}.png"))
-
-        filenames = list(map(lambda f: f'attachment://{f.filename}', message_handler.files))
+
+        logging.info(f"Generating {n} images for '{prompt[:20]}' with model 'dall-e-3' and size '{size}' and quality='{quality}' and style='{style}'")
+
+        # each image is its own request, so they all run at once and land in the discord message as they finish
+        results = await asyncio.gather(
+            *[self.generate_image(prompt, size, quality, style, message_handler) for i in range(n)],
+            return_exceptions=True)
+
+        filenames = [f'attachment://{r}' for r in results if isinstance(r, str)]
+        errors = [str(r) for r in results if isinstance(r, BaseException)]
+
+        for error in errors:
+            logging.error(f"Image generation failed: {error}")
+
+        # only give up if nothing at all came back
+        if not filenames and errors:
+            raise next(r for r in results if isinstance(r, BaseException))
+
+        if errors:
+            return json.dumps({ "filenames" : filenames, "errors" : errors })
+
         return json.dumps({ "filenames" : filenames })
-        
\ No newline at end of file
+
+    async def generate_image(
+            self,
+            prompt: str,
+            size: str,
+            quality: str,
+            style: str,
+            message_handler: MessageHandlerProtocol) -> Optional[str]:
+        async def attempt(model: str):
+            # every attempt, retries included, counts against the per-minute limit: one reserved before
+            # the deadline started is spent first, anything past those waits for a slot here,
+            # and the semaphore is only held while a request is out, not while waiting to retry
+            reserved = message_handler.tool_state.get(RESERVED_SLOTS, 0)
+            if reserved > 0:
+                message_handler.tool_state[RESERVED_SLOTS] = reserved - 1
+            else:
+                await wait_for_image_slot()
+            async with IMAGE_GENERATION_SEMAPHORE:
+                return await self.client.images.generate(
+                    prompt=prompt,
+                    model=model,
+                    size=size,
+                    quality=quality,
+                    style=style,
+                    n=1,
+                    response_format=self.response_format)
+
+        # the shared client doesn't retry, a rate limited or failed image is retried here
+        imagesReponse = await IMAGE_RESILIENCE.call("dall-e-3", attempt, hedge=False)
+
+        image = imagesReponse.data[0]
+        if self.response_format == "url":
+            if image.url is None:
+                return None
+            data = await self.download_image(image.url)
+        else:
+            if image.b64_json is None:
+                return None
+            data = decode_image(image.b64_json)
+        # the base64 string is no longer needed, don't hold it through the upload
+        del imagesReponse, image
+
+        extension = "png"
+        if self.image_format is not None:
+            data, extension = await asyncio.to_thread(reencode_image, data, self.image_format, self.target_bytes)
+
+        # numbered by arrival, which also keeps names unique across several calls in one request
+        filename = f"dalle3-{len(message_handler.files)}.{extension}"
+        await message_handler.add_file(discord.File(data, filename=filename))
+        return filename
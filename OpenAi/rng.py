@@ -1,12 +1,165 @@
 import json
+from typing import Any, ClassVar, Dict, List, Tuple
 import random
+import secrets
+import statistics
 import openai.types.chat as chat
 
 from dataclasses import dataclass, field
 
 from tools.toolbase import ToolBase
+from ToolResultCache import NEVER_CACHE, ToolCachePolicy
 import openai.types.shared_params as shared_params
 
+# optional, a pure python generator is used without it
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# batches bigger than this are worth the trip to a worker process
+IN_PROCESS_MAX_N = 100_000
+
+MAX_N = 10_000_000
+# without numpy every value is a python object, keep that bounded
+MAX_N_WITHOUT_NUMPY = 1_000_000
+MAX_SHUFFLE_ITEMS = 1_000
+# up to this many values are returned as they are, beyond it the model gets a summary
+MAX_LISTED_VALUES = 100
+HISTOGRAM_BINS = 20
+SAMPLE_SIZE = 10
+
+DISTRIBUTIONS = ["integer", "float", "normal", "choice", "shuffle"]
+
+# a seeded draw always comes out the same; kept in memory only, numpy and the fallback generator disagree
+SEEDED_CACHE_POLICY = ToolCachePolicy(ttl=60 * 60)
+
+def new_seed() -> int:
+    # returned with the result, so the same stream can be asked for again
+    return secrets.randbits(63)
+
+def shuffle_pool(args: Dict[str, Any]) -> List[Any]:
+    if args.get("items"):
+        pool = list(args["items"])
+    elif "min" in args and "max" in args:
+        pool = list(range(int(args["min"]), int(args["max"]) + 1))
+    else:
+        raise ValueError("shuffle needs items, or min and max")
+    if len(pool) > MAX_SHUFFLE_ITEMS:
+        raise ValueError(f"shuffle is limited to {MAX_SHUFFLE_ITEMS} items")
+    return pool
+
+def generate(args: Dict[str, Any], distribution: str, n: int, seed: int) -> Any:
+    if distribution in ("integer", "float") and ("min" not in args or "max" not in args):
+        raise ValueError(f"The {distribution} distribution needs min and max")
+
+    items = args.get("items") or []
+    weights = args.get("weights")
+    if distribution == "choice":
+        if not items:
+            raise ValueError("The choice distribution needs items to choose from")
+        if weights is not None and (len(weights) != len(items) or min(weights) < 0 or sum(weights) <= 0):
+            raise ValueError("weights must be one non-negative number for each item")
+
+    if numpy is not None:
+        rng = numpy.random.default_rng(seed)
+        if distribution == "integer":
+            return rng.integers(int(args["min"]), int(args["max"]), size=n, endpoint=True)
+        if distribution == "float":
+            return rng.uniform(float(args["min"]), float(args["max"]), size=n)
+        if distribution == "normal":
+            return rng.normal(float(args.get("mean", 0.0)), float(args.get("stddev", 1.0)), size=n)
+        if distribution == "choice":
+            p = numpy.asarray(weights, dtype=float) / float(sum(weights)) if weights is not None else None
+            return rng.choice(len(items), size=n, p=p)
+        pool = shuffle_pool(args)
+        return [pool[i] for i in rng.permutation(len(pool))]
+
+    r = random.Random(seed)
+    if distribution == "integer":
+        low, high = int(args["min"]), int(args["max"])
+        return [r.randint(low, high) for _ in range(n)]
+    if distribution == "float":
+        low, high = float(args["min"]), float(args["max"])
+        return [r.uniform(low, high) for _ in range(n)]
+    if distribution == "normal":
+        mean, stddev = float(args.get("mean", 0.0)), float(args.get("stddev", 1.0))
+        return [r.gauss(mean, stddev) for _ in range(n)]
+    if distribution == "choice":
+        return r.choices(range(len(items)), weights=weights, k=n)
+    pool = shuffle_pool(args)
+    r.shuffle(pool)
+    return pool
+
+def histogram(values: Any, integers: bool) -> List[Dict[str, Any]]:
+    low, high = min_max(values)
+
+    # a small range of integers is counted value by value, anything else goes into equal bins
+    if integers and high - low < HISTOGRAM_BINS:
+        if numpy is not None:
+            counts = numpy.bincount(values - low).tolist()
+        else:
+            counts = [0] * (high - low + 1)
+            for v in values:
+                counts[v - low] += 1
+        return [{ "value": low + i, "count": c } for i, c in enumerate(counts)]
+
+    if numpy is not None:
+        counts, edges = numpy.histogram(values, bins=HISTOGRAM_BINS)
+        counts, edges = counts.tolist(), edges.tolist()
+    else:
+        width = (high - low) / HISTOGRAM_BINS or 1
+        counts = [0] * HISTOGRAM_BINS
+        for v in values:
+            counts[min(HISTOGRAM_BINS - 1, int((v - low) / width))] += 1
+        edges = [low + i * width for i in range(HISTOGRAM_BINS + 1)]
+    return [{ "from": edges[i], "to": edges[i + 1], "count": c } for i, c in enumerate(counts)]
+
+def min_max(values: Any) -> Tuple[Any, Any]:
+    if numpy is not None:
+        return values.min().item(), values.max().item()
+    return min(values), max(values)
+
+def summarize(values: Any, integers: bool) -> Dict[str, Any]:
+    low, high = min_max(values)
+    if numpy is not None:
+        mean, stddev = float(values.mean()), float(values.std())
+        sample = values[:SAMPLE_SIZE].tolist()
+    else:
+        mean, stddev = statistics.fmean(values), statistics.pstdev(values)
+        sample = values[:SAMPLE_SIZE]
+    return {
+        "count": len(values),
+        "min": low,
+        "max": high,
+        "mean": mean,
+        "stddev": stddev,
+        "histogram": histogram(values, integers),
+        "sample": sample }
+
+def describe(args: Dict[str, Any], distribution: str, values: Any) -> Dict[str, Any]:
+    if distribution == "shuffle":
+        return { "result": values }
+
+    if distribution == "choice":
+        items = args["items"]
+        if len(values) <= MAX_LISTED_VALUES:
+            return { "result": [items[int(i)] for i in values] }
+        if numpy is not None:
+            counts = numpy.bincount(values, minlength=len(items)).tolist()
+        else:
+            counts = [0] * len(items)
+            for i in values:
+                counts[i] += 1
+        return { "summary": {
+            "count": len(values),
+            "counts": { str(item): c for item, c in zip(items, counts) },
+            "sample": [items[int(i)] for i in values[:SAMPLE_SIZE]] } }
+
+    if len(values) <= MAX_LISTED_VALUES:
+        return { "result": values.tolist() if numpy is not None else values }
+    return { "summary": summarize(values, integers=distribution == "integer") }
+
 @dataclass
 class RngTool(ToolBase):
     emoji: str = "🎲"
@@ -17,39 +170,91 @@ class RngTool(ToolBase):
             type="function",
             function=shared_params.FunctionDefinition(
                 name="rng",
-                description="Generate a random number between min and max, inclusive",
+                description="Generate random numbers, inclusive of min and max, from a seedable stream; also draws from a normal distribution, picks weighted choices and shuffles",
                 parameters=dict(
                     type="object",
                     properties={
+                        "distribution": {
+                            "type": "string",
+                            "enum": DISTRIBUTIONS,
+                            "description": "integer (default) and float are uniform between min and max, normal uses mean and stddev, choice picks from items using the optional weights, shuffle returns items, or min to max, in a random order"
+                        },
                         "min": {
                             "type": "number",
-                            "description": "The minimum number"                    
+                            "description": "The minimum number"
                         },
                         "max": {
                             "type": "number",
-                            "description": "The maximum number"                    
+                            "description": "The maximum number"
                         },
                         "n": {
                             "type": "number",
-                            "description": "The number of random numbers to generate"                    
+                            "description": f"The number of random values to generate, at most {MAX_N}. Beyond {MAX_LISTED_VALUES} a summary with a histogram is returned instead of every value"
+                        },
+                        "mean": {
+                            "type": "number",
+                            "description": "The mean of the normal distribution, 0 by default"
+                        },
+                        "stddev": {
+                            "type": "number",
+                            "description": "The standard deviation of the normal distribution, 1 by default"
+                        },
+                        "items": {
+                            "type": "array",
+                            "items": { "type": "string" },
+                            "description": "The items to choose from or shuffle"
+                        },
+                        "weights": {
+                            "type": "array",
+                            "items": { "type": "number" },
+                            "description": "Relative weights for choice, one for each item"
+                        },
+                        "seed": {
+                            "type": "integer",
+                            "description": "Repeats an earlier result when given the seed it returned"
                         },
                         "response": {
-                            "type" :"string",
-                            "description":"The confirmation message to the user."
+                            "type": "string",
+                            "description": "The confirmation message to the user."
                         }
                     },
-                    required=["min", "max"],
+                    required=[],
                 )
             )
         )
 
     parameter: chat.ChatCompletionToolParam = field(default_factory=create_chat_completion_tool_param)
+    # every call without a seed must roll again
+    cache_policy: ClassVar[ToolCachePolicy] = NEVER_CACHE
+
+    def cache_policy_for(self, arguments: str) -> ToolCachePolicy:
+        try:
+            seeded = json.loads(arguments).get("seed") is not None
+        except (ValueError, AttributeError):
+            seeded = False
+        return SEEDED_CACHE_POLICY if seeded else self.cache_policy
+
+    def is_cpu_bound(self, arguments: str) -> bool:
+        try:
+            return json.loads(arguments).get("n", 1) > IN_PROCESS_MAX_N
+        except (ValueError, AttributeError, TypeError):
+            return False
 
     async def get_tool_result(self, arguments: str, message_handler) -> str:
         args = json.loads(arguments)
 
-        n = args.get("n", 1)
+        distribution = args.get("distribution", "integer")
+        if distribution not in DISTRIBUTIONS:
+            raise ValueError(f"Unknown distribution {distribution}, expected one of {', '.join(DISTRIBUTIONS)}")
+
+        n = int(args.get("n", 1))
+        max_n = MAX_N if numpy is not None else MAX_N_WITHOUT_NUMPY
+        if n < 1 or n > max_n:
+            raise ValueError(f"n must be between 1 and {max_n}")
+
+        seed = args.get("seed")
+        seed = int(seed) if seed is not None else new_seed()
 
-        rn = [random.randint(args["min"], args["max"]) for i in range(n)]
+        values = generate(args, distribution, n, seed)
 
-        return json.dumps({ "result": rn })
+        return json.dumps({ **describe(args, distribution, values), "seed": seed })
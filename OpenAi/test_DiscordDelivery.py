@@ -0,0 +1,17 @@
+from DiscordDelivery import FENCE, find_cut, open_fence, split_message
+
+def test_fence_with_text_on_the_same_line_keeps_its_text():
+    chunks = split_message(FENCE + "a" * 50 + "\n", 20)
+
+    assert "".join(chunks).count("a") == 50
+    for chunk in chunks:
+        assert len(chunk) <= 20
+        assert open_fence(chunk) is None
+
+def test_chunks_of_fences_the_message_wrote_are_kept():
+    assert split_message("```\n```\n", 20) == ["```\n```\n"]
+
+def test_skin_tone_stays_with_its_emoji():
+    line = "a" * 9 + "👍🏽" + "b" * 10
+    cut = find_cut(line, 10)
+    assert line[:cut] == "a" * 9
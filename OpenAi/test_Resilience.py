@@ -0,0 +1,39 @@
+import asyncio
+
+import pytest
+
+from Resilience import BREAKER_FAILURE_THRESHOLD, Resilience
+
+class StatusError(Exception):
+    def __init__(self, status_code: int):
+        super().__init__(f"status {status_code}")
+        self.status_code = status_code
+
+def fail_with(status_code: int):
+    async def attempt(model: str):
+        raise StatusError(status_code)
+    return attempt
+
+def test_bad_requests_leave_the_breaker_closed():
+    resilience = Resilience(fallback_model="fallback", base_delay=0)
+
+    async def run():
+        for _ in range(BREAKER_FAILURE_THRESHOLD * 2):
+            with pytest.raises(StatusError):
+                await resilience.call("model", fail_with(400))
+
+    asyncio.run(run())
+    assert resilience.breaker_for("model").state == "closed"
+    assert resilience.choose_model("model") == "model"
+
+def test_server_errors_open_the_breaker():
+    resilience = Resilience(fallback_model="fallback", base_delay=0, max_attempts=1)
+
+    async def run():
+        for _ in range(BREAKER_FAILURE_THRESHOLD):
+            with pytest.raises(StatusError):
+                await resilience.call("model", fail_with(503))
+
+    asyncio.run(run())
+    assert resilience.breaker_for("model").state == "open"
+    assert resilience.choose_model("model") == "fallback"
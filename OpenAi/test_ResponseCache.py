@@ -0,0 +1,30 @@
+import asyncio
+import os
+
+from ResponseCache import ResponseCache
+
+def test_forgetting_a_message_drops_every_response_built_from_it(tmp_path):
+    path = os.path.join(str(tmp_path), "responses.sqlite3")
+
+    async def run():
+        cache = ResponseCache(path=path)
+        cache.put("thread", "reply", 1.0, (1, 2))
+        cache.put("other", "reply", 1.0, (3,))
+        await cache.close()
+
+        cache.forget_message(2)
+        assert cache.get_memory("thread") is None
+        assert cache.get_memory("other") is not None
+        await cache.close()
+
+        # a restart doesn't bring it back from disk either
+        reopened = ResponseCache(path=path)
+        assert await reopened.get("thread", "test", "model") is None
+        assert await reopened.get("other", "test", "model") == "reply"
+
+        # what came back from disk still knows its messages
+        reopened.forget_message(3)
+        assert reopened.get_memory("other") is None
+        await reopened.close()
+
+    asyncio.run(run())
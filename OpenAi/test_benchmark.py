@@ -0,0 +1,22 @@
+import asyncio
+
+import pytest
+
+# the benchmark drives the real handler, which needs the provider sdk and the tools package, as deployed
+pytest.importorskip("openai")
+pytest.importorskip("tools.toolbase")
+
+import benchmark
+
+def test_every_message_finishes_with_its_tool_rounds():
+    args = benchmark.build_parser().parse_args([
+        "--messages", "8", "--depth", "4", "--channels", "2", "--threads", "2",
+        "--tools", "2", "--tool-rounds", "2",
+        "--tool-latency", "0", "--discord-latency", "0", "--first-token", "0", "--per-token", "0", "--tokens", "4"])
+
+    handler, timings = asyncio.run(benchmark.run_level(args, concurrency=4))
+
+    assert len(timings.samples["end_to_end"]) == 8
+    assert len(timings.samples["tool"]) == 8 * 2 * 2
+    # the messages of a thread share its history, only the first to reach it has to convert it
+    assert handler.conversation_cache.hits > 0
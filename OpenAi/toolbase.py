@@ -1,19 +1,22 @@
 from __future__ import annotations
-from typing import List
+from typing import Awaitable, Callable, ClassVar, Optional
 import discord
 import openai.types.chat as chat
 from abc import ABC, abstractmethod
 from dataclasses import dataclass
 from MessageHandlerProtocol import MessageHandlerProtocol
+from RequestContext import RequestContext
+from ToolResultCache import NEVER_CACHE, TOOL_RESULT_CACHE, ToolCachePolicy
  
 @dataclass
 class ToolBase(ABC):    
-    class MessageHandler(MessageHandlerProtocol):
-        def __init__(self):
-            self.files : List[discord.File] = []
-
     emoji: str
     parameter: chat.ChatCompletionToolParam
+    cache_policy: ClassVar[ToolCachePolicy] = NEVER_CACHE
+    # overrides the executor's default deadline
+    timeout: ClassVar[Optional[float]] = None
+    # run in a worker process, only for tools whose whole output is their json result
+    cpu_bound: ClassVar[bool] = False
 
     @abstractmethod
     def create_chat_completion_tool_param():
@@ -26,21 +29,54 @@ class ToolBase(ABC):
             message_handler : MessageHandlerProtocol) -> str:
         pass        
 
+    def is_cpu_bound(self, arguments: str) -> bool:
+        return self.cpu_bound
+
+    async def reserve(self, arguments: str, message_handler : MessageHandlerProtocol):
+        # waits for capacity the call will need, like a rate limited api's quota, before its deadline starts
+        pass
+
+    def cache_policy_for(self, arguments: str) -> ToolCachePolicy:
+        # a tool that is only deterministic for some arguments, like a seeded draw, can opt in call by call
+        return self.cache_policy
+
+    async def run(
+            self,
+            arguments: str,
+            message_handler : MessageHandlerProtocol,
+            call: Optional[Callable[[], Awaitable[str]]] = None) -> str:
+        # every caller goes through here so tools that opt in share the result cache,
+        # call is how the result is produced when it isn't simply get_tool_result in this process
+        if call is None:
+            call = lambda: self.get_tool_result(arguments, message_handler)
+
+        policy = self.cache_policy_for(arguments)
+        if not policy.enabled:
+            return await call()
+
+        return await TOOL_RESULT_CACHE.get_or_run(
+            self.parameter["function"]["name"],
+            arguments,
+            policy,
+            call,
+            scope=getattr(message_handler.channel, "id", None))
+
     async def on_interaction(self, interaction: discord.Interaction, arguments: str, success_response: str):
         assert isinstance(interaction.channel, discord.TextChannel)
         
         await interaction.response.send_message("🤔")
 
-        message_handler = self.MessageHandler()
+        context = RequestContext(author=interaction.user, channel=interaction.channel)
         
         async with interaction.channel.typing():
             try:
-                await self.get_tool_result(arguments, message_handler)
+                await self.reserve(arguments, context)
+                await self.run(arguments, context)
 
-                if message_handler.files:
+                if context.files:
                     await interaction.edit_original_response(
                         content=success_response,
-                        attachments=message_handler.files)
+                        attachments=context.files)
 
             except Exception as e:                
                 await interaction.edit_original_response(